@@ -0,0 +1,315 @@
+"""
+Нагрузочные замеры: распределение ролей, операции с базой и рассылка.
+
+Запуск:
+    python benchmark.py                              # 100, 10 000 и 100 000 участников
+    python benchmark.py --sizes 100,1000 --output bench.json
+    python benchmark.py --only distribution --densities 0,2,50
+
+Результаты пишутся в JSON, чтобы сравнивать их между версиями.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Set, Tuple
+
+from telegram.error import RetryAfter
+
+from broadcast import Broadcaster
+from database import Database, DEFAULT_GAME_ID
+from distribution import build_forbidden, check_feasibility, find_assignment
+
+
+# Размеры игр по умолчанию
+DEFAULT_SIZES = (100, 10_000, 100_000)
+
+# Плотности исключений по умолчанию: среднее число исключений на участника
+DEFAULT_DENSITIES = (0, 1, 5)
+
+# Сколько раз повторяем каждое распределение (каждый раз с новыми исключениями)
+DEFAULT_REPEAT = 5
+
+# Сколько отдельных операций с базой замеряем на каждый метод
+DB_SAMPLE = 1000
+
+# Сколько сообщений рассылаем в замере рассылки (не больше размера игры)
+BROADCAST_SAMPLE = 5000
+
+# Задержка ответа заглушки бота в секундах
+STUB_LATENCY = 0.005
+
+BENCHMARKS = ('distribution', 'database', 'broadcast')
+
+
+def generate_users(n: int, rng: random.Random) -> List[Tuple]:
+    """Участники в формате строк users: (user_id, username, first_name, last_name)"""
+    first_names = ['Анна', 'Иван', 'Мария', 'Пётр', 'Ольга', 'Сергей', 'Елена', 'Дмитрий']
+    last_names = ['Иванов', 'Смирнова', 'Кузнецов', 'Попова', None]
+    user_ids = rng.sample(range(10_000_000, 10_000_000 + n * 10), n)
+    return [
+        (user_id, f"user{user_id}", rng.choice(first_names), rng.choice(last_names))
+        for user_id in user_ids
+    ]
+
+
+def generate_exclusions(user_ids: List[int], density: float,
+                        rng: random.Random) -> List[Tuple[int, int]]:
+    """
+    Случайные пары исключений: в среднем density исключений на участника.
+    Пары упорядочены (меньший ID первым) и не повторяются.
+    """
+    n = len(user_ids)
+    target = min(int(n * density / 2), n * (n - 1) // 2)
+    pairs: Set[Tuple[int, int]] = set()
+    while len(pairs) < target:
+        a, b = rng.sample(user_ids, 2)
+        pairs.add((min(a, b), max(a, b)))
+    return list(pairs)
+
+
+def exclusion_index(pairs: List[Tuple[int, int]]) -> Dict[int, Set[int]]:
+    """Индекс исключений в том же виде, что отдает Database.get_exclusion_index"""
+    index: Dict[int, Set[int]] = {}
+    for a, b in pairs:
+        index.setdefault(a, set()).add(b)
+        index.setdefault(b, set()).add(a)
+    return index
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    """Сводка по замерам в миллисекундах"""
+    ordered = sorted(samples)
+
+    def percentile(p: float) -> float:
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000
+
+    return {
+        'count': len(ordered),
+        'mean_ms': statistics.fmean(ordered) * 1000,
+        'p50_ms': percentile(0.50),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+        'max_ms': ordered[-1] * 1000,
+    }
+
+
+def timed(func: Callable, *args) -> float:
+    """Время одного вызова в секундах"""
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def bench_distribution(n: int, density: float, repeat: int, seed: int) -> Dict:
+    """Время и доля успеха распределения (то же, что делает distribute_roles)"""
+    samples = []
+    checks = []
+    successes = 0
+    for attempt in range(repeat):
+        rng = random.Random(seed + attempt)
+        user_ids = [u[0] for u in generate_users(n, rng)]
+        index = exclusion_index(generate_exclusions(user_ids, density, rng))
+
+        start = time.perf_counter()
+        forbidden = build_forbidden(user_ids, index)
+        _, violation = check_feasibility(user_ids, forbidden)
+        checks.append(time.perf_counter() - start)
+        assignment = None if violation else find_assignment(user_ids, forbidden, rng)
+        samples.append(time.perf_counter() - start)
+        successes += assignment is not None
+
+    return {
+        'benchmark': 'distribution',
+        'participants': n,
+        'density': density,
+        'success_rate': successes / repeat,
+        'feasibility_check': summarize(checks),
+        'time': summarize(samples),
+    }
+
+
+def bench_database(n: int, density: float, seed: int) -> Dict:
+    """Задержки отдельных методов Database на игре из n участников"""
+    rng = random.Random(seed)
+    users = generate_users(n, rng)
+    user_ids = [u[0] for u in users]
+    pairs = generate_exclusions(user_ids, density, rng)
+    sample = min(n, DB_SAMPLE)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'))
+        operations: Dict[str, List[float]] = {}
+
+        def measure(name: str, func: Callable, calls):
+            operations[name] = [timed(func, *args) for args in calls]
+
+        # Первые sample участников — отдельными транзакциями, остальных одной пачкой
+        measure('add_user', db.add_user, [(DEFAULT_GAME_ID, *u) for u in users[:sample]])
+        start = time.perf_counter()
+        with db.transaction():
+            for user in users[sample:]:
+                db.add_user(DEFAULT_GAME_ID, *user)
+        bulk_users = time.perf_counter() - start
+
+        measure('add_exclusion', db.add_exclusion, [(DEFAULT_GAME_ID, a, b) for a, b in pairs[:sample]])
+        with db.transaction():
+            for a, b in pairs[sample:]:
+                db.add_exclusion(DEFAULT_GAME_ID, a, b)
+
+        probe = rng.sample(user_ids, sample)
+        measure('get_user_cached', db.get_user, [(DEFAULT_GAME_ID, u) for u in probe])
+        db._user_cache.clear()
+        measure('get_user_uncached', db.get_user, [(DEFAULT_GAME_ID, u) for u in probe])
+        measure('is_registered', db.is_registered, [(DEFAULT_GAME_ID, u) for u in probe])
+
+        # Листаем список участников вперед, как кнопка «Вперед»
+        pages = []
+        cursor_id = None
+        for _ in range(min(sample, max(1, n // 20))):
+            start = time.perf_counter()
+            rows, _, has_next = db.get_users_page(DEFAULT_GAME_ID, after_id=cursor_id)
+            pages.append(time.perf_counter() - start)
+            if not has_next:
+                break
+            cursor_id = rows[-1][0]
+        operations['get_users_page'] = pages
+
+        operations['get_all_users'] = [timed(db.get_all_users, DEFAULT_GAME_ID) for _ in range(3)]
+        operations['get_user_names'] = [timed(db.get_user_names, DEFAULT_GAME_ID) for _ in range(3)]
+        operations['get_exclusion_index'] = [timed(db.get_exclusion_index, DEFAULT_GAME_ID)]
+        operations['get_exclusions_with_names'] = [timed(db.get_exclusions_with_names, DEFAULT_GAME_ID)]
+
+        shuffled = user_ids[:]
+        rng.shuffle(shuffled)
+        assignment = list(zip(shuffled, shuffled[1:] + shuffled[:1]))
+        messages = [(giver, f"Вы дарите подарок {receiver}") for giver, receiver in assignment]
+        operations['save_assignments'] = [
+            timed(db.save_assignments, DEFAULT_GAME_ID, assignment, messages, 'bench')
+        ]
+        measure('get_assignment', db.get_assignment, [(DEFAULT_GAME_ID, u) for u in probe])
+        operations['get_assignments_with_names'] = [timed(db.get_assignments_with_names, DEFAULT_GAME_ID)]
+        db.close()
+
+    return {
+        'benchmark': 'database',
+        'participants': n,
+        'density': density,
+        'bulk_add_user_s': bulk_users,
+        'operations': {name: summarize(samples) for name, samples in operations.items() if samples},
+    }
+
+
+class StubBot:
+    """Заглушка бота: отвечает с задержкой и иногда включает флуд-контроль"""
+
+    def __init__(self, latency: float = STUB_LATENCY, flood_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.sent = 0
+        self.floods = 0
+        self._rng = random.Random(seed)
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        await asyncio.sleep(self.latency)
+        if self._rng.random() < self.flood_rate:
+            self.floods += 1
+            raise RetryAfter(0.01)
+        self.sent += 1
+
+
+def bench_broadcast(n: int, rate: float, latency: float, flood_rate: float, seed: int) -> Dict:
+    """Пропускная способность Broadcaster на заглушке бота"""
+    count = min(n, BROADCAST_SAMPLE)
+    bot = StubBot(latency, flood_rate, seed)
+    messages = [(chat_id, "🎅 Тайный Санта") for chat_id in range(count)]
+
+    async def run():
+        broadcaster = Broadcaster(rate=rate or float('inf'))
+        start = time.perf_counter()
+        result = await broadcaster.broadcast(bot, messages)
+        return result, time.perf_counter() - start
+
+    result, elapsed = asyncio.run(run())
+    return {
+        'benchmark': 'broadcast',
+        'messages': count,
+        'rate_limit': rate or None,
+        'stub_latency_s': latency,
+        'flood_rate': flood_rate,
+        'sent': result.sent,
+        'failed': result.failed,
+        'floods': bot.floods,
+        'elapsed_s': elapsed,
+        'throughput_per_s': count / elapsed if elapsed else None,
+    }
+
+
+def parse_list(value: str, cast) -> List:
+    return [cast(item) for item in value.split(',') if item.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замеры производительности Тайного Санты")
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help="размеры игр через запятую")
+    parser.add_argument('--densities', default=','.join(map(str, DEFAULT_DENSITIES)),
+                        help="среднее число исключений на участника через запятую")
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help="повторов распределения на каждую точку")
+    parser.add_argument('--only', choices=BENCHMARKS, action='append',
+                        help="запустить только указанные замеры")
+    parser.add_argument('--rate', type=float, default=0,
+                        help="лимит рассылки в сообщениях в секунду (0 — без лимита)")
+    parser.add_argument('--latency', type=float, default=STUB_LATENCY,
+                        help="задержка ответа заглушки бота в секундах")
+    parser.add_argument('--flood-rate', type=float, default=0.0,
+                        help="доля отправок, на которые заглушка отвечает RetryAfter")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="файл для JSON (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    sizes = parse_list(args.sizes, int)
+    densities = parse_list(args.densities, float)
+    selected = args.only or BENCHMARKS
+    results = []
+
+    for n in sizes:
+        for density in densities:
+            if 'distribution' in selected:
+                results.append(bench_distribution(n, density, args.repeat, args.seed))
+            if 'database' in selected:
+                results.append(bench_database(n, density, args.seed))
+            print(f"{n} участников, плотность {density}: готово", file=sys.stderr)
+        if 'broadcast' in selected:
+            results.append(bench_broadcast(n, args.rate, args.latency, args.flood_rate, args.seed))
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'sizes': sizes,
+            'densities': densities,
+            'repeat': args.repeat,
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,26 @@
-import random
+import asyncio
 import logging
+import os
+import re
+import tempfile
+import time
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, ContextTypes, filters, ConversationHandler
-from database import Database
-from config import BOT_TOKEN, ADMIN_ID
+from database import Database, AsyncDatabase, LRUCache, DEFAULT_GAME_ID, WISHLIST_MAX_LENGTH
+from distribution import (
+    build_forbidden, can_give, check_feasibility, find_assignment, find_chain, find_cycles, splice_out,
+)
+from broadcast import Broadcaster, PROGRESS_INTERVAL
+from outbox import OutboxWorker
+from notifier import WishlistNotifier
+from persistence import SqlitePersistence
+from transfer import KINDS, FORMATS, detect_format, import_stream, export_bytes
+from metrics import HANDLER_SECONDS, timed_handler, render_summary, start_http_server
+from config import (
+    BOT_TOKEN, ADMIN_ID,
+    WEBHOOK_URL, WEBHOOK_SECRET, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH,
+    TELEGRAM_API_URL, METRICS_PORT, WISHLIST_NOTIFY_DELAY, PERSISTENCE_INTERVAL,
+)
 
 # Настройка логирования
 logging.basicConfig(
@@ -12,320 +29,697 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Инициализация базы данных
-db = Database()
+# Инициализация базы данных (запросы выполняются в пуле потоков)
+db = AsyncDatabase(Database())
+
+# Рассылка сообщений с учетом лимитов Telegram
+broadcaster = Broadcaster()
+
+# Фоновая доставка сообщений из очереди outbox
+outbox_worker = OutboxWorker(db, broadcaster)
+
+# Отложенные уведомления дарителям об изменении вишлиста
+wishlist_notifier = WishlistNotifier(db, outbox_worker)
 
 # Состояния для ConversationHandler
 WAITING_FOR_WISHLIST = 1
 
+# Кэш готовых экранов (текст и клавиатура): размер и время жизни записи в секундах.
+# Изменения, сделанные ботом, сбрасывают кэш сразу через версию данных игры;
+# время жизни ограничивает устаревание после правок другими процессами (transfer.py)
+RENDER_CACHE_SIZE = 1000
+RENDER_CACHE_TTL = 60
+render_cache = LRUCache(RENDER_CACHE_SIZE, RENDER_CACHE_TTL)
+
+# Максимальная длина сообщения в Telegram
+MESSAGE_LIMIT = 4096
+
+# Сколько имен показываем, объясняя, почему распределение невозможно
+VIOLATION_NAMES_LIMIT = 10
+
+# Максимальный размер загружаемого файла (больше Bot API боту все равно не отдаст)
+IMPORT_MAX_BYTES = 20 * 1024 * 1024
+
+# Блокировки раздачи ролей по играм: одновременно идет не больше одной
+distribution_locks = {}
+
+# Последнее допустимое паросочетание по играм: с него начинается проверка
+# нового исключения, поэтому она стоит пару поисков, а не полный пересчет
+feasibility_hints = {}
+
+# Бот обрабатывает только сообщения и нажатия кнопок — остальные обновления не запрашиваем
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+
+def is_admin(user_id: int, game) -> bool:
+    """Проверить, является ли пользователь админом игры"""
+    return game is not None and user_id == game[2]
+
+
+def page_navigation(screen, rows, has_prev, has_next, arg=0):
+    """Кнопки перехода между страницами списка (курсор — первая колонка строки)"""
+    buttons = []
+    if has_prev and rows:
+        buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"page_{screen}_{arg}_p_{rows[0][0]}"))
+    if has_next and rows:
+        buttons.append(InlineKeyboardButton("Вперед ➡️", callback_data=f"page_{screen}_{arg}_n_{rows[-1][0]}"))
+    return [buttons] if buttons else []
+
+
+def split_text(text, limit=MESSAGE_LIMIT):
+    """Разбить текст на части не длиннее limit, по возможности по строкам"""
+    chunks = []
+    current = ""
+    for line in text.splitlines(keepends=True):
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if len(current) + len(line) > limit:
+            chunks.append(current)
+            current = ""
+        current += line
+    if current or not chunks:
+        chunks.append(current)
+    return chunks
+
+
+async def edit_long_text(query, text, reply_markup=None):
+    """
+    Показать текст, который может не поместиться в одно сообщение:
+    первая часть заменяет текущее сообщение, остальные отправляются следом,
+    клавиатура прикрепляется к последней части.
+    """
+    chunks = split_text(text)
+    if len(chunks) == 1:
+        await show_screen(query, chunks[0], reply_markup=reply_markup)
+        return
+    
+    await query.edit_message_text(chunks[0])
+    for chunk in chunks[1:-1]:
+        await query.message.reply_text(chunk)
+    await query.message.reply_text(chunks[-1], reply_markup=reply_markup)
+
+
+def role_of(user_id: int, game) -> str:
+    """Роль пользователя в игре для кэша экранов"""
+    return 'admin' if is_admin(user_id, game) else 'player'
+
+
+async def render_screen(screen, role, game, args, build):
+    """
+    Текст и клавиатура экрана из кэша. Ключ — (экран, роль, игра, аргументы,
+    версия данных игры): любое изменение данных игры делает старые записи
+    недостижимыми. build — функция без аргументов, возвращающая корутину,
+    которая строит (текст, клавиатуру).
+    """
+    game_id = game[0] if game else None
+    key = (screen, role, game_id, args, db.sync.data_version(game_id))
+    rendered = render_cache.get(key)
+    if rendered is None:
+        rendered = await build()
+        render_cache.put(key, rendered)
+    return rendered
+
+
+async def show_screen(query, text, reply_markup=None):
+    """Показать экран в сообщении с кнопкой; если он уже показан, не трогать сообщение"""
+    message = query.message
+    # Telegram обрезает пробелы по краям текста, сравниваем так же
+    if message is not None and message.text == text.strip() and message.reply_markup == reply_markup:
+        return
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
 
-def is_admin(user_id: int) -> bool:
-    """Проверить, является ли пользователь админом"""
-    return user_id == ADMIN_ID
+async def build_main_menu(role):
+    """Главное меню: (текст, клавиатура)"""
+    keyboard = [
+        [InlineKeyboardButton("👤 Мой получатель", callback_data="my_receiver")],
+        [InlineKeyboardButton("🎁 Мой вишлист", callback_data="my_wishlist")],
+        [InlineKeyboardButton("✏️ Редактировать вишлист", callback_data="edit_wishlist")],
+    ]
+    if role == 'admin':
+        keyboard += [
+            [InlineKeyboardButton("📋 Список участников", callback_data="list_users")],
+            [InlineKeyboardButton("🎲 Раздать роли", callback_data="distribute")],
+            [InlineKeyboardButton("🔗 Раздать одной цепочкой", callback_data="distribute_chain")],
+            [InlineKeyboardButton("🚫 Управление исключениями", callback_data="manage_exclusions")],
+            [InlineKeyboardButton("🗑 Удалить пользователя", callback_data="remove_user_menu")],
+            [InlineKeyboardButton("📊 Текущие распределения", callback_data="view_assignments")],
+        ]
+    else:
+        keyboard.append([InlineKeyboardButton("🚪 Выйти из игры", callback_data="leave_game")])
+    return "Выберите действие:", InlineKeyboardMarkup(keyboard)
 
 
+@timed_handler("start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик команды /start"""
+    """Обработчик команды /start (/start <токен> — вступить в игру по ссылке-приглашению)"""
     user = update.effective_user
     
-    if db.is_registered(user.id):
+    if context.args:
+        # В ссылке случайный токен, а не номер игры: перебором в чужую игру не попасть
+        game = await db.get_game_by_invite(context.args[0])
+        if game is None:
+            await update.message.reply_text("❌ Игра не найдена. Проверьте ссылку-приглашение.")
+            return
+        await db.set_active_game(user.id, game[0])
+    else:
+        game = await db.get_active_game(user.id)
+    
+    if await db.is_registered(game[0], user.id):
         await update.message.reply_text(
-            f"Привет, {user.first_name}! Ты уже зарегистрирован в игре тайного санты! 🎅\n\n"
+            f"Привет, {user.first_name}! Ты уже зарегистрирован в игре «{game[1]}»! 🎅\n\n"
             "Используй /menu для доступа к меню."
         )
     else:
-        db.add_user(user.id, user.username or '', user.first_name, user.last_name)
+        await db.add_user(game[0], user.id, user.username or '', user.first_name, user.last_name)
         await update.message.reply_text(
             f"Привет, {user.first_name}! 🎅\n\n"
-            "Ты успешно зарегистрирован в игре тайного санты!\n"
+            f"Ты успешно зарегистрирован в игре «{game[1]}»!\n"
             "Жди, пока админ раздаст роли.\n\n"
             "Используй /menu для доступа к меню."
         )
 
 
+@timed_handler("menu")
 async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать меню"""
     user = update.effective_user
+    game = await db.get_active_game(user.id)
     
-    if is_admin(user.id):
-        # Админ-меню
-        keyboard = [
-            [InlineKeyboardButton("👤 Мой получатель", callback_data="my_receiver")],
-            [InlineKeyboardButton("🎁 Мой вишлист", callback_data="my_wishlist")],
-            [InlineKeyboardButton("✏️ Редактировать вишлист", callback_data="edit_wishlist")],
-            [InlineKeyboardButton("📋 Список участников", callback_data="list_users")],
-            [InlineKeyboardButton("🎲 Раздать роли", callback_data="distribute")],
-            [InlineKeyboardButton("🚫 Управление исключениями", callback_data="manage_exclusions")],
-            [InlineKeyboardButton("🗑 Удалить пользователя", callback_data="remove_user_menu")],
-            [InlineKeyboardButton("📊 Текущие распределения", callback_data="view_assignments")],
-        ]
-    else:
-        # Обычное меню
-        keyboard = [
-            [InlineKeyboardButton("👤 Мой получатель", callback_data="my_receiver")],
-            [InlineKeyboardButton("🎁 Мой вишлист", callback_data="my_wishlist")],
-            [InlineKeyboardButton("✏️ Редактировать вишлист", callback_data="edit_wishlist")],
-            [InlineKeyboardButton("🚪 Выйти из игры", callback_data="leave_game")],
-        ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("Выберите действие:", reply_markup=reply_markup)
+    # Меню не зависит от данных игры, поэтому в ключе нет игры
+    role = role_of(user.id, game)
+    text, reply_markup = await render_screen("menu", role, None, (), lambda: build_main_menu(role))
+    await update.message.reply_text(text, reply_markup=reply_markup)
+
+
+def callback_route(data: str) -> str:
+    """Имя действия кнопки без аргументов: page_list_0_n_42 -> page_list_n"""
+    return re.sub(r'_-?\d+', '', data)
 
 
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик нажатий на кнопки"""
     query = update.callback_query
+    with HANDLER_SECONDS.time(handler=f"button:{callback_route(query.data)}"):
+        await route_button(update, context)
+
+
+async def route_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Выполнить действие нажатой кнопки"""
+    query = update.callback_query
     await query.answer()
     user = update.effective_user
-    
-    if query.data == "list_users":
-        await handle_list_users(query, user)
+    game = await db.get_active_game(user.id)
+    
+    if query.data.startswith("page_"):
+        # page_<экран>_<аргумент>_<n|p>_<курсор>
+        _, screen, arg, direction, cursor_id = query.data.split("_")
+        after_id = int(cursor_id) if direction == "n" else None
+        before_id = int(cursor_id) if direction == "p" else None
+        if screen == "list":
+            await handle_list_users(query, user, game, after_id, before_id)
+        elif screen == "exclude1":
+            await handle_manage_exclusions(query, user, game, after_id, before_id)
+        elif screen == "exclude2":
+            await handle_add_exclusion_menu(query, user, game, int(arg), after_id, before_id)
+        elif screen == "remove":
+            await handle_remove_user_menu(query, user, game, after_id, before_id)
+        elif screen == "exclusions":
+            await handle_remove_exclusion_menu(query, user, game, after_id, before_id)
+    elif query.data == "list_users":
+        await handle_list_users(query, user, game)
     elif query.data == "distribute":
-        await handle_distribute(query, user, context)
+        await handle_distribute(query, user, game)
+    elif query.data == "distribute_chain":
+        await handle_distribute(query, user, game, single_chain=True)
+    elif query.data.startswith("confirm_distribute_"):
+        run_id = int(query.data.split("_")[-1])
+        await handle_confirm_distribute(query, user, game, run_id, context)
     elif query.data == "manage_exclusions":
-        await handle_manage_exclusions(query, user)
+        await handle_manage_exclusions(query, user, game)
     elif query.data == "view_assignments":
-        await handle_view_assignments(query, user)
+        await handle_view_assignments(query, user, game)
     elif query.data == "my_receiver":
-        await handle_my_receiver(query, user)
+        await handle_my_receiver(query, user, game)
     elif query.data.startswith("add_exclusion_"):
         user_id = int(query.data.split("_")[-1])
-        await handle_add_exclusion_menu(query, user, user_id)
+        await handle_add_exclusion_menu(query, user, game, user_id)
     elif query.data.startswith("exclude_"):
         user1_id, user2_id = map(int, query.data.split("_")[1:])
-        await handle_add_exclusion(query, user, user1_id, user2_id)
+        await handle_add_exclusion(query, user, game, user1_id, user2_id)
     elif query.data == "remove_exclusion_menu":
-        await handle_remove_exclusion_menu(query, user)
+        await handle_remove_exclusion_menu(query, user, game)
     elif query.data.startswith("remove_exclusion_"):
         exclusion_id = int(query.data.split("_")[-1])
-        await handle_remove_exclusion(query, user, exclusion_id)
+        await handle_remove_exclusion(query, user, game, exclusion_id)
     elif query.data == "back_to_menu":
-        await handle_back_to_menu(query, user)
+        await handle_back_to_menu(query, user, game)
     elif query.data == "remove_user_menu":
-        await handle_remove_user_menu(query, user)
+        await handle_remove_user_menu(query, user, game)
     elif query.data.startswith("remove_user_"):
         user_id = int(query.data.split("_")[-1])
-        await handle_remove_user(query, user, user_id)
+        await handle_remove_user(query, user, game, user_id)
     elif query.data == "leave_game":
-        await handle_leave_game(query, user)
+        await handle_leave_game(query, user, game)
     elif query.data == "confirm_leave":
-        await handle_confirm_leave(query, user)
+        await handle_confirm_leave(query, user, game)
     elif query.data == "my_wishlist":
-        await handle_my_wishlist(query, user)
+        await handle_my_wishlist(query, user, game)
     # edit_wishlist обрабатывается через ConversationHandler
 
 
-async def handle_list_users(query, user):
-    """Показать список участников"""
-    if not is_admin(user.id):
+async def handle_list_users(query, user, game, after_id=None, before_id=None):
+    """Показать список участников (постранично)"""
+    if not is_admin(user.id, game):
         await query.edit_message_text("❌ У вас нет прав доступа.")
         return
     
-    users = db.get_all_users()
+    text, reply_markup = await render_screen(
+        "list_users", "admin", game, (after_id, before_id),
+        lambda: build_users_list(game, after_id, before_id)
+    )
+    await show_screen(query, text, reply_markup=reply_markup)
+
+
+async def build_users_list(game, after_id, before_id):
+    """Экран списка участников: (текст, клавиатура)"""
+    users, has_prev, has_next = await db.get_users_page(game[0], after_id, before_id)
     if not users:
-        await query.edit_message_text("📋 Пока нет зарегистрированных участников.")
-        return
+        return "📋 Пока нет зарегистрированных участников.", None
     
     text = "📋 Список участников:\n\n"
-    for u in users:
-        # Структура: user_id, username, first_name, last_name, registered_at, wishlist
-        user_id, username, first_name, last_name, _, wishlist = u
+    for user_id, username, first_name, last_name in users:
         name = f"{first_name} {last_name or ''}".strip()
         text += f"• {name} (@{username or 'без username'})\n"
     
-    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(text, reply_markup=reply_markup)
+    keyboard = page_navigation("list", users, has_prev, has_next)
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")])
+    return text, InlineKeyboardMarkup(keyboard)
 
 
-async def handle_distribute(query, user, context: ContextTypes.DEFAULT_TYPE):
-    """Раздать роли"""
-    if not is_admin(user.id):
+async def handle_distribute(query, user, game, single_chain=False):
+    """Начать раздачу ролей: создать черновик и спросить подтверждение (single_chain — все дарят по одному кругу)"""
+    if not is_admin(user.id, game):
         await query.edit_message_text("❌ У вас нет прав доступа.")
         return
     
-    users = db.get_all_users()
+    users = await db.get_user_names(game[0])
     if len(users) < 2:
         await query.edit_message_text(
             "❌ Для распределения нужно минимум 2 участника!"
         )
         return
     
-    # Очищаем предыдущие распределения
-    db.clear_assignments()
+    # Подтверждение несет номер раздачи: повторное нажатие или повторная доставка
+    # кнопки Telegram-ом не раздадут роли второй раз
+    run_id = await db.create_distribution_run(game[0], single_chain)
+    mode = " одной цепочкой" if single_chain else ""
+    keyboard = [
+        [InlineKeyboardButton("✅ Раздать", callback_data=f"confirm_distribute_{run_id}")],
+        [InlineKeyboardButton("❌ Отмена", callback_data="back_to_menu")],
+    ]
+    await query.edit_message_text(
+        f"🎲 Раздать роли{mode}? Участников: {len(users)}.\n\n"
+        "Каждый получит сообщение о своем получателе. "
+        "Текущее распределение, если оно есть, будет заменено.",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+
+async def handle_confirm_distribute(query, user, game, run_id, context: ContextTypes.DEFAULT_TYPE):
+    """Подтвердить раздачу: распределить роли и поставить сообщения в очередь ровно один раз"""
+    if not is_admin(user.id, game):
+        await query.edit_message_text("❌ У вас нет прав доступа.")
+        return
     
-    # Пытаемся распределить роли
-    success, assignments = distribute_roles(users)
+    run = await db.get_distribution_run(run_id)
+    if run is None or run[1] != game[0]:
+        await query.edit_message_text("❌ Раздача не найдена.")
+        return
     
-    if not success:
-        await query.edit_message_text(
-            "❌ Не удалось распределить роли с учетом всех исключений.\n"
-            "Попробуйте изменить исключения или добавить больше участников."
+    # Раздачи одной игры выполняются по очереди; состояние раздачи проверяем
+    # под блокировкой, и второе нажатие только показывает результат первого
+    async with distribution_locks.setdefault(game[0], asyncio.Lock()):
+        run = await db.get_distribution_run(run_id)
+        if run[3] != 'draft':
+            await show_run_status(query, run)
+            return
+        single_chain = run[2]
+        
+        users = await db.get_user_names(game[0])
+        if len(users) < 2:
+            await query.edit_message_text(
+                "❌ Для распределения нужно минимум 2 участника!"
+            )
+            return
+        
+        # Пытаемся распределить роли (в отдельном потоке, чтобы не блокировать бота)
+        exclusion_index = await db.get_exclusion_index(game[0])
+        success, assignments = await asyncio.to_thread(
+            distribute_roles, game[0], users, exclusion_index, single_chain
         )
+        
+        if not success:
+            # Черновик остается: после правки исключений можно нажать «Раздать» еще раз
+            await query.edit_message_text(
+                "❌ Распределить роли невозможно: при текущих исключениях "
+                "не существует ни одного допустимого варианта.\n\n"
+                f"{describe_violation(assignments, users)}\n\n"
+                "Измените исключения или добавьте больше участников."
+            )
+            return
+        
+        # Готовим сообщения участникам: имена уже загружены, вишлисты читаем одним запросом
+        names = {u[0]: f"{u[1]} {u[2] or ''}".strip() for u in users}
+        wishlists = await db.get_wishlists(game[0])
+        messages = [
+            (giver_id, assignment_message(names[receiver_id], wishlists.get(receiver_id), "Роли распределены! 🎲"))
+            for giver_id, receiver_id in assignments
+        ]
+        
+        # Сохраняем распределения и ставим сообщения в очередь одной транзакцией
+        # вместе со сменой состояния раздачи: даже если бот упадет, рассылка
+        # продолжится после перезапуска, а повтор не создаст вторую
+        committed = await db.commit_distribution_run(run_id, assignments, messages)
+    
+    if not committed:
+        await show_run_status(query, await db.get_distribution_run(run_id))
         return
+    outbox_worker.wake()
+    
+    note = ""
+    if single_chain:
+        chains = len(find_cycles(dict(assignments)))
+        if chains == 1:
+            note = "🔗 Все дарят по одной цепочке.\n\n"
+        else:
+            note = f"⚠️ Одной цепочкой раздать не получилось из-за исключений, цепочек: {chains}.\n\n"
+    
+    await query.edit_message_text(
+        f"✅ Роли успешно распределены!\n\n{note}"
+        f"📤 Сообщения поставлены в очередь: {len(messages)}"
+    )
+    context.application.create_task(track_delivery(query, run_id, len(messages), note))
+
+
+async def show_run_status(query, run):
+    """Показать состояние уже подтвержденной раздачи, ничего не меняя"""
+    run_id, _, _, status, participants = run
+    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]]
     
-    # Сохраняем распределения
-    for giver_id, receiver_id in assignments:
-        db.save_assignment(giver_id, receiver_id)
-    
-    # Отправляем сообщения участникам
-    sent_count = 0
-    failed_count = 0
-    
-    for giver_id, receiver_id in assignments:
-        receiver = db.get_user(receiver_id)
-        if receiver:
-            # Структура: user_id, username, first_name, last_name, registered_at, wishlist
-            _, _, receiver_name, receiver_last, _, wishlist = receiver
-            receiver_full_name = f"{receiver_name} {receiver_last or ''}".strip()
-            
-            text = f"🎅 Тайный Санта!\n\n"
-            text += f"Роли распределены! 🎲\n\n"
-            text += f"Ты даришь подарок: {receiver_full_name} 🎁\n\n"
-            
-            # Добавляем вишлист, если он есть
-            if wishlist:
-                text += f"📝 Вишлист получателя:\n{wishlist}"
-            else:
-                text += "📝 Вишлист получателя не указан."
-            
+    if status == 'cancelled':
+        text = (
+            "ℹ️ Это подтверждение устарело: роли уже раздали другой раздачей.\n\n"
+            "Чтобы раздать заново, нажмите «Раздать роли» в меню."
+        )
+    else:
+        stats = await db.get_outbox_stats(f"run:{run_id}")
+        pending = stats.get('pending', 0) + stats.get('sending', 0)
+        # Бот мог перезапуститься во время рассылки и не отметить ее окончание
+        if status == 'committed' and pending == 0:
+            await db.mark_run_notified(run_id)
+        text = f"✅ Роли уже распределены (раздача №{run_id}).\n\n"
+        text += f"📤 Сообщения отправлены: {stats.get('sent', 0)} из {participants}"
+        if stats.get('failed', 0):
+            text += f"\n❌ Не удалось отправить: {stats['failed']}"
+        if stats.get('unknown', 0):
+            text += f"\n❓ Неизвестно, дошли ли (бот перезапускался): {stats['unknown']}"
+        if stats.get('cancelled', 0):
+            text += f"\n🚫 Отменено (роли раздали заново): {stats['cancelled']}"
+        if pending:
+            text += f"\n⏳ Еще в очереди: {pending}"
+    
+    await show_screen(query, text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+async def track_delivery(query, run_id, total, note=""):
+    """Показывать админу ход рассылки, пока очередь раздачи не опустеет"""
+    batch = f"run:{run_id}"
+    last_text = None
+    while True:
+        await asyncio.sleep(PROGRESS_INTERVAL)
+        stats = await db.get_outbox_stats(batch)
+        sent_count = stats.get('sent', 0)
+        failed_count = stats.get('failed', 0)
+        cancelled_count = stats.get('cancelled', 0)
+        unknown_count = stats.get('unknown', 0)
+        
+        # Отмененные и прерванные сообщения тоже больше не ждем
+        if stats.get('pending', 0) + stats.get('sending', 0) == 0:
+            await db.mark_run_notified(run_id)
+            break
+        
+        done = sent_count + failed_count + cancelled_count + unknown_count
+        text = f"⏳ Рассылка: {done} из {total} (ошибок: {failed_count})"
+        if text != last_text:
+            last_text = text
             try:
-                await context.bot.send_message(
-                    chat_id=giver_id,
-                    text=text
-                )
-                sent_count += 1
+                await query.edit_message_text(text)
             except Exception as e:
-                logger.error(f"Не удалось отправить сообщение пользователю {giver_id}: {e}")
-                failed_count += 1
+                logger.warning(f"Не удалось обновить прогресс рассылки: {e}")
     
     keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    result_text = f"✅ Роли успешно распределены!\n\n"
-    result_text += f"📤 Сообщения отправлены: {sent_count} из {len(assignments)} участникам"
+    result_text = f"✅ Роли успешно распределены!\n\n{note}"
+    result_text += f"📤 Сообщения отправлены: {sent_count} из {total} участникам"
     if failed_count > 0:
         result_text += f"\n❌ Не удалось отправить: {failed_count}"
+    if unknown_count > 0:
+        result_text += f"\n❓ Неизвестно, дошли ли (бот перезапускался): {unknown_count}"
+    if cancelled_count > 0:
+        result_text += f"\n🚫 Отменено (роли раздали заново): {cancelled_count}"
     
     await query.edit_message_text(result_text, reply_markup=reply_markup)
 
 
-def distribute_roles(users, max_attempts=1000):
+def assignment_message(receiver_full_name, wishlist, reason):
+    """Сообщение дарителю о его получателе"""
+    text = f"🎅 Тайный Санта!\n\n"
+    text += f"{reason}\n\n"
+    text += f"Ты даришь подарок: {receiver_full_name} 🎁\n\n"
+    
+    # Добавляем вишлист, если он есть
+    if wishlist:
+        text += f"📝 Вишлист получателя:\n{wishlist}"
+    else:
+        text += "📝 Вишлист получателя не указан."
+    return text
+
+
+def remove_participant(game_id, user_id, exclusion_index, admin_id=None):
     """
-    Распределить роли с учетом исключений.
-    Использует алгоритм с перестановками.
+    Удалить участника из игры и, если роли уже розданы, вырезать его из
+    цепочки дарителей: его даритель получает его получателя (или происходит
+    обмен с другой парой). Уведомления получают только затронутые дарители.
+    Выполняется в потоке базы одной транзакцией.
+    Возвращает None, если ролей еще нет; {} — если починить распределение
+    нельзя (тогда admin_id, если задан, получает предупреждение);
+    иначе изменённые пары.
     """
-    user_ids = [u[0] for u in users]
-    
-    for attempt in range(max_attempts):
-        # Перемешиваем список получателей
-        receivers = user_ids.copy()
-        random.shuffle(receivers)
-        
-        # Создаем пары (даритель -> получатель)
-        assignments = list(zip(user_ids, receivers))
+    database = db.sync
+    with database.transaction():
+        giver_id = database.get_giver_by_receiver(game_id, user_id)
+        receiver_id = database.get_assignment(game_id, user_id)
+        database.remove_user(game_id, user_id)
+        if giver_id is None or receiver_id is None:
+            return None
         
-        # Проверяем, что никто не дарит сам себе
-        if any(giver == receiver for giver, receiver in assignments):
-            continue
+        # Все пары нужны, только если замкнуть цепочку напрямую нельзя
+        assignment = None
+        if not can_give(exclusion_index, giver_id, receiver_id):
+            assignment = {g: r for _, g, r, _ in database.get_all_assignments(game_id)}
+        changes = splice_out(giver_id, receiver_id, exclusion_index, assignment)
         
-        # Проверяем исключения
-        valid = True
-        for giver_id, receiver_id in assignments:
-            if db.has_exclusion(giver_id, receiver_id):
-                valid = False
-                break
+        if changes is None:
+            if admin_id is not None:
+                database.enqueue_messages([(admin_id, (
+                    "⚠️ Участник вышел из игры, а распределение нельзя поправить "
+                    "без нарушения исключений. Раздайте роли заново."
+                ))])
+            return {}
         
-        if valid:
-            return True, assignments
+        reason = "🔄 Твой получатель изменился: один из участников вышел из игры."
+        wishlists = database.get_wishlists(game_id, changes.values())
+        messages = []
+        for g, r in changes.items():
+            # Структура: user_id, username, first_name, last_name, registered_at
+            _, _, first_name, last_name, _ = database.get_user(game_id, r)
+            name = f"{first_name} {last_name or ''}".strip()
+            messages.append((g, assignment_message(name, wishlists.get(r), reason)))
+        database.update_assignments(game_id, changes.items(), messages)
+        return changes
+
+
+def distribute_roles(game_id, users, exclusion_index, single_chain=False):
+    """
+    Распределить роли с учетом исключений.
+    single_chain — собрать всех в одну цепочку (или в наименьшее их число).
+    Возвращает (True, список пар) или (False, (дарители, получатели)) —
+    участников, из-за которых допустимого распределения не существует.
+    """
+    user_ids = [u[0] for u in users]
+    forbidden = build_forbidden(user_ids, exclusion_index)
+    
+    # Сначала быстрая проверка: невозможное распределение не ищем вовсе
+    matching, violation = check_feasibility(user_ids, forbidden, feasibility_hints.get(game_id))
+    if violation:
+        return False, violation
+    feasibility_hints[game_id] = matching
     
-    return False, []
+    if single_chain:
+        assignment = find_chain(user_ids, forbidden)
+    else:
+        assignment = find_assignment(user_ids, forbidden)
+    return True, [(giver_id, assignment[giver_id]) for giver_id in user_ids]
+
+
+def check_new_exclusion(game_id, users, exclusion_index, user1_id, user2_id):
+    """
+    Проверить, останется ли распределение возможным после нового исключения.
+    Возвращает None или (дарители, получатели), как distribute_roles.
+    """
+    user_ids = [u[0] for u in users]
+    forbidden = build_forbidden(user_ids, exclusion_index)
+    if user1_id in forbidden and user2_id in forbidden:
+        forbidden[user1_id].add(user2_id)
+        forbidden[user2_id].add(user1_id)
+    
+    matching, violation = check_feasibility(user_ids, forbidden, feasibility_hints.get(game_id))
+    if violation is None:
+        feasibility_hints[game_id] = matching
+    return violation
 
 
-async def handle_manage_exclusions(query, user):
+def describe_violation(violation, users):
+    """Текст о том, кому не хватает получателей"""
+    names = {u[0]: f"{u[1]} {u[2] or ''}".strip() for u in users}
+    
+    def name_list(user_ids):
+        shown = ", ".join(names.get(user_id, str(user_id)) for user_id in user_ids[:VIOLATION_NAMES_LIMIT])
+        if len(user_ids) > VIOLATION_NAMES_LIMIT:
+            shown += f" и еще {len(user_ids) - VIOLATION_NAMES_LIMIT}"
+        return shown
+    
+    givers, receivers = violation
+    if not receivers:
+        return f"Из-за исключений некому дарить: {name_list(givers)}."
+    return (
+        f"Участники ({len(givers)}): {name_list(givers)}\n"
+        f"могут дарить только этим участникам ({len(receivers)}): {name_list(receivers)}.\n"
+        "Получателей на всех не хватает."
+    )
+
+
+async def handle_manage_exclusions(query, user, game, after_id=None, before_id=None):
     """Управление исключениями"""
-    if not is_admin(user.id):
+    if not is_admin(user.id, game):
         await query.edit_message_text("❌ У вас нет прав доступа.")
         return
     
-    users = db.get_all_users()
-    exclusions = db.get_exclusions()
+    text, reply_markup = await render_screen(
+        "manage_exclusions", "admin", game, (after_id, before_id),
+        lambda: build_manage_exclusions(game, after_id, before_id)
+    )
+    await show_screen(query, text, reply_markup=reply_markup)
+
+
+async def build_manage_exclusions(game, after_id, before_id):
+    """Экран управления исключениями: (текст, клавиатура)"""
+    users, has_prev, has_next = await db.get_users_page(game[0], after_id, before_id)
+    # Сам список исключений — на отдельном постраничном экране: здесь страница стоит O(размера страницы)
+    has_exclusions = await db.has_exclusions(game[0])
     
     text = "🚫 Управление исключениями\n\n"
-    text += "Текущие исключения:\n"
-    
-    if exclusions:
-        for exc in exclusions:
-            exc_id, user1_id, user2_id = exc
-            user1 = db.get_user(user1_id)
-            user2 = db.get_user(user2_id)
-            if user1 and user2:
-                name1 = f"{user1[2]} {user1[3] or ''}".strip()
-                name2 = f"{user2[2]} {user2[3] or ''}".strip()
-                text += f"• {name1} ↔ {name2}\n"
-    else:
-        text += "Нет исключений\n"
-    
-    text += "\nДобавить исключение:\n"
+    if not has_exclusions:
+        text += "Исключений пока нет.\n\n"
+    text += "Добавить исключение:\n"
     text += "Выберите первого участника:"
     
     keyboard = []
-    for u in users:
-        # Структура: user_id, username, first_name, last_name, registered_at, wishlist
-        user_id, username, first_name, last_name, _, wishlist = u
+    for user_id, username, first_name, last_name in users:
         name = f"{first_name} {last_name or ''}".strip()
         keyboard.append([InlineKeyboardButton(
             f"➕ {name}",
             callback_data=f"add_exclusion_{user_id}"
         )])
+    keyboard += page_navigation("exclude1", users, has_prev, has_next)
     
-    # Добавляем кнопки для удаления исключений
-    if exclusions:
-        keyboard.append([InlineKeyboardButton("🗑 Удалить исключение", callback_data="remove_exclusion_menu")])
+    # Просмотр и удаление исключений
+    if has_exclusions:
+        keyboard.append([InlineKeyboardButton("📜 Исключения: просмотр и удаление", callback_data="remove_exclusion_menu")])
     
     keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(text, reply_markup=reply_markup)
+    return text, InlineKeyboardMarkup(keyboard)
 
 
-async def handle_add_exclusion_menu(query, user, user1_id):
+async def handle_add_exclusion_menu(query, user, game, user1_id, after_id=None, before_id=None):
     """Меню выбора второго участника для исключения"""
-    if not is_admin(user.id):
+    if not is_admin(user.id, game):
         await query.edit_message_text("❌ У вас нет прав доступа.")
         return
     
-    users = db.get_all_users()
-    user1 = db.get_user(user1_id)
+    text, reply_markup = await render_screen(
+        "add_exclusion", "admin", game, (user1_id, after_id, before_id),
+        lambda: build_add_exclusion_menu(game, user1_id, after_id, before_id)
+    )
+    await show_screen(query, text, reply_markup=reply_markup)
+
+
+async def build_add_exclusion_menu(game, user1_id, after_id, before_id):
+    """Экран выбора второго участника для исключения: (текст, клавиатура)"""
+    users, has_prev, has_next = await db.get_users_page(game[0], after_id, before_id)
+    user1 = await db.get_user(game[0], user1_id)
+    exclusion_index = await db.get_exclusion_index(game[0])
+    excluded = exclusion_index.get(user1_id, set())
     
     text = f"Выберите второго участника для исключения с {user1[2]}:\n"
     
     keyboard = []
-    for u in users:
-        user2_id, username, first_name, last_name, wishlist, _ = u
+    for user2_id, username, first_name, last_name in users:
         if user2_id == user1_id:
             continue
-        if db.has_exclusion(user1_id, user2_id):
+        if user2_id in excluded:
             continue
         name = f"{first_name} {last_name or ''}".strip()
         keyboard.append([InlineKeyboardButton(
             f"🚫 {name}",
             callback_data=f"exclude_{user1_id}_{user2_id}"
         )])
+    keyboard += page_navigation("exclude2", users, has_prev, has_next, arg=user1_id)
     
     keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="manage_exclusions")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(text, reply_markup=reply_markup)
+    return text, InlineKeyboardMarkup(keyboard)
 
 
-async def handle_add_exclusion(query, user, user1_id, user2_id):
+async def handle_add_exclusion(query, user, game, user1_id, user2_id):
     """Добавить исключение"""
-    if not is_admin(user.id):
+    if not is_admin(user.id, game):
         await query.edit_message_text("❌ У вас нет прав доступа.")
         return
     
-    db.add_exclusion(user1_id, user2_id)
-    user1 = db.get_user(user1_id)
-    user2 = db.get_user(user2_id)
+    users = await db.get_user_names(game[0])
+    exclusion_index = await db.get_exclusion_index(game[0])
+    violation = await asyncio.to_thread(
+        check_new_exclusion, game[0], users, exclusion_index, user1_id, user2_id
+    )
+    if violation:
+        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="manage_exclusions")]]
+        await query.edit_message_text(
+            "❌ Исключение не добавлено: с ним распределить роли будет невозможно.\n\n"
+            f"{describe_violation(violation, users)}\n\n"
+            "Если еще не все зарегистрировались, добавьте исключение позже.",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        return
+    
+    await db.add_exclusion(game[0], user1_id, user2_id)
+    user1 = await db.get_user(game[0], user1_id)
+    user2 = await db.get_user(game[0], user2_id)
     name1 = f"{user1[2]} {user1[3] or ''}".strip()
     name2 = f"{user2[2]} {user2[3] or ''}".strip()
     
@@ -333,89 +727,92 @@ async def handle_add_exclusion(query, user, user1_id, user2_id):
         f"✅ Исключение добавлено: {name1} ↔ {name2}"
     )
     # Возвращаемся к управлению исключениями
-    await handle_manage_exclusions(query, user)
+    await handle_manage_exclusions(query, user, game)
 
 
-async def handle_remove_exclusion_menu(query, user):
-    """Меню удаления исключений"""
-    if not is_admin(user.id):
+async def handle_remove_exclusion_menu(query, user, game, after_id=None, before_id=None):
+    """Меню удаления исключений (постранично)"""
+    if not is_admin(user.id, game):
         await query.edit_message_text("❌ У вас нет прав доступа.")
         return
     
-    exclusions = db.get_exclusions()
+    text, reply_markup = await render_screen(
+        "remove_exclusion", "admin", game, (after_id, before_id),
+        lambda: build_remove_exclusion_menu(game, after_id, before_id)
+    )
+    await show_screen(query, text, reply_markup=reply_markup)
+
+
+async def build_remove_exclusion_menu(game, after_id, before_id):
+    """Экран удаления исключений: (текст, клавиатура)"""
+    exclusions, has_prev, has_next = await db.get_exclusions_page(game[0], after_id, before_id)
     
-    if not exclusions:
-        await query.edit_message_text("Нет исключений для удаления.")
-        return
+    if not exclusions and after_id is None and before_id is None:
+        return "Нет исключений для удаления.", None
     
-    text = "🗑 Выберите исключение для удаления:\n\n"
+    text = "🗑 Исключения. Нажмите, чтобы удалить:\n\n"
     
     keyboard = []
-    for exc in exclusions:
-        exc_id, user1_id, user2_id = exc
-        user1 = db.get_user(user1_id)
-        user2 = db.get_user(user2_id)
-        if user1 and user2:
-            name1 = f"{user1[2]} {user1[3] or ''}".strip()
-            name2 = f"{user2[2]} {user2[3] or ''}".strip()
-            keyboard.append([InlineKeyboardButton(
-                f"🗑 {name1} ↔ {name2}",
-                callback_data=f"remove_exclusion_{exc_id}"
-            )])
+    for exc_id, _, name1, _, name2 in exclusions:
+        keyboard.append([InlineKeyboardButton(
+            f"🗑 {name1} ↔ {name2}",
+            callback_data=f"remove_exclusion_{exc_id}"
+        )])
+    keyboard += page_navigation("exclusions", exclusions, has_prev, has_next)
     
     keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="manage_exclusions")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(text, reply_markup=reply_markup)
+    return text, InlineKeyboardMarkup(keyboard)
 
 
-async def handle_remove_exclusion(query, user, exclusion_id):
+async def handle_remove_exclusion(query, user, game, exclusion_id):
     """Удалить исключение"""
-    if not is_admin(user.id):
+    if not is_admin(user.id, game):
         await query.edit_message_text("❌ У вас нет прав доступа.")
         return
     
-    exclusions = db.get_exclusions()
-    exclusion = next((e for e in exclusions if e[0] == exclusion_id), None)
+    exclusion = await db.get_exclusion(game[0], exclusion_id)
     
     if exclusion:
         _, user1_id, user2_id = exclusion
-        db.remove_exclusion(user1_id, user2_id)
+        await db.remove_exclusion(game[0], user1_id, user2_id)
         await query.edit_message_text("✅ Исключение удалено.")
         # Возвращаемся к управлению исключениями
-        await handle_manage_exclusions(query, user)
+        await handle_manage_exclusions(query, user, game)
     else:
         await query.edit_message_text("❌ Исключение не найдено.")
 
 
-async def handle_view_assignments(query, user):
+async def handle_view_assignments(query, user, game):
     """Показать текущие распределения"""
-    if not is_admin(user.id):
+    if not is_admin(user.id, game):
         await query.edit_message_text("❌ У вас нет прав доступа.")
         return
     
-    assignments = db.get_all_assignments()
+    text, reply_markup = await render_screen(
+        "view_assignments", "admin", game, (),
+        lambda: build_assignments_view(game)
+    )
+    await edit_long_text(query, text, reply_markup=reply_markup)
+
+
+async def build_assignments_view(game):
+    """Экран текущих распределений: (текст, клавиатура)"""
+    assignments = await db.get_assignments_with_names(game[0])
     
     if not assignments:
         text = "📊 Распределения еще не были созданы."
     else:
         text = "📊 Текущие распределения:\n\n"
-        for ass in assignments:
-            _, giver_id, receiver_id, _ = ass
-            giver = db.get_user(giver_id)
-            receiver = db.get_user(receiver_id)
-            if giver and receiver:
-                giver_name = f"{giver[2]} {giver[3] or ''}".strip()
-                receiver_name = f"{receiver[2]} {receiver[3] or ''}".strip()
-                text += f"🎁 {giver_name} → {receiver_name}\n"
+        for _, giver_name, _, receiver_name in assignments:
+            text += f"🎁 {giver_name} → {receiver_name}\n"
     
     keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(text, reply_markup=reply_markup)
+    return text, InlineKeyboardMarkup(keyboard)
 
 
-async def handle_my_receiver(query, user):
+async def handle_my_receiver(query, user, game):
     """Показать, кому пользователь должен дарить"""
-    receiver_id = db.get_assignment(user.id)
+    receiver_id = await db.get_assignment(game[0], user.id)
     
     if receiver_id is None:
         await query.edit_message_text(
@@ -423,10 +820,11 @@ async def handle_my_receiver(query, user):
         )
         return
     
-    receiver = db.get_user(receiver_id)
+    receiver = await db.get_user(game[0], receiver_id)
     if receiver:
-        # Структура: user_id, username, first_name, last_name, registered_at, wishlist
-        _, _, receiver_name, receiver_last, _, wishlist = receiver
+        # Структура: user_id, username, first_name, last_name, registered_at
+        _, _, receiver_name, receiver_last, _ = receiver
+        wishlist = await db.get_wishlist(game[0], receiver_id)
         receiver_full_name = f"{receiver_name} {receiver_last or ''}".strip()
         
         text = f"🎅 Тайный Санта!\n\n"
@@ -445,104 +843,98 @@ async def handle_my_receiver(query, user):
         await query.edit_message_text("❌ Получатель не найден.")
 
 
-async def handle_back_to_menu(query, user):
+async def handle_back_to_menu(query, user, game):
     """Вернуться в меню"""
-    if is_admin(user.id):
-        keyboard = [
-            [InlineKeyboardButton("👤 Мой получатель", callback_data="my_receiver")],
-            [InlineKeyboardButton("🎁 Мой вишлист", callback_data="my_wishlist")],
-            [InlineKeyboardButton("✏️ Редактировать вишлист", callback_data="edit_wishlist")],
-            [InlineKeyboardButton("📋 Список участников", callback_data="list_users")],
-            [InlineKeyboardButton("🎲 Раздать роли", callback_data="distribute")],
-            [InlineKeyboardButton("🚫 Управление исключениями", callback_data="manage_exclusions")],
-            [InlineKeyboardButton("🗑 Удалить пользователя", callback_data="remove_user_menu")],
-            [InlineKeyboardButton("📊 Текущие распределения", callback_data="view_assignments")],
-        ]
-    else:
-        keyboard = [
-            [InlineKeyboardButton("👤 Мой получатель", callback_data="my_receiver")],
-            [InlineKeyboardButton("🎁 Мой вишлист", callback_data="my_wishlist")],
-            [InlineKeyboardButton("✏️ Редактировать вишлист", callback_data="edit_wishlist")],
-            [InlineKeyboardButton("🚪 Выйти из игры", callback_data="leave_game")],
-        ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text("Выберите действие:", reply_markup=reply_markup)
+    role = role_of(user.id, game)
+    text, reply_markup = await render_screen("menu", role, None, (), lambda: build_main_menu(role))
+    await show_screen(query, text, reply_markup=reply_markup)
 
 
-async def handle_remove_user_menu(query, user):
+async def handle_remove_user_menu(query, user, game, after_id=None, before_id=None):
     """Меню выбора пользователя для удаления"""
-    if not is_admin(user.id):
+    if not is_admin(user.id, game):
         await query.edit_message_text("❌ У вас нет прав доступа.")
         return
     
-    users = db.get_all_users()
+    text, reply_markup = await render_screen(
+        "remove_user", "admin", game, (after_id, before_id),
+        lambda: build_remove_user_menu(game, after_id, before_id)
+    )
+    await show_screen(query, text, reply_markup=reply_markup)
+
+
+async def build_remove_user_menu(game, after_id, before_id):
+    """Экран выбора пользователя для удаления: (текст, клавиатура)"""
+    users, has_prev, has_next = await db.get_users_page(game[0], after_id, before_id)
     
     if not users:
-        await query.edit_message_text("Нет пользователей для удаления.")
-        return
+        return "Нет пользователей для удаления.", None
     
     text = "🗑 Выберите пользователя для удаления:\n\n"
     text += "⚠️ Внимание: будут удалены все связанные данные (исключения, распределения)\n\n"
     
     keyboard = []
-    for u in users:
-        # Структура: user_id, username, first_name, last_name, registered_at, wishlist
-        user_id, username, first_name, last_name, _, wishlist = u
+    for user_id, username, first_name, last_name in users:
         name = f"{first_name} {last_name or ''}".strip()
         # Не показываем админа в списке для удаления
-        if user_id == ADMIN_ID:
+        if user_id == game[2]:
             continue
         keyboard.append([InlineKeyboardButton(
             f"🗑 {name}",
             callback_data=f"remove_user_{user_id}"
         )])
     
-    if not keyboard:
-        await query.edit_message_text("Нет пользователей для удаления (кроме админа).")
-        return
+    if not keyboard and not (has_prev or has_next):
+        return "Нет пользователей для удаления (кроме админа).", None
     
+    keyboard += page_navigation("remove", users, has_prev, has_next)
     keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(text, reply_markup=reply_markup)
+    return text, InlineKeyboardMarkup(keyboard)
 
 
-async def handle_remove_user(query, user, user_id_to_remove):
+async def handle_remove_user(query, user, game, user_id_to_remove):
     """Удалить пользователя"""
-    if not is_admin(user.id):
+    if not is_admin(user.id, game):
         await query.edit_message_text("❌ У вас нет прав доступа.")
         return
     
     # Нельзя удалить админа
-    if user_id_to_remove == ADMIN_ID:
+    if user_id_to_remove == game[2]:
         await query.edit_message_text("❌ Нельзя удалить администратора.")
         return
     
-    user_to_remove = db.get_user(user_id_to_remove)
+    user_to_remove = await db.get_user(game[0], user_id_to_remove)
     if not user_to_remove:
         await query.edit_message_text("❌ Пользователь не найден.")
         return
     
-    # Структура: user_id, username, first_name, last_name, registered_at, wishlist
-    _, _, first_name, last_name, _, _ = user_to_remove
+    # Структура: user_id, username, first_name, last_name, registered_at
+    _, _, first_name, last_name, _ = user_to_remove
     name = f"{first_name} {last_name or ''}".strip()
     
-    # Удаляем пользователя
-    db.remove_user(user_id_to_remove)
+    # Удаляем пользователя и чиним распределение, если роли уже розданы
+    exclusion_index = await db.get_exclusion_index(game[0])
+    changes = await db.run(remove_participant, game[0], user_id_to_remove, exclusion_index)
     
-    await query.edit_message_text(f"✅ Пользователь {name} успешно удален из игры.")
+    text = f"✅ Пользователь {name} успешно удален из игры."
+    if changes:
+        outbox_worker.wake()
+        text += f"\n\n🔄 Распределение поправлено, уведомлено дарителей: {len(changes)}."
+    elif changes is not None:
+        text += "\n\n⚠️ Распределение нельзя поправить без нарушения исключений. Раздайте роли заново."
+    await query.edit_message_text(text)
     
     # Возвращаемся в меню
-    await handle_back_to_menu(query, user)
+    await handle_back_to_menu(query, user, game)
 
 
-async def handle_leave_game(query, user):
+async def handle_leave_game(query, user, game):
     """Выход пользователя из игры"""
-    if is_admin(user.id):
+    if is_admin(user.id, game):
         await query.edit_message_text("❌ Администратор не может выйти из игры.")
         return
     
-    if not db.is_registered(user.id):
+    if not await db.is_registered(game[0], user.id):
         await query.edit_message_text("❌ Вы не зарегистрированы в игре.")
         return
     
@@ -559,18 +951,21 @@ async def handle_leave_game(query, user):
     )
 
 
-async def handle_confirm_leave(query, user):
+async def handle_confirm_leave(query, user, game):
     """Подтверждение выхода из игры"""
-    if is_admin(user.id):
+    if is_admin(user.id, game):
         await query.edit_message_text("❌ Администратор не может выйти из игры.")
         return
     
-    if not db.is_registered(user.id):
+    if not await db.is_registered(game[0], user.id):
         await query.edit_message_text("❌ Вы не зарегистрированы в игре.")
         return
     
-    # Удаляем пользователя
-    db.remove_user(user.id)
+    # Удаляем пользователя и чиним распределение, если роли уже розданы
+    exclusion_index = await db.get_exclusion_index(game[0])
+    changes = await db.run(remove_participant, game[0], user.id, exclusion_index, game[2])
+    if changes is not None:
+        outbox_worker.wake()
     
     await query.edit_message_text(
         "✅ Вы успешно вышли из игры.\n\n"
@@ -578,13 +973,14 @@ async def handle_confirm_leave(query, user):
     )
 
 
-async def handle_my_wishlist(query, user):
+async def handle_my_wishlist(query, user, game):
     """Показать вишлист пользователя"""
-    wishlist = db.get_wishlist(user.id)
+    history = await db.get_wishlist_history(game[0], user.id)
     
     text = "🎁 Мой вишлист:\n\n"
-    if wishlist:
-        text += wishlist
+    if history:
+        revision, wishlist, updated_at = history[0]
+        text += f"{wishlist}\n\n✏️ Версия {revision}, изменен {updated_at} (UTC)"
     else:
         text += "Вишлист еще не заполнен.\n\n"
         text += "Используйте кнопку '✏️ Редактировать вишлист' для добавления."
@@ -602,14 +998,15 @@ async def handle_edit_wishlist(update: Update, context: ContextTypes.DEFAULT_TYP
     query = update.callback_query
     await query.answer()
     user = update.effective_user
+    game = await db.get_active_game(user.id)
     
-    current_wishlist = db.get_wishlist(user.id)
+    current_wishlist = await db.get_wishlist(game[0], user.id)
     
     text = "✏️ Редактирование вишлиста\n\n"
     if current_wishlist:
         text += f"Текущий вишлист:\n{current_wishlist}\n\n"
     
-    text += "Отправьте новый вишлист текстовым сообщением.\n"
+    text += f"Отправьте новый вишлист текстовым сообщением (до {WISHLIST_MAX_LENGTH} символов).\n"
     text += "Или отправьте /cancel для отмены."
     
     keyboard = [[InlineKeyboardButton("❌ Отмена", callback_data="back_to_menu")]]
@@ -620,37 +1017,25 @@ async def handle_edit_wishlist(update: Update, context: ContextTypes.DEFAULT_TYP
     return WAITING_FOR_WISHLIST
 
 
+@timed_handler("receive_wishlist")
 async def receive_wishlist(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Получить вишлист от пользователя"""
     user = update.effective_user
+    game = await db.get_active_game(user.id)
     wishlist_text = update.message.text
     
-    # Сохраняем вишлист
-    db.update_wishlist(user.id, wishlist_text)
-    
-    # Проверяем, есть ли распределение и кто дарит подарок этому пользователю
-    giver_id = db.get_giver_by_receiver(user.id)
-    
-    if giver_id:
-        # Получаем информацию о пользователе, который обновил вишлист
-        user_info = db.get_user(user.id)
-        if user_info:
-            _, _, first_name, last_name, _, _ = user_info
-            user_full_name = f"{first_name} {last_name or ''}".strip()
-            
-            # Отправляем уведомление дарителю
-            notification_text = f"🔔 Обновление вишлиста!\n\n"
-            notification_text += f"Получатель {user_full_name} обновил свой вишлист:\n\n"
-            notification_text += f"{wishlist_text}"
-            
-            try:
-                await context.bot.send_message(
-                    chat_id=giver_id,
-                    text=notification_text
-                )
-                logger.info(f"Уведомление об обновлении вишлиста отправлено дарителю {giver_id}")
-            except Exception as e:
-                logger.error(f"Не удалось отправить уведомление дарителю {giver_id}: {e}")
+    if len(wishlist_text) > WISHLIST_MAX_LENGTH:
+        await update.message.reply_text(
+            f"❌ Вишлист слишком длинный: {len(wishlist_text)} символов, "
+            f"можно не больше {WISHLIST_MAX_LENGTH}. Сократите его и отправьте еще раз "
+            "или отправьте /cancel для отмены."
+        )
+        return WAITING_FOR_WISHLIST
+    
+    # Сохраняем новую версию вишлиста. Дарителю сообщим одним сообщением,
+    # когда правки прекратятся на WISHLIST_NOTIFY_DELAY секунд
+    await db.update_wishlist(game[0], user.id, wishlist_text,
+                             notify_at=time.time() + WISHLIST_NOTIFY_DELAY)
     
     await update.message.reply_text(
         "✅ Вишлист успешно обновлен!\n\n"
@@ -661,24 +1046,138 @@ async def receive_wishlist(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
-async def cancel_wishlist(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Отменить редактирование вишлиста"""
-    await update.message.reply_text("❌ Редактирование вишлиста отменено.")
-    return ConversationHandler.END
+@timed_handler("new_game")
+async def new_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /newgame <название> — создать свою игру"""
+    user = update.effective_user
+    title = " ".join(context.args) or f"Тайный Санта {user.first_name}"
+    
+    game_id = await db.create_game(title, user.id)
+    await db.add_user(game_id, user.id, user.username or '', user.first_name, user.last_name)
+    await db.set_active_game(user.id, game_id)
+    
+    await update.message.reply_text(
+        f"🎄 Игра «{title}» создана, вы ее администратор!\n\n"
+        f"Отправьте участникам ссылку-приглашение:\n{await invite_link(context.bot, game_id)}\n\n"
+        "Используйте /menu для управления игрой."
+    )
 
 
-def main():
-    """Запуск бота"""
-    if not BOT_TOKEN:
-        logger.error("BOT_TOKEN не установлен! Создайте файл .env и добавьте BOT_TOKEN=ваш_токен")
+async def invite_link(bot, game_id):
+    """Ссылка-приглашение в игру"""
+    return f"https://t.me/{bot.username}?start={await db.get_invite_token(game_id)}"
+
+
+async def invite(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /invite — ссылка-приглашение в текущую игру (для админа)"""
+    user = update.effective_user
+    game = await db.get_active_game(user.id)
+    if not is_admin(user.id, game):
+        await update.message.reply_text("❌ У вас нет прав доступа.")
         return
     
-    if ADMIN_ID == 0:
-        logger.error("ADMIN_ID не установлен! Создайте файл .env и добавьте ADMIN_ID=ваш_telegram_id")
+    await update.message.reply_text(
+        f"Ссылка-приглашение в игру «{game[1]}»:\n{await invite_link(context.bot, game[0])}"
+    )
+
+
+@timed_handler("import_document")
+async def import_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Загрузка CSV/JSONL-файла с участниками, исключениями или распределениями (для админа)"""
+    user = update.effective_user
+    game = await db.get_active_game(user.id)
+    if not is_admin(user.id, game):
+        await update.message.reply_text("❌ Загружать файлы может только администратор игры.")
+        return
+    
+    document = update.message.document
+    if (document.file_size or 0) > IMPORT_MAX_BYTES:
+        await update.message.reply_text(
+            f"❌ Файл слишком большой: не больше {IMPORT_MAX_BYTES // (1024 * 1024)} МБ."
+        )
+        return
+    
+    # Файл скачиваем на диск и читаем потоково: в памяти он целиком не держится
+    file = await document.get_file()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'import')
+        await file.download_to_drive(path)
+        try:
+            with open(path, encoding='utf-8-sig', newline='') as stream:
+                kind, total = await db.run(
+                    import_stream, db.sync, game[0], stream, detect_format(document.file_name)
+                )
+        except (ValueError, UnicodeDecodeError) as e:
+            await update.message.reply_text(f"❌ Не удалось загрузить файл: {e}")
+            return
+    
+    titles = {'users': "участников", 'exclusions': "исключений", 'assignments': "распределений"}
+    await update.message.reply_text(f"✅ Загружено {titles[kind]}: {total} (игра «{game[1]}»)")
+
+
+async def export_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /export <users|exclusions|assignments> [csv|jsonl]: выгрузить данные игры (для админа)"""
+    user = update.effective_user
+    game = await db.get_active_game(user.id)
+    if not is_admin(user.id, game):
+        await update.message.reply_text("❌ У вас нет прав доступа.")
         return
     
-    # Создаем приложение
-    application = Application.builder().token(BOT_TOKEN).build()
+    args = context.args or []
+    kind = args[0] if args else 'users'
+    fmt = args[1] if len(args) > 1 else 'csv'
+    if kind not in KINDS or fmt not in FORMATS:
+        await update.message.reply_text(
+            "Использование: /export <users|exclusions|assignments> [csv|jsonl]"
+        )
+        return
+    
+    buffer = await db.run(export_bytes, db.sync, game[0], kind, fmt)
+    await update.message.reply_document(document=buffer, filename=f"{kind}_game{game[0]}.{fmt}")
+
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /stats: задержки обработчиков, запросов к базе и отправки (только для ADMIN_ID)"""
+    user = update.effective_user
+    # Метрики общие для всех игр, а админом своей игры может стать кто угодно (/newgame)
+    if user.id != ADMIN_ID:
+        await update.message.reply_text("❌ У вас нет прав доступа.")
+        return
+    
+    for chunk in split_text(render_summary()):
+        await update.message.reply_text(chunk)
+
+
+async def cancel_wishlist(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отменить редактирование вишлиста"""
+    await update.message.reply_text("❌ Редактирование вишлиста отменено.")
+    return ConversationHandler.END
+
+
+def build_application(token: str = BOT_TOKEN) -> Application:
+    """Создать приложение со всеми обработчиками"""
+    async def post_init(application: Application):
+        outbox_worker.start(application.bot)
+        wishlist_notifier.start()
+    
+    async def shutdown(application: Application):
+        await wishlist_notifier.stop()
+        await outbox_worker.stop()
+        db.close()
+    
+    builder = (
+        Application.builder()
+        .token(token)
+        .post_init(post_init)
+        .post_shutdown(shutdown)
+        # Диалоги и user_data переживают перезапуск: хранятся в той же базе
+        .persistence(SqlitePersistence(db, update_interval=PERSISTENCE_INTERVAL))
+    )
+    if TELEGRAM_API_URL:
+        # Свой сервер Bot API (например, fake_telegram.py для нагрузочных тестов)
+        api_url = TELEGRAM_API_URL.rstrip('/')
+        builder = builder.base_url(f"{api_url}/bot").base_file_url(f"{api_url}/file/bot")
+    application = builder.build()
     
     # ConversationHandler для редактирования вишлиста
     async def cancel_wishlist_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -699,19 +1198,61 @@ def main():
         fallbacks=[
             CommandHandler("cancel", cancel_wishlist),
         ],
+        name="wishlist",
+        persistent=True,
     )
     
     # Регистрируем обработчики
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("menu", menu))
+    application.add_handler(CommandHandler("newgame", new_game))
+    application.add_handler(CommandHandler("invite", invite))
+    application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("export", export_data))
+    application.add_handler(MessageHandler(filters.Document.ALL, import_document))
     application.add_handler(wishlist_handler)
     application.add_handler(CallbackQueryHandler(button_handler))
     
-    # Запускаем бота
-    logger.info("Бот запущен!")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    return application
+
+
+def main():
+    """Запуск бота"""
+    if not BOT_TOKEN:
+        logger.error("BOT_TOKEN не установлен! Создайте файл .env и добавьте BOT_TOKEN=ваш_токен")
+        return
+    
+    if ADMIN_ID == 0:
+        logger.error("ADMIN_ID не установлен! Создайте файл .env и добавьте ADMIN_ID=ваш_telegram_id")
+        return
+    
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        logger.error("WEBHOOK_SECRET не установлен! Без секрета вебхук примет запросы от кого угодно")
+        return
+    
+    # Админ из настроек управляет основной игрой
+    db.sync.set_game_admin(DEFAULT_GAME_ID, ADMIN_ID)
+    
+    application = build_application()
+    
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT)
+    
+    if WEBHOOK_URL:
+        # Telegram сам присылает обновления на наш HTTPS-адрес (можно ставить за reverse proxy)
+        logger.info(f"Бот запущен в режиме вебхука на {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+    else:
+        logger.info("Бот запущен!")
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == '__main__':
     main()
-
@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from metrics import SEND_MESSAGES, SEND_RETRIES
+
+logger = logging.getLogger(__name__)
+
+
+# Ограничения Telegram: ~30 сообщений в секунду всего и ~1 в секунду в один чат
+GLOBAL_RATE = 30
+PER_CHAT_INTERVAL = 1.0
+
+# Сколько сообщений отправляем одновременно
+CONCURRENCY = 10
+
+# Сколько раз повторяем отправку после флуд-контроля или сетевой ошибки
+MAX_RETRIES = 5
+
+# Как часто (в секундах) вызываем обработчик прогресса рассылки
+PROGRESS_INTERVAL = 3.0
+
+
+class TokenBucket:
+    """Ведро токенов: не больше rate операций в секунду с запасом capacity"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        # Момент, раньше которого токены не выдаём (после флуд-контроля)
+        self._not_before = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Дождаться свободного токена"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._not_before:
+                    await asyncio.sleep(self._not_before - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """
+        Остановить выдачу токенов на seconds секунд (после флуд-контроля).
+        Одновременные паузы не складываются: ждём до самого позднего срока.
+        """
+        self._not_before = max(self._not_before, time.monotonic() + seconds)
+        # За время паузы токены не копятся, иначе после нее уйдет целая пачка
+        self._tokens = min(self._tokens, 0)
+        self._updated = max(self._updated, self._not_before)
+
+
+@dataclass
+class BroadcastResult:
+    """Итог рассылки"""
+    total: int = 0
+    sent: int = 0
+    failed: int = 0
+
+
+# Обработчик прогресса: (обработано, всего, отправлено, ошибок)
+ProgressCallback = Callable[[int, int, int, int], Awaitable[None]]
+
+
+class Broadcaster:
+    """
+    Отправка сообщений с учётом ограничений Telegram.
+    Общий лимит — ведро токенов, лимит на чат — минимальный интервал между
+    сообщениями в один чат, одновременных отправок не больше concurrency.
+    При RetryAfter ждём, сколько попросил Telegram, и повторяем.
+    """
+
+    def __init__(self, rate: float = GLOBAL_RATE, per_chat_interval: float = PER_CHAT_INTERVAL,
+                 concurrency: int = CONCURRENCY, max_retries: int = MAX_RETRIES):
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self._bucket = TokenBucket(rate)
+        self._semaphore = asyncio.Semaphore(concurrency)
+        # chat_id -> момент, раньше которого в чат писать нельзя
+        self._chat_ready: Dict[int, float] = {}
+
+    async def _wait_for_chat(self, chat_id: int):
+        now = time.monotonic()
+        ready = self._chat_ready.get(chat_id, 0.0)
+        self._chat_ready[chat_id] = max(now, ready) + self.per_chat_interval
+        if ready > now:
+            await asyncio.sleep(ready - now)
+
+        # Не даём словарю расти бесконечно
+        if len(self._chat_ready) > 10000:
+            self._chat_ready = {c: t for c, t in self._chat_ready.items() if t > now}
+
+    async def send(self, bot, chat_id: int, text: str, **kwargs) -> bool:
+        """Отправить одно сообщение. Возвращает True, если оно доставлено."""
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                await self._wait_for_chat(chat_id)
+                await self._bucket.acquire()
+                try:
+                    await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                    SEND_MESSAGES.inc(result='sent')
+                    return True
+                except RetryAfter as e:
+                    logger.warning(f"Флуд-контроль при отправке в {chat_id}, ждём {e.retry_after} с")
+                    SEND_RETRIES.inc(reason='flood')
+                    # Ждём паузу в ведре: отдельный sleep удвоил бы ожидание
+                    self._bucket.pause(e.retry_after)
+                except (Forbidden, BadRequest) as e:
+                    # Пользователь заблокировал бота или чат не существует — повтор не поможет
+                    logger.error(f"Не удалось отправить сообщение пользователю {chat_id}: {e}")
+                    SEND_MESSAGES.inc(result='failed')
+                    return False
+                except NetworkError as e:
+                    logger.warning(f"Сетевая ошибка при отправке в {chat_id}: {e}")
+                    SEND_RETRIES.inc(reason='network')
+                    await asyncio.sleep(min(2 ** attempt, 30))
+            logger.error(f"Не удалось отправить сообщение пользователю {chat_id}: попытки исчерпаны")
+            SEND_MESSAGES.inc(result='failed')
+            return False
+
+    async def broadcast(self, bot, messages: Iterable[Tuple[int, str]],
+                        progress: Optional[ProgressCallback] = None) -> BroadcastResult:
+        """
+        Разослать сообщения (chat_id, текст).
+        progress вызывается не чаще раза в PROGRESS_INTERVAL секунд и в конце.
+        """
+        messages = list(messages)
+        result = BroadcastResult(total=len(messages))
+        last_report = time.monotonic()
+
+        async def deliver(chat_id: int, text: str):
+            nonlocal last_report
+            if await self.send(bot, chat_id, text):
+                result.sent += 1
+            else:
+                result.failed += 1
+            now = time.monotonic()
+            if progress and now - last_report >= PROGRESS_INTERVAL:
+                last_report = now
+                await _report(progress, result)
+
+        await asyncio.gather(*(deliver(chat_id, text) for chat_id, text in messages))
+        if progress:
+            await _report(progress, result)
+        return result
+
+
+async def _report(progress: ProgressCallback, result: BroadcastResult):
+    """Вызвать обработчик прогресса, не прерывая рассылку из-за его ошибок"""
+    try:
+        await progress(result.sent + result.failed, result.total, result.sent, result.failed)
+    except Exception as e:
+        logger.warning(f"Не удалось обновить прогресс рассылки: {e}")
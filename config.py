@@ -9,3 +9,30 @@ BOT_TOKEN = os.getenv('BOT_TOKEN', '')
 # ID администратора (можно узнать у @userinfobot)
 ADMIN_ID = int(os.getenv('ADMIN_ID', '0'))
 
+# Режим вебхука: если задан WEBHOOK_URL (публичный HTTPS-адрес, например
+# https://santa.example.com), бот принимает обновления HTTP-сервером вместо опроса
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+
+# Секрет, который Telegram передает в заголовке X-Telegram-Bot-Api-Secret-Token
+# (1-256 символов: A-Z, a-z, 0-9, _ и -)
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+
+# Адрес и порт локального HTTP-сервера и путь, на который приходят обновления
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+
+# Адрес Bot API (пусто — настоящий Telegram). Для нагрузочных тестов
+# указывает на fake_telegram.py, например http://127.0.0.1:8081
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', '')
+
+# Порт, на котором отдаются метрики в формате Prometheus (/metrics); 0 — не отдавать
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+
+# Через сколько секунд после последней правки вишлиста дарителю уходит уведомление
+# (все правки за это время объединяются в одно сообщение)
+WISHLIST_NOTIFY_DELAY = int(os.getenv('WISHLIST_NOTIFY_DELAY', '60'))
+
+# Как часто (в секундах) состояние диалогов и user_data записывается в базу;
+# при остановке бота оно записывается в любом случае
+PERSISTENCE_INTERVAL = float(os.getenv('PERSISTENCE_INTERVAL', '10'))
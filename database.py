@@ -1,231 +1,1339 @@
+import asyncio
+import functools
+import secrets
 import sqlite3
-from typing import List, Tuple, Optional
+import threading
+import time
+import queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Set, Tuple, Optional
+
+from metrics import DB_QUERY_SECONDS, DB_WAIT_SECONDS
+
+
+# Количество соединений для чтения в пуле
+READER_POOL_SIZE = 4
+
+# Размер кэша подготовленных выражений на одно соединение
+STATEMENT_CACHE_SIZE = 256
+
+# Размер кэша пользователей (записей) и время жизни записи в секундах
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 300
+
+# Сколько участников показываем на одной странице списков
+USERS_PAGE_SIZE = 20
+
+# Сколько строк читаем из курсора за раз при выгрузке
+FETCH_SIZE = 1000
+
+# Сколько ID передаём в одном запросе (старые SQLite разрешают не больше 999 параметров)
+IDS_PER_QUERY = 900
+
+# Игра, в которую попадают пользователи без приглашения (и все данные до появления игр)
+DEFAULT_GAME_ID = 1
+
+# Максимальная длина вишлиста в символах (он целиком уходит в сообщение дарителю)
+WISHLIST_MAX_LENGTH = 3000
+
+# Длина случайной части ссылки-приглашения в байтах (в ссылке ~1.3 символа на байт)
+INVITE_TOKEN_BYTES = 12
+
+# Сколько последних версий вишлиста храним
+WISHLIST_REVISIONS = 20
+
+# Колонки пользователя, которые возвращают get_user и get_all_users
+USER_COLUMNS = 'user_id, username, first_name, last_name, registered_at'
+
+# Текущий вишлист пользователя из таблицы с псевдонимом {0}
+WISHLIST_SQL = '''(
+    SELECT w.text FROM wishlists w
+    WHERE w.game_id = {0}.game_id AND w.user_id = {0}.user_id
+    ORDER BY w.revision DESC LIMIT 1
+)'''
+
+# Полное имя пользователя из таблицы с псевдонимом {0}
+FULL_NAME_SQL = "TRIM({0}.first_name || ' ' || COALESCE({0}.last_name, ''))"
+
+
+def _migrate_initial_schema(cursor: sqlite3.Cursor):
+    """1: пользователи, исключения и распределения"""
+    # Таблица пользователей
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            wishlist TEXT,
+            registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Добавляем колонку wishlist, если её нет (для старых БД)
+    cursor.execute('PRAGMA table_info(users)')
+    if 'wishlist' not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute('ALTER TABLE users ADD COLUMN wishlist TEXT')
+
+    # Таблица исключений (кто кому не может дарить)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS exclusions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user1_id INTEGER,
+            user2_id INTEGER,
+            FOREIGN KEY (user1_id) REFERENCES users(user_id),
+            FOREIGN KEY (user2_id) REFERENCES users(user_id),
+            UNIQUE(user1_id, user2_id)
+        )
+    ''')
+
+    # Таблица распределения (кто кому дарит)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS assignments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            giver_id INTEGER,
+            receiver_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (giver_id) REFERENCES users(user_id),
+            FOREIGN KEY (receiver_id) REFERENCES users(user_id),
+            UNIQUE(giver_id)
+        )
+    ''')
+
+
+def _migrate_outbox(cursor: sqlite3.Cursor):
+    """2: очередь исходящих сообщений"""
+    # Пишется в той же транзакции, что и данные, и разбирается фоновым обработчиком
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            batch TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sent_at TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox(status, id)')
+
+
+def _migrate_lookup_indexes(cursor: sqlite3.Cursor):
+    """3: индексы для частых выборок"""
+    # Постраничный вывод участников
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_name ON users(first_name, user_id)')
+    # get_giver_by_receiver и удаление пользователя
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_assignments_receiver ON assignments(receiver_id)')
+    # Поиск исключений по второму участнику (по первому работает UNIQUE(user1_id, user2_id))
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_exclusions_user2 ON exclusions(user2_id)')
+    # Статистика рассылки по пакету
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_outbox_batch ON outbox(batch, status)')
+
+
+def _migrate_games(cursor: sqlite3.Cursor):
+    """4: несколько независимых игр в одной базе"""
+    cursor.execute('''
+        CREATE TABLE games (
+            game_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT,
+            admin_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Все существующие данные переходят в основную игру
+    cursor.execute("INSERT INTO games (game_id, title) VALUES (?, 'Тайный Санта')", (DEFAULT_GAME_ID,))
+
+    # Игра, с которой пользователь сейчас работает
+    cursor.execute('''
+        CREATE TABLE active_games (
+            user_id INTEGER PRIMARY KEY,
+            game_id INTEGER NOT NULL REFERENCES games(game_id)
+        )
+    ''')
+
+    # Пересоздаём таблицы с game_id в ключах (SQLite не умеет менять PRIMARY KEY)
+    cursor.execute('''
+        CREATE TABLE users_new (
+            game_id INTEGER NOT NULL REFERENCES games(game_id),
+            user_id INTEGER NOT NULL,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            wishlist TEXT,
+            registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (game_id, user_id)
+        )
+    ''')
+    cursor.execute('''
+        INSERT INTO users_new (game_id, user_id, username, first_name, last_name, wishlist, registered_at)
+        SELECT ?, user_id, username, first_name, last_name, wishlist, registered_at FROM users
+    ''', (DEFAULT_GAME_ID,))
+
+    cursor.execute('''
+        CREATE TABLE exclusions_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            game_id INTEGER NOT NULL REFERENCES games(game_id),
+            user1_id INTEGER,
+            user2_id INTEGER,
+            FOREIGN KEY (game_id, user1_id) REFERENCES users(game_id, user_id),
+            FOREIGN KEY (game_id, user2_id) REFERENCES users(game_id, user_id),
+            UNIQUE(game_id, user1_id, user2_id)
+        )
+    ''')
+    cursor.execute('''
+        INSERT INTO exclusions_new (id, game_id, user1_id, user2_id)
+        SELECT id, ?, user1_id, user2_id FROM exclusions
+    ''', (DEFAULT_GAME_ID,))
+
+    cursor.execute('''
+        CREATE TABLE assignments_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            game_id INTEGER NOT NULL REFERENCES games(game_id),
+            giver_id INTEGER,
+            receiver_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (game_id, giver_id) REFERENCES users(game_id, user_id),
+            FOREIGN KEY (game_id, receiver_id) REFERENCES users(game_id, user_id),
+            UNIQUE(game_id, giver_id)
+        )
+    ''')
+    cursor.execute('''
+        INSERT INTO assignments_new (id, game_id, giver_id, receiver_id, created_at)
+        SELECT id, ?, giver_id, receiver_id, created_at FROM assignments
+    ''', (DEFAULT_GAME_ID,))
+
+    for table in ('users', 'exclusions', 'assignments'):
+        cursor.execute(f'DROP TABLE {table}')
+        cursor.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+
+    # Индексы разбиты по играм: выборки стоят O(размера игры)
+    cursor.execute('CREATE INDEX idx_users_name ON users(game_id, first_name, user_id)')
+    cursor.execute('CREATE INDEX idx_assignments_receiver ON assignments(game_id, receiver_id)')
+    cursor.execute('CREATE INDEX idx_exclusions_user2 ON exclusions(game_id, user2_id)')
+    cursor.execute('CREATE INDEX idx_games_admin ON games(admin_id)')
+
+
+def _migrate_wishlists(cursor: sqlite3.Cursor):
+    """5: вишлисты в отдельной таблице с историей версий"""
+    # Списки участников и меню больше не тянут тексты вишлистов из users
+    cursor.execute('''
+        CREATE TABLE wishlists (
+            game_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            revision INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (game_id, user_id, revision),
+            FOREIGN KEY (game_id, user_id) REFERENCES users(game_id, user_id)
+        )
+    ''')
+    cursor.execute('''
+        INSERT INTO wishlists (game_id, user_id, revision, text)
+        SELECT game_id, user_id, 1, wishlist FROM users
+        WHERE wishlist IS NOT NULL AND wishlist != ''
+    ''')
+
+    # Убираем колонку wishlist: пересоздаём таблицу (DROP COLUMN есть не во всех SQLite)
+    cursor.execute('''
+        CREATE TABLE users_new (
+            game_id INTEGER NOT NULL REFERENCES games(game_id),
+            user_id INTEGER NOT NULL,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (game_id, user_id)
+        )
+    ''')
+    cursor.execute('''
+        INSERT INTO users_new (game_id, user_id, username, first_name, last_name, registered_at)
+        SELECT game_id, user_id, username, first_name, last_name, registered_at FROM users
+    ''')
+    cursor.execute('DROP TABLE users')
+    cursor.execute('ALTER TABLE users_new RENAME TO users')
+    cursor.execute('CREATE INDEX idx_users_name ON users(game_id, first_name, user_id)')
+
+
+def _migrate_wishlist_notifications(cursor: sqlite3.Cursor):
+    """6: отложенные уведомления дарителям об изменении вишлиста"""
+    # Одна строка на получателя: повторные изменения только переносят срок
+    cursor.execute('''
+        CREATE TABLE wishlist_notifications (
+            game_id INTEGER NOT NULL,
+            receiver_id INTEGER NOT NULL,
+            due_at REAL NOT NULL,
+            PRIMARY KEY (game_id, receiver_id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX idx_wishlist_notifications_due ON wishlist_notifications(due_at)')
+
+
+def _migrate_bot_state(cursor: sqlite3.Cursor):
+    """7: состояние бота (диалоги, user_data, bot_data) для SqlitePersistence"""
+    cursor.execute('''
+        CREATE TABLE bot_state (
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value BLOB NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (kind, key)
+        )
+    ''')
+
+
+def _migrate_distribution_runs(cursor: sqlite3.Cursor):
+    """8: раздачи ролей с состоянием (draft -> committed -> notified)"""
+    # draft — админ нажал «Раздать», ждём подтверждения; committed — пары сохранены
+    # и сообщения стоят в outbox; notified — рассылка закончена; cancelled — черновик
+    # устарел, потому что подтвердили другую раздачу
+    cursor.execute('''
+        CREATE TABLE distribution_runs (
+            run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            game_id INTEGER NOT NULL REFERENCES games(game_id),
+            single_chain INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'draft',
+            participants INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            committed_at TIMESTAMP,
+            notified_at TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX idx_distribution_runs_game ON distribution_runs(game_id, status)')
+
+
+def new_invite_token() -> str:
+    """Случайный токен приглашения (только символы, допустимые в /start-ссылке)"""
+    return secrets.token_urlsafe(INVITE_TOKEN_BYTES)
+
+
+def _migrate_invite_tokens(cursor: sqlite3.Cursor):
+    """9: случайные токены в ссылках-приглашениях вместо номеров игр"""
+    cursor.execute('ALTER TABLE games ADD COLUMN invite_token TEXT')
+    cursor.execute('SELECT game_id FROM games')
+    cursor.executemany('''
+        UPDATE games SET invite_token = ? WHERE game_id = ?
+    ''', [(new_invite_token(), game_id) for game_id, in cursor.fetchall()])
+    cursor.execute('CREATE UNIQUE INDEX idx_games_invite_token ON games(invite_token)')
+
+
+def _migrate_exclusion_pages(cursor: sqlite3.Cursor):
+    """10: постраничный вывод исключений игры по id"""
+    cursor.execute('CREATE INDEX idx_exclusions_game ON exclusions(game_id, id)')
+
+
+class LRUCache:
+    """
+    Потокобезопасный LRU-кэш с ограниченным размером и временем жизни записей.
+    Считает попадания и промахи.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[object, Tuple[float, object]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Получить значение; default, если записи нет или она устарела"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value):
+        """Сохранить значение, вытеснив самые старые записи при переполнении"""
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def update(self, key, func):
+        """Заменить закэшированное значение на func(значение), если оно есть"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[1] is not None:
+                self._data[key] = (item[0], func(item[1]))
+
+    def pop(self, key):
+        """Удалить запись"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Удалить все записи"""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        """Счетчики кэша: попадания, промахи и текущий размер"""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data)}
+
+
+# Миграции схемы по порядку; номер применённой хранится в PRAGMA user_version.
+# Новые миграции добавляются только в конец списка.
+MIGRATIONS = [
+    _migrate_initial_schema,
+    _migrate_outbox,
+    _migrate_lookup_indexes,
+    _migrate_games,
+    _migrate_wishlists,
+    _migrate_wishlist_notifications,
+    _migrate_bot_state,
+    _migrate_distribution_runs,
+    _migrate_invite_tokens,
+    _migrate_exclusion_pages,
+]
 
 
 class Database:
-    def __init__(self, db_name: str = 'santa.db'):
+    def __init__(self, db_name: str = 'santa.db', readers: int = READER_POOL_SIZE,
+                 user_cache_size: int = USER_CACHE_SIZE, user_cache_ttl: float = USER_CACHE_TTL):
         self.db_name = db_name
+        # Кэш строк пользователей: (game_id, user_id) -> строка или None (не зарегистрирован)
+        self._user_cache = LRUCache(user_cache_size, user_cache_ttl)
+        self._user_version = 0
+        # Индексы исключений в памяти: game_id -> (user_id -> множество user_id, с кем есть исключение)
+        self._exclusion_index: Dict[int, Dict[int, Set[int]]] = {}
+        self._exclusion_version = 0
+        # Версии данных игр для кэша экранов бота: game_id -> счётчик изменений.
+        # Игры, изменённые в текущей транзакции, получают новую версию после COMMIT
+        self._data_versions: Dict[int, int] = {}
+        self._touched: Set[int] = set()
+        # Сброс кэшей, отложенный до COMMIT внешней транзакции
+        self._on_commit: List[Callable[[], None]] = []
+
+        # Одно долгоживущее соединение для записи и пул соединений для чтения
+        self._write_lock = threading.RLock()
+        self._writer_owner: Optional[int] = None
+        self._depth = 0
+        self._writer = self.get_connection()
+        self._readers: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        # База в памяти у каждого соединения своя, поэтому читаем через писателя
+        if db_name != ':memory:':
+            for _ in range(readers):
+                self._readers.put(self.get_connection(readonly=True))
+        self._pooled = not self._readers.empty()
+
         self.init_db()
 
-    def get_connection(self):
-        return sqlite3.connect(self.db_name)
+    def get_connection(self, readonly: bool = False) -> sqlite3.Connection:
+        """Открыть новое соединение с настроенными PRAGMA"""
+        conn = sqlite3.connect(
+            self.db_name,
+            isolation_level=None,  # транзакциями управляем сами
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+        )
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute('PRAGMA cache_size = -16000')  # ~16 МБ
+        conn.execute('PRAGMA temp_store = MEMORY')
+        conn.execute('PRAGMA busy_timeout = 5000')
+        if readonly:
+            conn.execute('PRAGMA query_only = ON')
+        return conn
 
-    def init_db(self):
-        """Инициализация базы данных"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Таблица пользователей
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                wishlist TEXT,
-                registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Добавляем колонку wishlist, если её нет (для существующих БД)
-        try:
-            cursor.execute('ALTER TABLE users ADD COLUMN wishlist TEXT')
-        except sqlite3.OperationalError:
-            pass  # Колонка уже существует
-        
-        # Таблица исключений (кто кому не может дарить)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS exclusions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user1_id INTEGER,
-                user2_id INTEGER,
-                FOREIGN KEY (user1_id) REFERENCES users(user_id),
-                FOREIGN KEY (user2_id) REFERENCES users(user_id),
-                UNIQUE(user1_id, user2_id)
-            )
-        ''')
-        
-        # Таблица распределения (кто кому дарит)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS assignments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                giver_id INTEGER,
-                receiver_id INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (giver_id) REFERENCES users(user_id),
-                FOREIGN KEY (receiver_id) REFERENCES users(user_id),
-                UNIQUE(giver_id)
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
-
-    def add_user(self, user_id: int, username: str, first_name: str, last_name: str = None, wishlist: str = None):
-        """Добавить пользователя"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT OR REPLACE INTO users (user_id, username, first_name, last_name, wishlist)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, username, first_name, last_name, wishlist))
-        conn.commit()
-        conn.close()
-
-    def get_user(self, user_id: int) -> Optional[Tuple]:
-        """Получить пользователя по ID"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        user = cursor.fetchone()
-        conn.close()
-        return user
-
-    def get_all_users(self) -> List[Tuple]:
-        """Получить всех пользователей"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users ORDER BY first_name')
-        users = cursor.fetchall()
-        conn.close()
-        return users
-
-    def is_registered(self, user_id: int) -> bool:
-        """Проверить, зарегистрирован ли пользователь"""
-        return self.get_user(user_id) is not None
-
-    def add_exclusion(self, user1_id: int, user2_id: int):
-        """Добавить исключение (user1 и user2 не могут дарить друг другу)"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        # Добавляем в обе стороны для удобства
+    def close(self):
+        """Закрыть все соединения"""
+        with self._write_lock:
+            self._writer.close()
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Транзакция на запись: COMMIT при успехе, ROLLBACK при исключении.
+        Вложенные вызовы присоединяются к внешней транзакции.
+        """
+        with self._write_lock:
+            cursor = self._writer.cursor()
+            if self._depth:
+                self._depth += 1
+                try:
+                    yield cursor
+                finally:
+                    self._depth -= 1
+                return
+
+            cursor.execute('BEGIN IMMEDIATE')
+            self._depth = 1
+            self._writer_owner = threading.get_ident()
+            try:
+                yield cursor
+            except BaseException:
+                cursor.execute('ROLLBACK')
+                raise
+            else:
+                cursor.execute('COMMIT')
+                for game_id in self._touched:
+                    self._data_versions[game_id] = self._data_versions.get(game_id, 0) + 1
+                for callback in self._on_commit:
+                    callback()
+            finally:
+                self._touched.clear()
+                self._on_commit.clear()
+                self._depth = 0
+                self._writer_owner = None
+
+    @contextmanager
+    def reading(self):
+        """Курсор для чтения из пула (внутри транзакции — из соединения записи)"""
+        if not self._pooled or self._in_transaction():
+            with self._write_lock:
+                yield self._writer.cursor()
+            return
+
+        conn = self._readers.get()
         try:
+            yield conn.cursor()
+        finally:
+            self._readers.put(conn)
+
+    def _touch(self, game_id: int):
+        """Отметить изменение данных игры (вызывается внутри транзакции)"""
+        self._touched.add(game_id)
+
+    def _after_commit(self, callback: Callable[[], None]):
+        """
+        Выполнить callback после COMMIT внешней транзакции (вызывается внутри
+        транзакции). Если сбросить кэш раньше, параллельное чтение из пула
+        успеет закэшировать ещё не удалённые строки. При ROLLBACK не выполняется.
+        """
+        self._on_commit.append(callback)
+
+    def _in_transaction(self) -> bool:
+        """Идёт ли в этом потоке транзакция на запись"""
+        return self._writer_owner == threading.get_ident()
+
+    def data_version(self, game_id: int) -> int:
+        """Версия данных игры: растёт при каждом изменении участников, исключений, вишлистов и распределений"""
+        return self._data_versions.get(game_id, 0)
+
+    def init_db(self):
+        """Инициализация базы данных: применить недостающие миграции"""
+        with self.reading() as cursor:
+            cursor.execute('PRAGMA user_version')
+            version = cursor.fetchone()[0]
+        if version >= len(MIGRATIONS):
+            return  # Схема актуальна
+
+        with self.transaction() as cursor:
+            # Перечитываем версию под блокировкой записи: миграции мог применить другой процесс
+            cursor.execute('PRAGMA user_version')
+            version = cursor.fetchone()[0]
+            for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+                migration(cursor)
+                cursor.execute(f'PRAGMA user_version = {number}')
+
+    def create_game(self, title: str, admin_id: int) -> int:
+        """Создать игру со случайным токеном приглашения и вернуть её ID"""
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT INTO games (title, admin_id, invite_token)
+                VALUES (?, ?, ?)
+            ''', (title, admin_id, new_invite_token()))
+            return cursor.lastrowid
+
+    def get_game(self, game_id: int) -> Optional[Tuple[int, str, int]]:
+        """Получить игру: (game_id, title, admin_id)"""
+        with self.reading() as cursor:
+            cursor.execute('SELECT game_id, title, admin_id FROM games WHERE game_id = ?', (game_id,))
+            return cursor.fetchone()
+
+    def get_game_by_invite(self, invite_token: str) -> Optional[Tuple[int, str, int]]:
+        """Найти игру по токену из ссылки-приглашения: (game_id, title, admin_id)"""
+        with self.reading() as cursor:
             cursor.execute('''
-                INSERT INTO exclusions (user1_id, user2_id)
+                SELECT game_id, title, admin_id FROM games WHERE invite_token = ?
+            ''', (invite_token,))
+            return cursor.fetchone()
+
+    def get_invite_token(self, game_id: int) -> Optional[str]:
+        """Токен ссылки-приглашения игры"""
+        with self.reading() as cursor:
+            cursor.execute('SELECT invite_token FROM games WHERE game_id = ?', (game_id,))
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    def set_game_admin(self, game_id: int, admin_id: int):
+        """Назначить админа игры"""
+        with self.transaction() as cursor:
+            cursor.execute('UPDATE games SET admin_id = ? WHERE game_id = ?', (admin_id, game_id))
+            self._touch(game_id)
+
+    def set_active_game(self, user_id: int, game_id: int):
+        """Выбрать игру, с которой пользователь сейчас работает"""
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT OR REPLACE INTO active_games (user_id, game_id)
                 VALUES (?, ?)
-            ''', (min(user1_id, user2_id), max(user1_id, user2_id)))
-            conn.commit()
-        except sqlite3.IntegrityError:
-            pass  # Уже существует
-        conn.close()
+            ''', (user_id, game_id))
+
+    def get_active_game(self, user_id: int) -> Tuple[int, str, int]:
+        """Получить текущую игру пользователя (по умолчанию — основную): (game_id, title, admin_id)"""
+        with self.reading() as cursor:
+            cursor.execute('''
+                SELECT g.game_id, g.title, g.admin_id
+                FROM games g
+                WHERE g.game_id = COALESCE(
+                    (SELECT game_id FROM active_games WHERE user_id = ?), ?
+                )
+            ''', (user_id, DEFAULT_GAME_ID))
+            return cursor.fetchone()
+
+    def add_user(self, game_id: int, user_id: int, username: str, first_name: str,
+                 last_name: str = None, wishlist: str = None):
+        """Добавить пользователя в игру"""
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT OR REPLACE INTO users (game_id, user_id, username, first_name, last_name)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (game_id, user_id, username, first_name, last_name))
+            if wishlist:
+                self._save_wishlist(cursor, game_id, user_id, wishlist)
+            self._touch(game_id)
+            # Перечитываем строку, чтобы закэшировать её вместе с registered_at
+            cursor.execute(f'''
+                SELECT {USER_COLUMNS} FROM users
+                WHERE game_id = ? AND user_id = ?
+            ''', (game_id, user_id))
+            row = cursor.fetchone()
+            self._invalidate_users(game_id, user_id, row)
+
+    def add_users(self, game_id: int, rows: Iterable[Tuple[int, str, str, str, str]]):
+        """
+        Добавить или обновить пачку пользователей одной транзакцией:
+        (user_id, username, first_name, last_name, wishlist).
+        Пустой wishlist не затирает уже сохранённый. Игра становится активной
+        для тех, у кого активной игры ещё нет.
+        """
+        rows = list(rows)
+        with self.transaction() as cursor:
+            cursor.executemany('''
+                INSERT INTO users (game_id, user_id, username, first_name, last_name)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (game_id, user_id) DO UPDATE
+                SET username = excluded.username,
+                    first_name = excluded.first_name,
+                    last_name = excluded.last_name
+            ''', ((game_id, *row[:4]) for row in rows))
+            for user_id, _, _, _, wishlist in rows:
+                if wishlist:
+                    self._save_wishlist(cursor, game_id, user_id, wishlist)
+            cursor.executemany('''
+                INSERT OR IGNORE INTO active_games (user_id, game_id)
+                VALUES (?, ?)
+            ''', ((row[0], game_id) for row in rows))
+            self._touch(game_id)
+            self._invalidate_users()
+
+    def get_user(self, game_id: int, user_id: int) -> Optional[Tuple]:
+        """Получить пользователя по ID: (user_id, username, first_name, last_name, registered_at)"""
+        # Внутри транзакции кэш может быть устаревшим (сброс ждёт COMMIT), читаем из базы
+        in_transaction = self._in_transaction()
+        key = (game_id, user_id)
+        row = False if in_transaction else self._user_cache.get(key, default=False)
+        if row is not False:
+            return row
+
+        version = self._user_version
+        with self.reading() as cursor:
+            cursor.execute(f'''
+                SELECT {USER_COLUMNS} FROM users
+                WHERE game_id = ? AND user_id = ?
+            ''', (game_id, user_id))
+            row = cursor.fetchone()
+        # Не кэшируем, если пользователи успели измениться во время чтения,
+        # и внутри транзакции: прочитанное может откатиться
+        if version == self._user_version and not in_transaction:
+            self._user_cache.put(key, row)
+        return row
 
-    def remove_exclusion(self, user1_id: int, user2_id: int):
+    def _invalidate_users(self, game_id: int = None, user_id: int = None, row: Tuple = None):
+        """
+        Обновить кэш пользователей после COMMIT: положить новую строку row
+        (или забыть пользователя, если row нет), без user_id — сбросить весь кэш.
+        Версию меняем после COMMIT: параллельное чтение старых данных не попадет в кэш.
+        """
+        def invalidate():
+            self._user_version += 1
+            if user_id is None:
+                self._user_cache.clear()
+            elif row is None:
+                self._user_cache.pop((game_id, user_id))
+            else:
+                self._user_cache.put((game_id, user_id), row)
+
+        self._after_commit(invalidate)
+
+    def user_cache_stats(self) -> Dict[str, int]:
+        """Статистика кэша пользователей: hits, misses, size"""
+        return self._user_cache.stats()
+
+    def get_all_users(self, game_id: int) -> List[Tuple]:
+        """Получить всех пользователей игры: (user_id, username, first_name, last_name, registered_at)"""
+        with self.reading() as cursor:
+            cursor.execute(f'''
+                SELECT {USER_COLUMNS} FROM users
+                WHERE game_id = ?
+                ORDER BY first_name, user_id
+            ''', (game_id,))
+            return cursor.fetchall()
+
+    def get_user_names(self, game_id: int) -> List[Tuple[int, str, str]]:
+        """Получить участников игры для распределения и меню: (user_id, first_name, last_name)"""
+        with self.reading() as cursor:
+            cursor.execute('''
+                SELECT user_id, first_name, last_name FROM users
+                WHERE game_id = ?
+                ORDER BY first_name, user_id
+            ''', (game_id,))
+            return cursor.fetchall()
+
+    def get_users_page(self, game_id: int, after_id: int = None, before_id: int = None,
+                       limit: int = USERS_PAGE_SIZE) -> Tuple[List[Tuple], bool, bool]:
+        """
+        Получить страницу участников игры, упорядоченных по (first_name, user_id).
+        Курсор — user_id последней (after_id) или первой (before_id) записи
+        соседней страницы, поэтому страница стоит O(limit), а не O(участников).
+        Возвращает (строки (user_id, username, first_name, last_name), есть_предыдущая, есть_следующая).
+        """
+        columns = 'user_id, username, first_name, last_name'
+        cursor_id = after_id if after_id is not None else before_id
+        with self.reading() as cursor:
+            key = None
+            if cursor_id is not None:
+                cursor.execute('''
+                    SELECT first_name, user_id FROM users
+                    WHERE game_id = ? AND user_id = ?
+                ''', (game_id, cursor_id))
+                key = cursor.fetchone()
+
+            # Курсор не задан или участник уже удален — начинаем с первой страницы
+            if key is None:
+                cursor.execute(f'''
+                    SELECT {columns} FROM users
+                    WHERE game_id = ?
+                    ORDER BY first_name, user_id
+                    LIMIT ?
+                ''', (game_id, limit + 1))
+                rows = cursor.fetchall()
+                return rows[:limit], False, len(rows) > limit
+
+            if after_id is not None:
+                cursor.execute(f'''
+                    SELECT {columns} FROM users
+                    WHERE game_id = ? AND (first_name, user_id) > (?, ?)
+                    ORDER BY first_name, user_id
+                    LIMIT ?
+                ''', (game_id, *key, limit + 1))
+                rows = cursor.fetchall()
+                return rows[:limit], True, len(rows) > limit
+
+            cursor.execute(f'''
+                SELECT {columns} FROM users
+                WHERE game_id = ? AND (first_name, user_id) < (?, ?)
+                ORDER BY first_name DESC, user_id DESC
+                LIMIT ?
+            ''', (game_id, *key, limit + 1))
+            rows = cursor.fetchall()
+            return rows[:limit][::-1], len(rows) > limit, True
+
+    def is_registered(self, game_id: int, user_id: int) -> bool:
+        """Проверить, зарегистрирован ли пользователь в игре"""
+        return self.get_user(game_id, user_id) is not None
+
+    def add_exclusion(self, game_id: int, user1_id: int, user2_id: int):
+        """Добавить исключение (user1 и user2 не могут дарить друг другу)"""
+        # Храним пару упорядоченной, поиск в обе стороны идёт через индекс
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT OR IGNORE INTO exclusions (game_id, user1_id, user2_id)
+                VALUES (?, ?, ?)
+            ''', (game_id, min(user1_id, user2_id), max(user1_id, user2_id)))
+            self._touch(game_id)
+            self._invalidate_exclusions(game_id)
+
+    def add_exclusions(self, game_id: int, pairs: Iterable[Tuple[int, int]]):
+        """Добавить пачку исключений одной транзакцией"""
+        with self.transaction() as cursor:
+            cursor.executemany('''
+                INSERT OR IGNORE INTO exclusions (game_id, user1_id, user2_id)
+                VALUES (?, ?, ?)
+            ''', ((game_id, min(a, b), max(a, b)) for a, b in pairs))
+            self._touch(game_id)
+            self._invalidate_exclusions(game_id)
+
+    def remove_exclusion(self, game_id: int, user1_id: int, user2_id: int):
         """Удалить исключение"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            DELETE FROM exclusions
-            WHERE user1_id = ? AND user2_id = ?
-        ''', (min(user1_id, user2_id), max(user1_id, user2_id)))
-        conn.commit()
-        conn.close()
-
-    def get_exclusions(self) -> List[Tuple]:
-        """Получить все исключения"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM exclusions')
-        exclusions = cursor.fetchall()
-        conn.close()
-        return exclusions
-
-    def has_exclusion(self, user1_id: int, user2_id: int) -> bool:
+        with self.transaction() as cursor:
+            cursor.execute('''
+                DELETE FROM exclusions
+                WHERE game_id = ? AND user1_id = ? AND user2_id = ?
+            ''', (game_id, min(user1_id, user2_id), max(user1_id, user2_id)))
+            self._touch(game_id)
+            self._invalidate_exclusions(game_id)
+
+    def get_exclusions(self, game_id: int) -> List[Tuple]:
+        """Получить все исключения игры: (id, user1_id, user2_id)"""
+        with self.reading() as cursor:
+            cursor.execute('''
+                SELECT id, user1_id, user2_id FROM exclusions
+                WHERE game_id = ?
+            ''', (game_id,))
+            return cursor.fetchall()
+
+    def get_exclusion_index(self, game_id: int) -> Dict[int, Set[int]]:
+        """
+        Получить индекс исключений игры: user_id -> множество user_id, с кем есть исключение.
+        Загружается из базы одним запросом и сбрасывается при изменении исключений.
+        Внутри транзакции всегда читается из базы: сброс индекса ждёт COMMIT.
+        """
+        in_transaction = self._in_transaction()
+        index = None if in_transaction else self._exclusion_index.get(game_id)
+        if index is None:
+            version = self._exclusion_version
+            index = {}
+            with self.reading() as cursor:
+                cursor.execute('''
+                    SELECT user1_id, user2_id FROM exclusions
+                    WHERE game_id = ?
+                ''', (game_id,))
+                for user1_id, user2_id in cursor:
+                    index.setdefault(user1_id, set()).add(user2_id)
+                    index.setdefault(user2_id, set()).add(user1_id)
+            # Не кэшируем, если исключения успели измениться во время загрузки,
+            # и внутри транзакции: прочитанное может откатиться
+            if version == self._exclusion_version and not in_transaction:
+                self._exclusion_index[game_id] = index
+        return index
+
+    def _invalidate_exclusions(self, game_id: int):
+        """Сбросить индекс исключений игры после COMMIT (вызывается внутри транзакции)"""
+        def invalidate():
+            self._exclusion_version += 1
+            self._exclusion_index.pop(game_id, None)
+
+        self._after_commit(invalidate)
+
+    def get_exclusions_with_names(self, game_id: int) -> List[Tuple[int, int, str, int, str]]:
+        """Получить исключения с именами участников: (id, user1_id, имя1, user2_id, имя2)"""
+        with self.reading() as cursor:
+            cursor.execute(f'''
+                SELECT e.id, e.user1_id, {FULL_NAME_SQL.format('u1')},
+                       e.user2_id, {FULL_NAME_SQL.format('u2')}
+                FROM exclusions e
+                JOIN users u1 ON u1.game_id = e.game_id AND u1.user_id = e.user1_id
+                JOIN users u2 ON u2.game_id = e.game_id AND u2.user_id = e.user2_id
+                WHERE e.game_id = ?
+                ORDER BY e.id
+            ''', (game_id,))
+            return cursor.fetchall()
+
+    def get_exclusions_page(self, game_id: int, after_id: int = None, before_id: int = None,
+                            limit: int = USERS_PAGE_SIZE) -> Tuple[List[Tuple], bool, bool]:
+        """
+        Получить страницу исключений с именами, упорядоченных по id.
+        Курсор — id последнего (after_id) или первого (before_id) исключения
+        соседней страницы, поэтому страница стоит O(limit), а не O(исключений).
+        Возвращает (строки (id, user1_id, имя1, user2_id, имя2), есть_предыдущая, есть_следующая).
+        """
+        query = f'''
+            SELECT e.id, e.user1_id, {FULL_NAME_SQL.format('u1')},
+                   e.user2_id, {FULL_NAME_SQL.format('u2')}
+            FROM exclusions e
+            JOIN users u1 ON u1.game_id = e.game_id AND u1.user_id = e.user1_id
+            JOIN users u2 ON u2.game_id = e.game_id AND u2.user_id = e.user2_id
+            WHERE e.game_id = ? AND {{}}
+            ORDER BY e.id {{}}
+            LIMIT ?
+        '''
+        with self.reading() as cursor:
+            if before_id is not None:
+                cursor.execute(query.format('e.id < ?', 'DESC'), (game_id, before_id, limit + 1))
+                rows = cursor.fetchall()
+                return rows[:limit][::-1], len(rows) > limit, True
+
+            cursor.execute(query.format('e.id > ?', ''), (game_id, after_id or 0, limit + 1))
+            rows = cursor.fetchall()
+            return rows[:limit], after_id is not None, len(rows) > limit
+
+    def get_exclusion(self, game_id: int, exclusion_id: int) -> Optional[Tuple[int, int, int]]:
+        """Получить исключение игры по id: (id, user1_id, user2_id)"""
+        with self.reading() as cursor:
+            cursor.execute('''
+                SELECT id, user1_id, user2_id FROM exclusions
+                WHERE game_id = ? AND id = ?
+            ''', (game_id, exclusion_id))
+            return cursor.fetchone()
+
+    def has_exclusions(self, game_id: int) -> bool:
+        """Есть ли в игре хотя бы одно исключение"""
+        with self.reading() as cursor:
+            cursor.execute('SELECT EXISTS (SELECT 1 FROM exclusions WHERE game_id = ?)', (game_id,))
+            return bool(cursor.fetchone()[0])
+
+    def has_exclusion(self, game_id: int, user1_id: int, user2_id: int) -> bool:
         """Проверить, есть ли исключение между двумя пользователями"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT COUNT(*) FROM exclusions
-            WHERE user1_id = ? AND user2_id = ?
-        ''', (min(user1_id, user2_id), max(user1_id, user2_id)))
-        count = cursor.fetchone()[0]
-        conn.close()
-        return count > 0
-
-    def clear_assignments(self):
-        """Очистить все распределения"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM assignments')
-        conn.commit()
-        conn.close()
-
-    def save_assignment(self, giver_id: int, receiver_id: int):
+        return user2_id in self.get_exclusion_index(game_id).get(user1_id, ())
+
+    def clear_assignments(self, game_id: int):
+        """Очистить все распределения игры"""
+        with self.transaction() as cursor:
+            cursor.execute('DELETE FROM assignments WHERE game_id = ?', (game_id,))
+            self._touch(game_id)
+
+    def save_assignment(self, game_id: int, giver_id: int, receiver_id: int):
         """Сохранить распределение"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO assignments (giver_id, receiver_id)
-            VALUES (?, ?)
-        ''', (giver_id, receiver_id))
-        conn.commit()
-        conn.close()
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT INTO assignments (game_id, giver_id, receiver_id)
+                VALUES (?, ?, ?)
+            ''', (game_id, giver_id, receiver_id))
+            self._touch(game_id)
+
+    def save_assignments(self, game_id: int, pairs: List[Tuple[int, int]],
+                         messages: Iterable[Tuple[int, str]] = (), batch: str = None):
+        """
+        Заменить все распределения игры новыми одной транзакцией.
+        Либо сохраняется весь набор пар, либо (при ошибке) остаются старые.
+        Сообщения (chat_id, текст) ставятся в outbox в той же транзакции,
+        а неотправленные сообщения прежних раздач игры отменяются: в них
+        уже неверные получатели.
+        """
+        with self.transaction() as cursor:
+            cursor.execute('DELETE FROM assignments WHERE game_id = ?', (game_id,))
+            cursor.execute('''
+                UPDATE outbox SET status = 'cancelled', sent_at = CURRENT_TIMESTAMP
+                WHERE status = 'pending' AND batch IS NOT ? AND batch IN (
+                    SELECT 'run:' || run_id FROM distribution_runs WHERE game_id = ?
+                )
+            ''', (batch, game_id))
+            cursor.executemany('''
+                INSERT INTO assignments (game_id, giver_id, receiver_id)
+                VALUES (?, ?, ?)
+            ''', ((game_id, giver_id, receiver_id) for giver_id, receiver_id in pairs))
+            self.enqueue_messages(messages, batch)
+            self._touch(game_id)
+
+    def update_assignments(self, game_id: int, pairs: Iterable[Tuple[int, int]],
+                           messages: Iterable[Tuple[int, str]] = (), batch: str = None):
+        """
+        Изменить получателей у отдельных дарителей, не трогая остальные пары.
+        Сообщения (chat_id, текст) ставятся в outbox в той же транзакции.
+        """
+        with self.transaction() as cursor:
+            cursor.executemany('''
+                INSERT INTO assignments (game_id, giver_id, receiver_id)
+                VALUES (?, ?, ?)
+                ON CONFLICT (game_id, giver_id) DO UPDATE
+                SET receiver_id = excluded.receiver_id, created_at = CURRENT_TIMESTAMP
+            ''', ((game_id, giver_id, receiver_id) for giver_id, receiver_id in pairs))
+            self.enqueue_messages(messages, batch)
+            self._touch(game_id)
+
+    def create_distribution_run(self, game_id: int, single_chain: bool = False) -> int:
+        """Создать черновик раздачи и вернуть его ID"""
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT INTO distribution_runs (game_id, single_chain)
+                VALUES (?, ?)
+            ''', (game_id, int(single_chain)))
+            return cursor.lastrowid
+
+    def get_distribution_run(self, run_id: int) -> Optional[Tuple[int, int, bool, str, int]]:
+        """Получить раздачу: (run_id, game_id, single_chain, status, participants)"""
+        with self.reading() as cursor:
+            cursor.execute('''
+                SELECT run_id, game_id, single_chain, status, participants FROM distribution_runs
+                WHERE run_id = ?
+            ''', (run_id,))
+            row = cursor.fetchone()
+        return (row[0], row[1], bool(row[2]), row[3], row[4]) if row else None
+
+    def commit_distribution_run(self, run_id: int, pairs: List[Tuple[int, int]],
+                                messages: Iterable[Tuple[int, str]] = ()) -> bool:
+        """
+        Перевести черновик в committed и сохранить его распределение одной транзакцией.
+        Сообщения ставятся в outbox с пакетом run:<run_id>; остальные черновики игры
+        и неотправленные сообщения прежних раздач отменяются. Возвращает False, если раздача уже не черновик — тогда ничего не меняется.
+        """
+        with self.transaction() as cursor:
+            cursor.execute('''
+                UPDATE distribution_runs
+                SET status = 'committed', participants = ?, committed_at = CURRENT_TIMESTAMP
+                WHERE run_id = ? AND status = 'draft'
+            ''', (len(pairs), run_id))
+            if cursor.rowcount == 0:
+                return False
+            cursor.execute('SELECT game_id FROM distribution_runs WHERE run_id = ?', (run_id,))
+            game_id = cursor.fetchone()[0]
+            cursor.execute('''
+                UPDATE distribution_runs SET status = 'cancelled'
+                WHERE game_id = ? AND status = 'draft'
+            ''', (game_id,))
+            self.save_assignments(game_id, pairs, messages, batch=f"run:{run_id}")
+            return True
+
+    def mark_run_notified(self, run_id: int):
+        """Отметить, что рассылка раздачи закончена"""
+        with self.transaction() as cursor:
+            cursor.execute('''
+                UPDATE distribution_runs SET status = 'notified', notified_at = CURRENT_TIMESTAMP
+                WHERE run_id = ? AND status = 'committed'
+            ''', (run_id,))
 
-    def get_assignment(self, giver_id: int) -> Optional[int]:
+    def get_assignment(self, game_id: int, giver_id: int) -> Optional[int]:
         """Получить, кому должен дарить пользователь"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT receiver_id FROM assignments WHERE giver_id = ?', (giver_id,))
-        result = cursor.fetchone()
-        conn.close()
+        with self.reading() as cursor:
+            cursor.execute('''
+                SELECT receiver_id FROM assignments
+                WHERE game_id = ? AND giver_id = ?
+            ''', (game_id, giver_id))
+            result = cursor.fetchone()
         return result[0] if result else None
 
-    def get_giver_by_receiver(self, receiver_id: int) -> Optional[int]:
+    def get_giver_by_receiver(self, game_id: int, receiver_id: int) -> Optional[int]:
         """Получить, кто дарит подарок получателю"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT giver_id FROM assignments WHERE receiver_id = ?', (receiver_id,))
-        result = cursor.fetchone()
-        conn.close()
+        with self.reading() as cursor:
+            cursor.execute('''
+                SELECT giver_id FROM assignments
+                WHERE game_id = ? AND receiver_id = ?
+            ''', (game_id, receiver_id))
+            result = cursor.fetchone()
         return result[0] if result else None
 
-    def get_all_assignments(self) -> List[Tuple]:
-        """Получить все распределения"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM assignments')
-        assignments = cursor.fetchall()
-        conn.close()
-        return assignments
-
-    def remove_user(self, user_id: int):
-        """Удалить пользователя и все связанные данные"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Удаляем исключения, где участвует этот пользователь
+    def get_all_assignments(self, game_id: int) -> List[Tuple]:
+        """Получить все распределения игры: (id, giver_id, receiver_id, created_at)"""
+        with self.reading() as cursor:
+            cursor.execute('''
+                SELECT id, giver_id, receiver_id, created_at FROM assignments
+                WHERE game_id = ?
+            ''', (game_id,))
+            return cursor.fetchall()
+
+    def get_assignments_with_names(self, game_id: int) -> List[Tuple[int, str, int, str]]:
+        """Получить распределения с именами: (giver_id, имя дарителя, receiver_id, имя получателя)"""
+        with self.reading() as cursor:
+            cursor.execute(f'''
+                SELECT a.giver_id, {FULL_NAME_SQL.format('g')},
+                       a.receiver_id, {FULL_NAME_SQL.format('r')}
+                FROM assignments a
+                JOIN users g ON g.game_id = a.game_id AND g.user_id = a.giver_id
+                JOIN users r ON r.game_id = a.game_id AND r.user_id = a.receiver_id
+                WHERE a.game_id = ?
+                ORDER BY a.id
+            ''', (game_id,))
+            return cursor.fetchall()
+
+    def remove_user(self, game_id: int, user_id: int):
+        """Удалить пользователя из игры и все связанные данные"""
+        with self.transaction() as cursor:
+            # Удаляем исключения, где участвует этот пользователь
+            cursor.execute('''
+                DELETE FROM exclusions
+                WHERE game_id = ? AND (user1_id = ? OR user2_id = ?)
+            ''', (game_id, user_id, user_id))
+
+            # Удаляем распределения, где пользователь даритель или получатель
+            cursor.execute('''
+                DELETE FROM assignments
+                WHERE game_id = ? AND (giver_id = ? OR receiver_id = ?)
+            ''', (game_id, user_id, user_id))
+
+            # Удаляем самого пользователя, его вишлисты и сбрасываем выбор этой игры
+            cursor.execute('DELETE FROM wishlists WHERE game_id = ? AND user_id = ?', (game_id, user_id))
+            cursor.execute('''
+                DELETE FROM wishlist_notifications WHERE game_id = ? AND receiver_id = ?
+            ''', (game_id, user_id))
+            cursor.execute('DELETE FROM users WHERE game_id = ? AND user_id = ?', (game_id, user_id))
+            cursor.execute('DELETE FROM active_games WHERE user_id = ? AND game_id = ?', (user_id, game_id))
+            self._touch(game_id)
+            self._invalidate_users(game_id, user_id)
+            self._invalidate_exclusions(game_id)
+
+    def _iter_rows(self, sql: str, params: Tuple) -> Iterator[Tuple]:
+        """Потоково отдавать строки запроса пачками по FETCH_SIZE"""
+        with self.reading() as cursor:
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(FETCH_SIZE)
+                if not rows:
+                    return
+                yield from rows
+
+    def iter_users(self, game_id: int) -> Iterator[Tuple]:
+        """Все пользователи игры для выгрузки: (user_id, username, first_name, last_name, wishlist)"""
+        return self._iter_rows(f'''
+            SELECT u.user_id, u.username, u.first_name, u.last_name, {WISHLIST_SQL.format('u')}
+            FROM users u
+            WHERE u.game_id = ?
+            ORDER BY u.user_id
+        ''', (game_id,))
+
+    def iter_exclusions(self, game_id: int) -> Iterator[Tuple[int, int]]:
+        """Все исключения игры для выгрузки: (user1_id, user2_id)"""
+        return self._iter_rows('''
+            SELECT user1_id, user2_id FROM exclusions
+            WHERE game_id = ?
+            ORDER BY id
+        ''', (game_id,))
+
+    def iter_assignments(self, game_id: int) -> Iterator[Tuple[int, int]]:
+        """Все распределения игры для выгрузки: (giver_id, receiver_id)"""
+        return self._iter_rows('''
+            SELECT giver_id, receiver_id FROM assignments
+            WHERE game_id = ?
+            ORDER BY id
+        ''', (game_id,))
+
+    def enqueue_messages(self, messages: Iterable[Tuple[int, str]], batch: str = None):
+        """Поставить сообщения (chat_id, текст) в очередь на отправку"""
+        with self.transaction() as cursor:
+            cursor.executemany('''
+                INSERT INTO outbox (chat_id, text, batch)
+                VALUES (?, ?, ?)
+            ''', ((chat_id, text, batch) for chat_id, text in messages))
+
+    def claim_pending_messages(self, limit: int) -> List[Tuple[int, int, str]]:
+        """
+        Забрать до limit неотправленных сообщений на отправку: (id, chat_id, текст).
+        Сообщения переводятся в статус 'sending' до отправки, поэтому после
+        падения они не уйдут второй раз (см. recover_sending_messages).
+        """
+        with self.transaction() as cursor:
+            cursor.execute('''
+                SELECT id, chat_id, text FROM outbox
+                WHERE status = 'pending'
+                ORDER BY id
+                LIMIT ?
+            ''', (limit,))
+            messages = cursor.fetchall()
+            cursor.executemany('''
+                UPDATE outbox SET status = 'sending'
+                WHERE id = ? AND status = 'pending'
+            ''', ((message_id,) for message_id, _, _ in messages))
+            return messages
+
+    def mark_messages(self, results: Iterable[Tuple[int, str]]):
+        """Отметить отправленную пачку: (id, 'sent' | 'failed' | 'unknown')"""
+        with self.transaction() as cursor:
+            cursor.executemany('''
+                UPDATE outbox SET status = ?, sent_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status = 'sending'
+            ''', ((status, message_id) for message_id, status in results))
+
+    def recover_sending_messages(self) -> int:
+        """
+        Отметить 'unknown' сообщения, которые отправлялись в момент падения.
+        Дошли ли они, неизвестно, поэтому повторно они не отправляются.
+        Возвращает их количество.
+        """
+        with self.transaction() as cursor:
+            cursor.execute('''
+                UPDATE outbox SET status = 'unknown', sent_at = CURRENT_TIMESTAMP
+                WHERE status = 'sending'
+            ''')
+            return cursor.rowcount
+
+    def get_outbox_stats(self, batch: str) -> Dict[str, int]:
+        """Получить количество сообщений пакета по статусам: pending, sending, sent, failed, unknown, cancelled"""
+        with self.reading() as cursor:
+            cursor.execute('''
+                SELECT status, COUNT(*) FROM outbox
+                WHERE batch = ?
+                GROUP BY status
+            ''', (batch,))
+            return dict(cursor.fetchall())
+
+    def get_bot_state(self, kind: str) -> List[Tuple[str, bytes]]:
+        """Сохранённое состояние бота одного вида: (ключ, значение)"""
+        with self.reading() as cursor:
+            cursor.execute('SELECT key, value FROM bot_state WHERE kind = ?', (kind,))
+            return cursor.fetchall()
+
+    def save_bot_state(self, items: Iterable[Tuple[str, str, Optional[bytes]]]):
+        """Записать пачку состояния одной транзакцией: (вид, ключ, значение); None — удалить"""
+        items = list(items)
+        with self.transaction() as cursor:
+            cursor.executemany('''
+                DELETE FROM bot_state WHERE kind = ? AND key = ?
+            ''', ((kind, key) for kind, key, value in items if value is None))
+            cursor.executemany('''
+                INSERT INTO bot_state (kind, key, value)
+                VALUES (?, ?, ?)
+                ON CONFLICT (kind, key) DO UPDATE
+                SET value = excluded.value, updated_at = CURRENT_TIMESTAMP
+            ''', ((kind, key, value) for kind, key, value in items if value is not None))
+
+    def _save_wishlist(self, cursor: sqlite3.Cursor, game_id: int, user_id: int,
+                       wishlist: str) -> Optional[int]:
+        """
+        Записать новую версию вишлиста и удалить самые старые.
+        Возвращает номер версии или None, если текст не изменился.
+        """
+        if len(wishlist) > WISHLIST_MAX_LENGTH:
+            raise ValueError(f"Вишлист длиннее {WISHLIST_MAX_LENGTH} символов")
         cursor.execute('''
-            DELETE FROM exclusions
-            WHERE user1_id = ? OR user2_id = ?
-        ''', (user_id, user_id))
-        
-        # Удаляем распределения, где пользователь даритель или получатель
+            SELECT revision, text FROM wishlists
+            WHERE game_id = ? AND user_id = ?
+            ORDER BY revision DESC LIMIT 1
+        ''', (game_id, user_id))
+        last = cursor.fetchone()
+        if last and last[1] == wishlist:
+            return None
+
+        revision = last[0] + 1 if last else 1
         cursor.execute('''
-            DELETE FROM assignments
-            WHERE giver_id = ? OR receiver_id = ?
-        ''', (user_id, user_id))
-        
-        # Удаляем самого пользователя
-        cursor.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
-        
-        conn.commit()
-        conn.close()
-
-    def update_wishlist(self, user_id: int, wishlist: str):
-        """Обновить вишлист пользователя"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+            INSERT INTO wishlists (game_id, user_id, revision, text)
+            VALUES (?, ?, ?, ?)
+        ''', (game_id, user_id, revision, wishlist))
         cursor.execute('''
-            UPDATE users SET wishlist = ? WHERE user_id = ?
-        ''', (wishlist, user_id))
-        conn.commit()
-        conn.close()
-
-    def get_wishlist(self, user_id: int) -> Optional[str]:
-        """Получить вишлист пользователя"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT wishlist FROM users WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        conn.close()
-        return result[0] if result and result[0] else None
+            DELETE FROM wishlists
+            WHERE game_id = ? AND user_id = ? AND revision <= ?
+        ''', (game_id, user_id, revision - WISHLIST_REVISIONS))
+        self._touch(game_id)
+        return revision
+
+    def update_wishlist(self, game_id: int, user_id: int, wishlist: str,
+                        notify_at: float = None) -> Optional[int]:
+        """
+        Сохранить новую версию вишлиста и вернуть её номер (None, если текст не изменился).
+        notify_at — когда (unix-время) сообщить дарителю; каждое изменение
+        переносит срок, поэтому серия правок даёт одно уведомление.
+        ValueError, если вишлист длиннее WISHLIST_MAX_LENGTH.
+        """
+        with self.transaction() as cursor:
+            revision = self._save_wishlist(cursor, game_id, user_id, wishlist)
+            if revision is not None and notify_at is not None:
+                cursor.execute('''
+                    INSERT INTO wishlist_notifications (game_id, receiver_id, due_at)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT (game_id, receiver_id) DO UPDATE SET due_at = excluded.due_at
+                ''', (game_id, user_id, notify_at))
+            return revision
+
+    def pop_due_wishlist_notifications(self, now: float, limit: int) -> List[Tuple[int, int]]:
+        """Забрать до limit уведомлений, срок которых наступил: (game_id, receiver_id)"""
+        with self.transaction() as cursor:
+            cursor.execute('''
+                SELECT game_id, receiver_id FROM wishlist_notifications
+                WHERE due_at <= ?
+                ORDER BY due_at
+                LIMIT ?
+            ''', (now, limit))
+            due = cursor.fetchall()
+            cursor.executemany('''
+                DELETE FROM wishlist_notifications
+                WHERE game_id = ? AND receiver_id = ?
+            ''', due)
+            return due
+
+    def get_wishlist(self, game_id: int, user_id: int) -> Optional[str]:
+        """Получить текущий вишлист пользователя"""
+        with self.reading() as cursor:
+            cursor.execute('''
+                SELECT text FROM wishlists
+                WHERE game_id = ? AND user_id = ?
+                ORDER BY revision DESC LIMIT 1
+            ''', (game_id, user_id))
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    def get_wishlists(self, game_id: int, user_ids: Iterable[int] = None) -> Dict[int, str]:
+        """
+        Текущие вишлисты пользователей (по умолчанию — всех участников игры):
+        user_id -> текст, только у кого вишлист есть.
+        """
+        select = f'''
+            SELECT u.user_id, {WISHLIST_SQL.format('u')}
+            FROM users u
+            WHERE u.game_id = ?
+        '''
+        wishlists = {}
+        with self.reading() as cursor:
+            if user_ids is None:
+                cursor.execute(select, (game_id,))
+                wishlists.update((user_id, text) for user_id, text in cursor if text)
+                return wishlists
+
+            user_ids = list(user_ids)
+            for start in range(0, len(user_ids), IDS_PER_QUERY):
+                chunk = user_ids[start:start + IDS_PER_QUERY]
+                cursor.execute(
+                    select + f" AND u.user_id IN ({','.join('?' * len(chunk))})",
+                    (game_id, *chunk)
+                )
+                wishlists.update((user_id, text) for user_id, text in cursor if text)
+        return wishlists
+
+    def get_wishlist_history(self, game_id: int, user_id: int) -> List[Tuple[int, str, str]]:
+        """Сохранённые версии вишлиста, новые первыми: (revision, text, created_at)"""
+        with self.reading() as cursor:
+            cursor.execute('''
+                SELECT revision, text, created_at FROM wishlists
+                WHERE game_id = ? AND user_id = ?
+                ORDER BY revision DESC
+            ''', (game_id, user_id))
+            return cursor.fetchall()
+
+
+class AsyncDatabase:
+    """
+    Асинхронная обёртка над Database для обработчиков бота.
+    Каждый вызов выполняется в отдельном пуле потоков, поэтому медленный
+    запрос не блокирует цикл событий. Методы повторяют API Database:
+
+        user = await db.get_user(user_id)
+
+    Синхронный Database остаётся доступен через атрибут sync (для скриптов).
+    """
+
+    def __init__(self, database: Database, workers: int = READER_POOL_SIZE + 1):
+        self.sync = database
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='db')
+
+    async def run(self, func, *args, **kwargs):
+        """Выполнить произвольную функцию в потоке базы данных"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    def close(self):
+        """Дождаться выполнения запросов и закрыть соединения"""
+        self._executor.shutdown(wait=True)
+        self.sync.close()
+
+    def __getattr__(self, name):
+        method = getattr(self.sync, name)
+        if name.startswith('_') or not callable(method):
+            raise AttributeError(name)
+
+        async def call(*args, **kwargs):
+            queued = time.perf_counter()
+
+            def timed_call():
+                started = time.perf_counter()
+                DB_WAIT_SECONDS.observe(started - queued)
+                with DB_QUERY_SECONDS.time(method=name):
+                    return method(*args, **kwargs)
+
+            return await self.run(timed_call)
 
+        call.__name__ = name
+        call.__doc__ = method.__doc__
+        # Запоминаем обёртку, чтобы не создавать её на каждый вызов
+        setattr(self, name, call)
+        return call
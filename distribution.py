@@ -0,0 +1,385 @@
+import random
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+
+# Сколько случайных партнёров для обмена пробуем, прежде чем перейти к паросочетанию
+REPAIR_TRIES = 16
+
+# Сколько случайных обменов на участника делаем для перемешивания результата
+MIX_ROUNDS = 4
+
+# Сколько случайных пар пробуем для слияния цепочек, прежде чем перебирать все
+MERGE_TRIES = 64
+
+# Сколько раз начинаем заново со случайного распределения, если одна цепочка не вышла
+CHAIN_RESTARTS = 8
+
+# Бюджет шагов поиска цепочки вращениями (на участника)
+ROTATION_STEPS = 50
+
+
+def build_forbidden(user_ids: Iterable[int], exclusion_index: Dict[int, Set[int]]) -> Dict[int, Set[int]]:
+    """
+    Построить список запретов: кому участник не может дарить.
+    exclusion_index уже двусторонний (см. Database.get_exclusion_index),
+    себе дарить тоже нельзя.
+    """
+    return {user_id: exclusion_index.get(user_id, set()) | {user_id} for user_id in user_ids}
+
+
+def _allowed(forbidden: Dict[int, Set[int]], giver_id: int, receiver_id: int) -> bool:
+    return receiver_id not in forbidden[giver_id]
+
+
+def _augment(root: int, receivers: List[int], forbidden: Dict[int, Set[int]],
+             match_giver: Dict[int, int], match_receiver: Dict[int, int]) -> bool:
+    """
+    Найти увеличивающий путь от свободного дарителя root (поиск в ширину).
+    Граф разрешённых пар плотный, поэтому обходим множество ещё не посещённых
+    получателей: каждый получатель либо посещается один раз, либо пропускается
+    из-за запрета, так что один поиск стоит O(N + число исключений).
+    """
+    unvisited = set(receivers)
+    parent = {}
+    queue = deque([root])
+    while queue:
+        giver_id = queue.popleft()
+        banned = forbidden[giver_id]
+        reachable = [r for r in unvisited if r not in banned]
+        for receiver_id in reachable:
+            unvisited.discard(receiver_id)
+            parent[receiver_id] = giver_id
+            owner = match_receiver.get(receiver_id)
+            if owner is None:
+                # Разворачиваем путь до корня
+                while True:
+                    giver_id = parent[receiver_id]
+                    previous = match_giver.get(giver_id)
+                    match_giver[giver_id] = receiver_id
+                    match_receiver[receiver_id] = giver_id
+                    if giver_id == root:
+                        return True
+                    receiver_id = previous
+            queue.append(owner)
+    return False
+
+
+def max_matching(user_ids: List[int], forbidden: Dict[int, Set[int]],
+                 hint: Optional[Dict[int, int]] = None) -> Dict[int, int]:
+    """
+    Максимальное паросочетание дарителей и получателей.
+    hint — прошлое паросочетание (например, до добавления исключения): из него
+    берём все ещё допустимые пары и досаживаем только оставшихся, поэтому
+    после одного нового исключения проверка стоит пару поисков O(N + исключений).
+    Без hint начинаем со сдвига по кругу (каждый дарит следующему).
+    """
+    if hint is None:
+        hint = dict(zip(user_ids, user_ids[1:] + user_ids[:1]))
+
+    members = set(user_ids)
+    match_giver: Dict[int, int] = {}
+    match_receiver: Dict[int, int] = {}
+    for giver_id, receiver_id in hint.items():
+        if (giver_id in forbidden and receiver_id in members
+                and receiver_id not in match_receiver and _allowed(forbidden, giver_id, receiver_id)):
+            match_giver[giver_id] = receiver_id
+            match_receiver[receiver_id] = giver_id
+
+    for giver_id in user_ids:
+        if giver_id not in match_giver:
+            _augment(giver_id, user_ids, forbidden, match_giver, match_receiver)
+    return match_giver
+
+
+def find_hall_violation(user_ids: List[int], forbidden: Dict[int, Set[int]],
+                        matching: Dict[int, int]) -> Optional[Tuple[List[int], List[int]]]:
+    """
+    Объяснить, почему распределения нет (условие Холла).
+    matching должно быть максимальным. Возвращает None, если все дарители
+    паросочетаны, иначе (дарители, получатели): дарители могут дарить только
+    этим получателям, а получателей меньше, чем дарителей.
+    Это дарители, достижимые чередующимися путями из непаросочетанных.
+    """
+    free = [giver_id for giver_id in user_ids if giver_id not in matching]
+    if not free:
+        return None
+
+    match_receiver = {r: g for g, r in matching.items()}
+    unvisited = set(user_ids)
+    givers = set(free)
+    receivers = set()
+    queue = deque(free)
+    while queue:
+        banned = forbidden[queue.popleft()]
+        for receiver_id in [r for r in unvisited if r not in banned]:
+            unvisited.discard(receiver_id)
+            receivers.add(receiver_id)
+            # Паросочетание максимальное, значит получатель занят
+            owner = match_receiver[receiver_id]
+            if owner not in givers:
+                givers.add(owner)
+                queue.append(owner)
+    return sorted(givers), sorted(receivers)
+
+
+def check_feasibility(user_ids: List[int], forbidden: Dict[int, Set[int]],
+                      hint: Optional[Dict[int, int]] = None
+                      ) -> Tuple[Dict[int, int], Optional[Tuple[List[int], List[int]]]]:
+    """
+    Проверить за полиномиальное время, существует ли распределение.
+    Возвращает (максимальное паросочетание, нарушение условия Холла или None).
+    """
+    matching = max_matching(user_ids, forbidden, hint)
+    return matching, find_hall_violation(user_ids, forbidden, matching)
+
+
+def can_give(exclusion_index: Dict[int, Set[int]], giver_id: int, receiver_id: int) -> bool:
+    """Может ли giver_id дарить receiver_id (не себе и без исключения между ними)"""
+    return giver_id != receiver_id and receiver_id not in exclusion_index.get(giver_id, ())
+
+
+def splice_out(giver_id: int, receiver_id: int, exclusion_index: Dict[int, Set[int]],
+               assignment: Optional[Dict[int, int]] = None,
+               rng: Optional[random.Random] = None) -> Optional[Dict[int, int]]:
+    """
+    Починить распределение после ухода участника: giver_id дарил ушедшему,
+    а ушедший дарил receiver_id. Возвращает изменённые пары (даритель -> новый
+    получатель) или None, если допустимого распределения без ушедшего нет.
+
+    1. Замыкаем цепочку: giver_id дарит receiver_id — O(1).
+    2. Иначе обмениваемся получателями с одной из остальных пар — O(k) до
+       первой подходящей.
+    3. Иначе ищем увеличивающий путь по всему распределению.
+    assignment — остальные пары без ушедшего и giver_id; нужен только для
+    шагов 2 и 3.
+    """
+    if can_give(exclusion_index, giver_id, receiver_id):
+        return {giver_id: receiver_id}
+    if not assignment:
+        return None
+
+    rng = rng or random
+    givers = list(assignment)
+    offset = rng.randrange(len(givers))
+    for i in range(len(givers)):
+        other_id = givers[(offset + i) % len(givers)]
+        theirs = assignment[other_id]
+        if can_give(exclusion_index, giver_id, theirs) and can_give(exclusion_index, other_id, receiver_id):
+            return {giver_id: theirs, other_id: receiver_id}
+
+    user_ids = givers + [giver_id]
+    forbidden = build_forbidden(user_ids, exclusion_index)
+    match_giver = dict(assignment)
+    match_receiver = {r: g for g, r in match_giver.items()}
+    if not _augment(giver_id, user_ids, forbidden, match_giver, match_receiver):
+        return None
+    return {g: r for g, r in match_giver.items() if assignment.get(g) != r}
+
+
+def find_assignment(user_ids: List[int], forbidden: Dict[int, Set[int]],
+                    rng: Optional[random.Random] = None) -> Optional[Dict[int, int]]:
+    """
+    Найти случайное допустимое распределение (даритель -> получатель).
+    Возвращает None, если распределения с учётом исключений не существует.
+
+    1. Берём случайную перестановку и чиним конфликты случайными обменами.
+    2. Оставшихся дарителей досаживаем увеличивающими путями (паросочетание);
+       если путь не найден, допустимого распределения нет.
+    3. Перемешиваем результат случайными допустимыми обменами, чтобы
+       распределение было близко к равномерному среди всех допустимых.
+    """
+    rng = rng or random
+    n = len(user_ids)
+    if n < 2:
+        return None
+
+    receivers = list(user_ids)
+    rng.shuffle(receivers)
+    assignment = dict(zip(user_ids, receivers))
+
+    # Чиним конфликты обменами получателей между двумя дарителями
+    unmatched = []
+    for giver_id in user_ids:
+        if _allowed(forbidden, giver_id, assignment[giver_id]):
+            continue
+        for _ in range(REPAIR_TRIES):
+            other_id = user_ids[rng.randrange(n)]
+            mine, theirs = assignment[giver_id], assignment[other_id]
+            if _allowed(forbidden, giver_id, theirs) and _allowed(forbidden, other_id, mine):
+                assignment[giver_id], assignment[other_id] = theirs, mine
+                break
+        else:
+            unmatched.append(giver_id)
+
+    # Не получилось — освобождаем этих дарителей и ищем увеличивающие пути
+    if unmatched:
+        for giver_id in unmatched:
+            del assignment[giver_id]
+        match_receiver = {r: g for g, r in assignment.items()}
+        for giver_id in unmatched:
+            if not _augment(giver_id, user_ids, forbidden, assignment, match_receiver):
+                return None
+
+    # Перемешивание: симметричные случайные обмены, сохраняющие допустимость
+    for _ in range(MIX_ROUNDS * n):
+        a = user_ids[rng.randrange(n)]
+        b = user_ids[rng.randrange(n)]
+        ra, rb = assignment[a], assignment[b]
+        if _allowed(forbidden, a, rb) and _allowed(forbidden, b, ra):
+            assignment[a], assignment[b] = rb, ra
+
+    return assignment
+
+
+def find_cycles(assignment: Dict[int, int]) -> List[List[int]]:
+    """Разбить распределение на цепочки (циклы) дарителей"""
+    seen = set()
+    cycles = []
+    for start in assignment:
+        if start in seen:
+            continue
+        cycle = []
+        user_id = start
+        while user_id not in seen:
+            seen.add(user_id)
+            cycle.append(user_id)
+            user_id = assignment[user_id]
+        cycles.append(cycle)
+    return cycles
+
+
+def _try_merge(assignment: Dict[int, int], forbidden: Dict[int, Set[int]],
+               first: List[int], second: List[int], rng) -> bool:
+    """
+    Слить две цепочки обменом получателей между a из first и b из second:
+    a -> σ(b), b -> σ(a) превращает два цикла в один.
+    Сначала пробуем случайные пары, потом перебираем все.
+    """
+    def swap_if_allowed(a: int, b: int) -> bool:
+        ra, rb = assignment[a], assignment[b]
+        if _allowed(forbidden, a, rb) and _allowed(forbidden, b, ra):
+            assignment[a], assignment[b] = rb, ra
+            return True
+        return False
+
+    for _ in range(MERGE_TRIES):
+        if swap_if_allowed(rng.choice(first), rng.choice(second)):
+            return True
+    return any(swap_if_allowed(a, b) for a in first for b in second)
+
+
+def merge_cycles(assignment: Dict[int, int], forbidden: Dict[int, Set[int]],
+                 rng: Optional[random.Random] = None) -> int:
+    """
+    Слить цепочки допустимого распределения в одну (на месте).
+    Каждое слияние — один обмен получателями, так что при обычной плотности
+    исключений работа почти линейна. Если одну цепочку получить нельзя,
+    оставляет как можно меньше цепочек. Возвращает их число.
+    """
+    rng = rng or random
+    cycles = sorted(find_cycles(assignment), key=len, reverse=True)
+    if not cycles:
+        return 0
+
+    main = cycles[0]
+    pending = cycles[1:]
+    # Цепочку, которую не удалось слить, пробуем снова, когда главная вырастет
+    while pending:
+        stuck = []
+        for cycle in pending:
+            if _try_merge(assignment, forbidden, main, cycle, rng):
+                main.extend(cycle)
+            else:
+                stuck.append(cycle)
+        if len(stuck) == len(pending):
+            break
+        pending = stuck
+
+    # Оставшиеся цепочки сливаем между собой, сколько получится
+    rest = []
+    for cycle in pending:
+        for other in rest:
+            if _try_merge(assignment, forbidden, other, cycle, rng):
+                other.extend(cycle)
+                break
+        else:
+            rest.append(cycle)
+    return 1 + len(rest)
+
+
+def _rotation_chain(user_ids: List[int], forbidden: Dict[int, Set[int]],
+                    rng) -> Optional[Dict[int, int]]:
+    """
+    Поиск одной цепочки (гамильтонова цикла) методом вращений Поша.
+    Исключения симметричны, поэтому граф разрешённых пар неориентированный.
+    Путь удлиняем свободным соседом конца; если такого нет, берём соседа u
+    конца внутри пути и разворачиваем хвост после u — конец меняется.
+    Для плотных графов почти всегда находит цикл за O(N) удлинений и
+    немного вращений. Возвращает None, если бюджет шагов исчерпан.
+    """
+    n = len(user_ids)
+    # Непосещённые в случайном порядке: берём с конца, обычно первый же подходит
+    unvisited = list(user_ids)
+    rng.shuffle(unvisited)
+    path = [unvisited.pop()]
+
+    for _ in range(ROTATION_STEPS * n):
+        end = path[-1]
+        banned = forbidden[end]
+        if not unvisited:
+            if path[0] not in banned:
+                return {giver_id: path[(i + 1) % n] for i, giver_id in enumerate(path)}
+        else:
+            k = next((k for k in range(len(unvisited) - 1, -1, -1) if unvisited[k] not in banned), None)
+            if k is not None:
+                unvisited[k], unvisited[-1] = unvisited[-1], unvisited[k]
+                path.append(unvisited.pop())
+                continue
+
+        # Вращение вокруг соседа конца внутри пути (кроме предыдущего)
+        if len(path) < 3:
+            return None
+        i = rng.randrange(len(path) - 2)
+        if path[i] in banned:
+            pivots = [j for j in range(len(path) - 2) if path[j] not in banned]
+            if not pivots:
+                return None  # Из конца некуда идти, и вращать нечем
+            i = rng.choice(pivots)
+        path[i + 1:] = reversed(path[i + 1:])
+    return None
+
+
+def find_chain(user_ids: List[int], forbidden: Dict[int, Set[int]],
+               rng: Optional[random.Random] = None) -> Optional[Dict[int, int]]:
+    """
+    Найти распределение одной цепочкой (все дарят по кругу, без пар
+    «дарим друг другу»). Если при исключениях это не удаётся, возвращает
+    распределение с наименьшим найденным числом цепочек; None — если
+    допустимого распределения нет вовсе.
+
+    1. Случайное распределение, цепочки которого сливаем обменами.
+    2. Если осталось несколько цепочек — поиск вращениями Поша.
+    3. Если и он не нашёл — несколько новых попыток слияния, берём лучшую.
+    """
+    rng = rng or random
+    assignment = find_assignment(user_ids, forbidden, rng)
+    if assignment is None:
+        return None
+    best_cycles = merge_cycles(assignment, forbidden, rng)
+    if best_cycles == 1:
+        return assignment
+
+    chain = _rotation_chain(user_ids, forbidden, rng)
+    if chain is not None:
+        return chain
+
+    best = assignment
+    for _ in range(CHAIN_RESTARTS):
+        assignment = find_assignment(user_ids, forbidden, rng)
+        cycles = merge_cycles(assignment, forbidden, rng)
+        if cycles < best_cycles:
+            best, best_cycles = assignment, cycles
+        if cycles == 1:
+            break
+    return best
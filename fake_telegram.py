@@ -0,0 +1,526 @@
+"""
+Локальная замена Telegram Bot API для сквозных нагрузочных тестов.
+
+Сервер реализует методы, которыми пользуется бот (getMe, deleteWebhook,
+getUpdates, sendMessage, editMessageText, answerCallbackQuery), и умеет
+отвечать 429 Too Many Requests, как настоящий Telegram. Нагрузчик
+имитирует тысячи пользователей, которые жмут /start, /menu и кнопки, и
+замеряет задержку от отправки обновления до ответа бота.
+
+Запуск (бот стартует отдельным процессом со временной базой):
+    python fake_telegram.py --users 2000 --steps 5
+    python fake_telegram.py --users 500 --rate 30 --distribute
+    python fake_telegram.py --serve-only --port 8081   # бот запускаете сами
+
+Для ручного запуска бота против сервера задайте TELEGRAM_API_URL=http://127.0.0.1:8081.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+from benchmark import summarize
+
+
+# Адрес и порт сервера по умолчанию
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8081
+
+# Токен, с которым запускается бот в тесте
+TEST_TOKEN = '123456:FAKE-TOKEN'
+
+# Первый ID виртуального пользователя (он же админ основной игры)
+FIRST_USER_ID = 1_000_000
+
+# Сколько секунд ждем ответа бота на одно действие
+STEP_TIMEOUT = 30.0
+
+# Кнопки, которые нагрузчик не нажимает: они меняют данные или ждут ввода текста
+SKIPPED_BUTTONS = ('edit_wishlist', 'leave_game', 'confirm_leave', 'distribute',
+                   'confirm_distribute_', 'remove_user_', 'exclude_', 'remove_exclusion_')
+
+# Сколько раз админ пробует открыть подтверждение раздачи (ответ бота мог упереться в лимит)
+DISTRIBUTE_ATTEMPTS = 5
+
+# Пауза между попытками в секундах
+DISTRIBUTE_RETRY_DELAY = 1.0
+
+# Методы, к которым применяются лимиты на отправку
+LIMITED_METHODS = ('sendMessage', 'editMessageText')
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Santa', 'username': 'santa_test_bot'}
+
+
+class FakeTelegram:
+    """
+    Состояние поддельного Bot API: очередь обновлений, сообщения в чатах
+    и лимиты отправки. Лимиты выключены, пока rate и chat_interval равны 0.
+    """
+
+    def __init__(self, rate: float = 0, chat_interval: float = 0):
+        self.rate = rate
+        self.chat_interval = chat_interval
+        self._lock = threading.Lock()
+        self._updates_ready = threading.Condition(self._lock)
+        self._updates: List[dict] = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._query_ids = itertools.count(1)
+        # chat_id -> {message_id: сообщение}
+        self._messages: Dict[int, Dict[int, dict]] = {}
+        # Ведро токенов общего лимита и моменты, когда чат снова доступен
+        self._tokens = float(rate)
+        self._tokens_updated = time.monotonic()
+        self._chat_ready: Dict[int, float] = {}
+        self.calls: Dict[str, int] = {}
+        self.floods = 0
+        self.polling = threading.Event()
+        # Обработчик ответов бота: (chat_id, сообщение), вызывается из потока сервера
+        self.on_reply = None
+
+    # --- Со стороны пользователей ---
+
+    def push_message(self, user: dict, text: str):
+        """Пользователь пишет боту"""
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user['id'], 'type': 'private', 'first_name': user['first_name']},
+            'from': user,
+            'text': text,
+        }
+        if text.startswith('/'):
+            command = text.split()[0]
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        self._push({'message': message})
+
+    def press_button(self, user: dict, message: dict, data: str):
+        """Пользователь нажимает кнопку под сообщением бота"""
+        self._push({'callback_query': {
+            'id': str(next(self._query_ids)),
+            'from': user,
+            'chat_instance': str(user['id']),
+            'message': message,
+            'data': data,
+        }})
+
+    def _push(self, update: dict):
+        with self._lock:
+            update['update_id'] = next(self._update_ids)
+            self._updates.append(update)
+            self._updates_ready.notify_all()
+
+    def keyboard_message(self, chat_id: int) -> Optional[dict]:
+        """Последнее сообщение бота с кнопками в чате"""
+        with self._lock:
+            for message in reversed(list(self._messages.get(chat_id, {}).values())):
+                if message.get('reply_markup'):
+                    return dict(message)
+        return None
+
+    # --- Со стороны бота ---
+
+    def call(self, method: str, params: dict) -> Tuple[int, dict]:
+        """Выполнить метод Bot API, вернуть (HTTP-статус, ответ)"""
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        handler = getattr(self, f'_api_{method}', None)
+        if handler is None:
+            return 404, {'ok': False, 'error_code': 404, 'description': 'Not Found: method not found'}
+
+        if method in LIMITED_METHODS:
+            retry_after = self._throttle(int(params.get('chat_id', 0)))
+            if retry_after:
+                return 429, {
+                    'ok': False,
+                    'error_code': 429,
+                    'description': f'Too Many Requests: retry after {retry_after}',
+                    'parameters': {'retry_after': retry_after},
+                }
+        try:
+            return 200, {'ok': True, 'result': handler(params)}
+        except LookupError as e:
+            return 400, {'ok': False, 'error_code': 400, 'description': f'Bad Request: {e}'}
+
+    def _throttle(self, chat_id: int) -> int:
+        """0, если отправку можно выполнить, иначе сколько секунд ждать"""
+        with self._lock:
+            now = time.monotonic()
+            wait = 0.0
+            if self.rate:
+                self._tokens = min(self.rate, self._tokens + (now - self._tokens_updated) * self.rate)
+                self._tokens_updated = now
+                if self._tokens < 1:
+                    wait = (1 - self._tokens) / self.rate
+            if self.chat_interval:
+                wait = max(wait, self._chat_ready.get(chat_id, 0.0) - now)
+            if wait > 0:
+                self.floods += 1
+                return math.ceil(wait)
+            if self.rate:
+                self._tokens -= 1
+            if self.chat_interval:
+                self._chat_ready[chat_id] = now + self.chat_interval
+            return 0
+
+    def _api_getMe(self, params: dict) -> dict:
+        return BOT_USER
+
+    def _api_deleteWebhook(self, params: dict) -> bool:
+        return True
+
+    def _api_getUpdates(self, params: dict) -> List[dict]:
+        self.polling.set()
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        deadline = time.monotonic() + float(params.get('timeout') or 0)
+        with self._updates_ready:
+            # Обновления до offset бот уже получил
+            self._updates = [u for u in self._updates if u['update_id'] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._updates_ready.wait(deadline - time.monotonic())
+            return self._updates[:limit]
+
+    def _api_sendMessage(self, params: dict) -> dict:
+        chat_id = int(params['chat_id'])
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+            'text': str(params['text']),
+        }
+        if params.get('reply_markup'):
+            message['reply_markup'] = params['reply_markup']
+        with self._lock:
+            self._messages.setdefault(chat_id, {})[message['message_id']] = message
+        self._reply(chat_id, message)
+        return message
+
+    def _api_editMessageText(self, params: dict) -> dict:
+        chat_id = int(params['chat_id'])
+        with self._lock:
+            message = self._messages.get(chat_id, {}).get(int(params['message_id']))
+            if message is None:
+                raise LookupError('message to edit not found')
+            message['text'] = str(params['text'])
+            message['edit_date'] = int(time.time())
+            if params.get('reply_markup'):
+                message['reply_markup'] = params['reply_markup']
+            else:
+                message.pop('reply_markup', None)
+            message = dict(message)
+        self._reply(chat_id, message)
+        return message
+
+    def _api_answerCallbackQuery(self, params: dict) -> bool:
+        return True
+
+    def _reply(self, chat_id: int, message: dict):
+        if self.on_reply is not None:
+            self.on_reply(chat_id, message)
+
+
+def parse_params(body: bytes, content_type: str) -> dict:
+    """
+    Параметры запроса. Бот шлет их формой, где сложные значения
+    (reply_markup и т.п.) закодированы в JSON.
+    """
+    if not body:
+        return {}
+    if content_type.startswith('application/json'):
+        return json.loads(body)
+    params = {}
+    for key, value in parse_qsl(body.decode('utf-8'), keep_blank_values=True):
+        try:
+            decoded = json.loads(value)
+        except ValueError:
+            decoded = value
+        params[key] = decoded if isinstance(decoded, (dict, list, int, float, bool)) else value
+    return params
+
+
+def make_server(api: FakeTelegram, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT) -> ThreadingHTTPServer:
+    """HTTP-сервер с адресами вида /bot<токен>/<метод>"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self._handle(self.rfile.read(int(self.headers.get('Content-Length') or 0)))
+
+        def do_GET(self):
+            self._handle(b'')
+
+        def _handle(self, body: bytes):
+            parts = self.path.split('?')[0].strip('/').split('/')
+            if len(parts) != 2 or not parts[0].startswith('bot'):
+                status, payload = 404, {'ok': False, 'error_code': 404, 'description': 'Not Found'}
+            else:
+                params = parse_params(body, self.headers.get('Content-Type', ''))
+                if '?' in self.path:
+                    params.update(parse_qsl(self.path.split('?', 1)[1]))
+                status, payload = api.call(parts[1], params)
+            data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass  # Тысячи запросов в секунду в консоли не нужны
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    return server
+
+
+class LoadDriver:
+    """
+    Виртуальные пользователи: каждый пишет /start, /menu и затем нажимает
+    случайные кнопки, дожидаясь ответа бота перед следующим действием.
+    """
+
+    def __init__(self, api: FakeTelegram, users: int, steps: int, think: float = 0.0,
+                 timeout: float = STEP_TIMEOUT, seed: int = 0):
+        self.api = api
+        self.users = [
+            {'id': FIRST_USER_ID + i, 'is_bot': False, 'first_name': f'Гость{i}', 'username': f'guest{i}'}
+            for i in range(users)
+        ]
+        self.steps = steps
+        self.think = think
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+        # Задержки по видам действий: '/start', '/menu', 'button'
+        self.latencies: Dict[str, List[float]] = {}
+        self.timeouts = 0
+        self._waiters: Dict[int, asyncio.Future] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._notified: Dict[int, float] = {}
+        self._watch_since: Optional[float] = None
+
+    def _on_reply(self, chat_id: int, message: dict):
+        # Вызывается из потока HTTP-сервера; после замера бот еще может дописывать
+        # прогресс рассылки, а цикл событий уже закрыт
+        if not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._resolve, chat_id, message)
+
+    def _resolve(self, chat_id: int, message: dict):
+        if self._watch_since is not None and chat_id not in self._notified and 'edit_date' not in message:
+            self._notified[chat_id] = time.perf_counter()
+        waiter = self._waiters.pop(chat_id, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(message)
+
+    async def _act(self, user: dict, kind: str, send) -> bool:
+        """Выполнить действие и дождаться ответа бота в чат"""
+        waiter = self._loop.create_future()
+        self._waiters[user['id']] = waiter
+        start = time.perf_counter()
+        send()
+        try:
+            await asyncio.wait_for(waiter, self.timeout)
+        except asyncio.TimeoutError:
+            self._waiters.pop(user['id'], None)
+            self.timeouts += 1
+            return False
+        self.latencies.setdefault(kind, []).append(time.perf_counter() - start)
+        if self.think:
+            await asyncio.sleep(self.rng.uniform(0, 2 * self.think))
+        return True
+
+    async def _user_session(self, user: dict):
+        if not await self._act(user, '/start', lambda: self.api.push_message(user, '/start')):
+            return
+        if not await self._act(user, '/menu', lambda: self.api.push_message(user, '/menu')):
+            return
+        for _ in range(self.steps):
+            message = self.api.keyboard_message(user['id'])
+            buttons = [
+                button['callback_data']
+                for row in (message or {}).get('reply_markup', {}).get('inline_keyboard', [])
+                for button in row
+                if not button.get('callback_data', '').startswith(SKIPPED_BUTTONS)
+            ]
+            if not buttons:
+                if not await self._act(user, '/menu', lambda: self.api.push_message(user, '/menu')):
+                    return
+                continue
+            data = self.rng.choice(buttons)
+            if not await self._act(user, 'button', lambda: self.api.press_button(user, message, data)):
+                return
+
+    async def run(self) -> Dict:
+        """Прогнать всех пользователей одновременно"""
+        self._loop = asyncio.get_running_loop()
+        self.api.on_reply = self._on_reply
+        start = time.perf_counter()
+        await asyncio.gather(*(self._user_session(user) for user in self.users))
+        elapsed = time.perf_counter() - start
+        actions = sum(len(samples) for samples in self.latencies.values())
+        return {
+            'users': len(self.users),
+            'actions': actions,
+            'timeouts': self.timeouts,
+            'elapsed_s': elapsed,
+            'throughput_per_s': actions / elapsed if elapsed else None,
+            'latency': {kind: summarize(samples) for kind, samples in self.latencies.items()},
+            'latency_all': summarize([s for samples in self.latencies.values() for s in samples]) if actions else None,
+        }
+
+    @staticmethod
+    def _find_button(message: Optional[dict], prefix: str) -> Optional[str]:
+        """callback_data первой кнопки сообщения, начинающейся с prefix"""
+        for row in (message or {}).get('reply_markup', {}).get('inline_keyboard', []):
+            for button in row:
+                if button.get('callback_data', '').startswith(prefix):
+                    return button['callback_data']
+        return None
+
+    async def distribute(self, timeout: float) -> Dict:
+        """Админ раздает роли; ждем, пока сообщение о получателе придет всем"""
+        admin = self.users[0]
+        # Раздача начинается с подтверждения. Если бот не смог его показать
+        # (например, получил 429 на редактирование), нажимаем «Раздать» снова
+        confirm = message = None
+        for attempt in range(DISTRIBUTE_ATTEMPTS):
+            if attempt:
+                await asyncio.sleep(DISTRIBUTE_RETRY_DELAY)
+            await self._act(admin, '/menu', lambda: self.api.push_message(admin, '/menu'))
+            message = self.api.keyboard_message(admin['id'])
+            if self._find_button(message, 'distribute') is None:
+                continue
+            await self._act(admin, 'button', lambda: self.api.press_button(admin, message, 'distribute'))
+            message = self.api.keyboard_message(admin['id'])
+            confirm = self._find_button(message, 'confirm_distribute_')
+            if confirm is not None:
+                break
+        if confirm is None:
+            self.timeouts += 1
+            return {
+                'participants': len(self.users),
+                'notified': 0,
+                'error': f"бот не показал подтверждение раздачи за {DISTRIBUTE_ATTEMPTS} попыток",
+            }
+
+        self._notified = {}
+        self._watch_since = start = time.perf_counter()
+        self.api.press_button(admin, message, confirm)
+        deadline = start + timeout
+        while len(self._notified) < len(self.users) and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        self._watch_since = None
+        arrivals = sorted(t - start for t in self._notified.values())
+        return {
+            'participants': len(self.users),
+            'notified': len(arrivals),
+            'elapsed_s': arrivals[-1] if arrivals else None,
+            'messages_per_s': len(arrivals) / arrivals[-1] if arrivals else None,
+            'arrival': summarize(arrivals) if arrivals else None,
+        }
+
+
+def start_bot(api_url: str, workdir: str) -> subprocess.Popen:
+    """Запустить bot.py против поддельного API со временной базой в workdir"""
+    env = dict(
+        os.environ,
+        BOT_TOKEN=TEST_TOKEN,
+        ADMIN_ID=str(FIRST_USER_ID),
+        TELEGRAM_API_URL=api_url,
+        WEBHOOK_URL='',
+    )
+    bot_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')
+    log = open(os.path.join(workdir, 'bot.log'), 'wb')
+    return subprocess.Popen([sys.executable, bot_path], cwd=workdir, env=env,
+                            stdout=log, stderr=subprocess.STDOUT)
+
+
+def stop_bot(process: subprocess.Popen):
+    """Остановить бота так же, как Ctrl+C"""
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Поддельный Telegram Bot API и нагрузчик")
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--users', type=int, default=1000, help="число виртуальных пользователей")
+    parser.add_argument('--steps', type=int, default=5, help="нажатий кнопок на пользователя")
+    parser.add_argument('--think', type=float, default=0.0,
+                        help="средняя пауза пользователя между действиями в секундах")
+    parser.add_argument('--rate', type=float, default=0,
+                        help="общий лимит отправок в секунду, выше — 429 (0 — без лимита)")
+    parser.add_argument('--chat-interval', type=float, default=0,
+                        help="минимальный интервал между сообщениями в один чат (0 — без лимита)")
+    parser.add_argument('--distribute', action='store_true',
+                        help="в конце раздать роли и замерить доставку уведомлений")
+    parser.add_argument('--distribute-timeout', type=float, default=600.0)
+    parser.add_argument('--serve-only', action='store_true',
+                        help="только поднять сервер (бота и нагрузку запускаете сами)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="файл для JSON с результатами (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    api = FakeTelegram(rate=args.rate, chat_interval=args.chat_interval)
+    server = make_server(api, args.host, args.port)
+    api_url = f"http://{args.host}:{server.server_address[1]}"
+    if args.serve_only:
+        print(f"Поддельный Bot API слушает {api_url}", file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    with tempfile.TemporaryDirectory() as workdir:
+        bot = start_bot(api_url, workdir)
+        try:
+            if not api.polling.wait(30):
+                with open(os.path.join(workdir, 'bot.log'), encoding='utf-8', errors='replace') as f:
+                    print(f.read()[-2000:], file=sys.stderr)
+                sys.exit("Бот не начал опрашивать сервер за 30 секунд")
+
+            driver = LoadDriver(api, args.users, args.steps, args.think, seed=args.seed)
+
+            async def scenario():
+                result = {'load': await driver.run()}
+                if args.distribute:
+                    result['distribute'] = await driver.distribute(args.distribute_timeout)
+                return result
+
+            report = asyncio.run(scenario())
+            api.on_reply = None
+        finally:
+            stop_bot(bot)
+            server.shutdown()
+
+    report['api'] = {'calls': api.calls, 'floods': api.floods,
+                     'rate': args.rate or None, 'chat_interval': args.chat_interval or None}
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+# Границы корзин гистограмм задержек в секундах
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Сколько строк показываем в каждом разделе /stats
+STATS_TOP = 10
+
+
+def _escape(value) -> str:
+    """Экранировать значение метки"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    """Метки в формате Prometheus: {name="value",...}"""
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """Счётчик с метками; безопасен для вызова из разных потоков"""
+
+    def __init__(self, name: str, help_text: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def values(self) -> Dict[Tuple[str, ...], float]:
+        with self._lock:
+            return dict(self._values)
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for key, value in sorted(self.values().items()):
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {value:g}')
+        return lines
+
+
+class Histogram:
+    """Гистограмма с метками: число наблюдений, сумма и накопленные корзины"""
+
+    def __init__(self, name: str, help_text: str, labelnames: Iterable[str] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # метки -> [счётчики корзин..., +Inf], сумма
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Замерить время выполнения блока"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> Dict[Tuple[str, ...], Tuple[List[int], float]]:
+        with self._lock:
+            return {key: (counts[:], total) for key, (counts, total) in self._values.items()}
+
+    def percentile(self, counts: List[int], q: float) -> float:
+        """Оценка перцентиля сверху: граница корзины, в которую он попал"""
+        target = q * sum(counts)
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float('inf')
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for key, (counts, total) in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound:g}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {total:.6f}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Registry:
+    """Набор метрик процесса"""
+
+    def __init__(self):
+        self._metrics: List = []
+
+    def counter(self, name: str, help_text: str, labelnames: Iterable[str] = ()) -> Counter:
+        metric = Counter(name, help_text, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, labelnames: Iterable[str] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help_text, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+HANDLER_SECONDS = REGISTRY.histogram(
+    'santa_handler_seconds', 'Время обработки обновления', ['handler'])
+DB_QUERY_SECONDS = REGISTRY.histogram(
+    'santa_db_query_seconds', 'Время выполнения метода Database', ['method'])
+DB_WAIT_SECONDS = REGISTRY.histogram(
+    'santa_db_wait_seconds', 'Ожидание свободного потока базы данных')
+SEND_MESSAGES = REGISTRY.counter(
+    'santa_send_messages_total', 'Отправленные и неотправленные сообщения', ['result'])
+SEND_RETRIES = REGISTRY.counter(
+    'santa_send_retries_total', 'Повторы отправки сообщений', ['reason'])
+
+
+def timed_handler(name: str):
+    """Декоратор: замерять время асинхронного обработчика"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with HANDLER_SECONDS.time(handler=name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _histogram_lines(histogram: Histogram, title: str) -> List[str]:
+    rows = []
+    for key, (counts, total) in histogram.snapshot().items():
+        count = sum(counts)
+        if count:
+            rows.append((total, key[0] if key else '', count, histogram.percentile(counts, 0.95)))
+    if not rows:
+        return []
+    lines = [title]
+    for total, label, count, p95 in sorted(rows, reverse=True)[:STATS_TOP]:
+        lines.append(f"• {label}: {count} шт., в среднем {total / count * 1000:.1f} мс, "
+                     f"p95 ≤ {p95 * 1000:g} мс, всего {total:.2f} с")
+    return lines + ['']
+
+
+def render_summary() -> str:
+    """Краткая сводка для команды /stats"""
+    lines = ["📈 Статистика бота", ""]
+    lines += _histogram_lines(HANDLER_SECONDS, "⏱ Обработчики (по суммарному времени):")
+    lines += _histogram_lines(DB_QUERY_SECONDS, "🗄 Запросы к базе:")
+
+    wait = DB_WAIT_SECONDS.snapshot().get(())
+    if wait and sum(wait[0]):
+        lines.append(f"⌛ Ожидание потока базы: p95 ≤ {DB_WAIT_SECONDS.percentile(wait[0], 0.95) * 1000:g} мс")
+        lines.append("")
+
+    sends = {key[0]: value for key, value in SEND_MESSAGES.values().items()}
+    retries = {key[0]: value for key, value in SEND_RETRIES.values().items()}
+    lines.append("📤 Отправка сообщений:")
+    lines.append(f"• отправлено: {sends.get('sent', 0):g}, ошибок: {sends.get('failed', 0):g}")
+    lines.append(f"• повторов: флуд-контроль {retries.get('flood', 0):g}, сеть {retries.get('network', 0):g}")
+    return '\n'.join(lines)
+
+
+def start_http_server(port: int, host: str = '0.0.0.0') -> Optional[ThreadingHTTPServer]:
+    """Отдавать метрики в формате Prometheus на http://host:port/metrics"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            data = REGISTRY.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    try:
+        server = ThreadingHTTPServer((host, port), Handler)
+    except OSError as e:
+        logger.error(f"Не удалось открыть порт метрик {port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return server
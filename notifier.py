@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+# Как часто (в секундах) проверяем, не пора ли отправить уведомления
+CHECK_INTERVAL = 5.0
+
+# Сколько уведомлений обрабатываем одной транзакцией
+BATCH_SIZE = 100
+
+# Пакет outbox, в который попадают уведомления
+OUTBOX_BATCH = 'wishlist'
+
+
+def wishlist_update_message(receiver_full_name: str, wishlist: str) -> str:
+    """Сообщение дарителю об изменении вишлиста получателя"""
+    text = f"🔔 Обновление вишлиста!\n\n"
+    text += f"Получатель {receiver_full_name} обновил свой вишлист:\n\n"
+    text += f"{wishlist}"
+    return text
+
+
+class WishlistNotifier:
+    """
+    Отложенные уведомления дарителям об изменении вишлиста.
+    Database.update_wishlist(..., notify_at=...) записывает срок уведомления
+    в таблицу wishlist_notifications, и каждая следующая правка его
+    переносит. Когда срок наступает, дарителю уходит одно сообщение
+    с последней версией вишлиста. Сроки хранятся в базе, поэтому
+    после перезапуска уведомления не теряются.
+    """
+
+    def __init__(self, db, outbox_worker, check_interval: float = CHECK_INTERVAL,
+                 batch_size: int = BATCH_SIZE):
+        self.db = db
+        self.outbox_worker = outbox_worker
+        self.check_interval = check_interval
+        self.batch_size = batch_size
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Запустить фоновую проверку"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановить проверку (несработавшие уведомления останутся в базе)"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                processed = await self.db.run(self.flush_due)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка отправки уведомлений о вишлистах: {e}")
+                processed = 0
+
+            # Будим доставку здесь, в цикле событий: flush_due работает в потоке базы
+            if processed:
+                self.outbox_worker.wake()
+            # Полная пачка — возможно, ждут еще; иначе спим до следующей проверки
+            if processed < self.batch_size:
+                await asyncio.sleep(self.check_interval)
+
+    def flush_due(self, now: float = None) -> int:
+        """
+        Поставить в outbox уведомления, срок которых наступил.
+        Выполняется в потоке базы одной транзакцией. Возвращает число
+        обработанных уведомлений (включая те, которым некому уходить).
+        """
+        database = self.db.sync
+        now = time.time() if now is None else now
+        with database.transaction():
+            due = database.pop_due_wishlist_notifications(now, self.batch_size)
+            messages = []
+            for game_id, receiver_id in due:
+                # Дарителя ищем сейчас: роли могли раздать или поменять после правки
+                giver_id = database.get_giver_by_receiver(game_id, receiver_id)
+                receiver = database.get_user(game_id, receiver_id)
+                wishlist = database.get_wishlist(game_id, receiver_id)
+                if giver_id is None or receiver is None or not wishlist:
+                    continue
+                # Структура: user_id, username, first_name, last_name, registered_at
+                _, _, first_name, last_name, _ = receiver
+                name = f"{first_name} {last_name or ''}".strip()
+                messages.append((giver_id, wishlist_update_message(name, wishlist)))
+            database.enqueue_messages(messages, OUTBOX_BATCH)
+
+        if messages:
+            logger.info(f"Уведомлений об обновлении вишлиста поставлено в очередь: {len(messages)}")
+        return len(due)
@@ -0,0 +1,96 @@
+import asyncio
+import logging
+from typing import Optional
+
+from broadcast import Broadcaster
+
+logger = logging.getLogger(__name__)
+
+
+# Сколько сообщений забираем из очереди за раз
+BATCH_SIZE = 100
+
+# Как часто (в секундах) проверяем очередь, если нас не будили
+IDLE_INTERVAL = 5.0
+
+
+class OutboxWorker:
+    """
+    Фоновая доставка сообщений из таблицы outbox.
+    Забирает пачку неотправленных сообщений (статус 'sending'), отправляет
+    их через Broadcaster и отмечает результат всей пачки одной транзакцией.
+    После перезапуска продолжает с неотправленных, а сообщения, которые
+    отправлялись в момент падения, отмечает 'unknown' и не отправляет повторно.
+    """
+
+    def __init__(self, db, broadcaster: Broadcaster, batch_size: int = BATCH_SIZE,
+                 idle_interval: float = IDLE_INTERVAL):
+        self.db = db
+        self.broadcaster = broadcaster
+        self.batch_size = batch_size
+        self.idle_interval = idle_interval
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, bot):
+        """Запустить фоновую доставку"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(bot))
+
+    async def stop(self):
+        """Остановить доставку (неотправленное останется в очереди)"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def wake(self):
+        """Сообщить, что в очереди появились новые сообщения"""
+        self._wakeup.set()
+
+    async def _run(self, bot):
+        try:
+            unknown = await self.db.recover_sending_messages()
+        except Exception as e:
+            logger.error(f"Не удалось разобрать прерванную отправку: {e}")
+        else:
+            if unknown:
+                logger.warning(f"Неизвестно, дошли ли сообщения прерванной отправки: {unknown}")
+
+        while True:
+            try:
+                delivered = await self.drain_batch(bot)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка доставки сообщений из очереди: {e}")
+                delivered = 0
+
+            if delivered == 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.idle_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+
+    async def drain_batch(self, bot) -> int:
+        """Отправить одну пачку сообщений. Возвращает размер пачки."""
+        batch = await self.db.claim_pending_messages(self.batch_size)
+        results = await asyncio.gather(
+            *(self.broadcaster.send(bot, chat_id, text) for _, chat_id, text in batch),
+            return_exceptions=True
+        )
+
+        statuses = []
+        for (message_id, chat_id, _), ok in zip(batch, results):
+            if isinstance(ok, BaseException):
+                # Отправка могла и пройти: повторять не будем
+                logger.error(f"Ошибка отправки сообщения в {chat_id}: {ok}")
+                statuses.append((message_id, 'unknown'))
+            else:
+                statuses.append((message_id, 'sent' if ok else 'failed'))
+        await self.db.mark_messages(statuses)
+        return len(batch)
@@ -0,0 +1,130 @@
+import asyncio
+import json
+import logging
+import pickle
+from typing import Dict, Optional, Tuple
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+
+# Виды записей в таблице bot_state
+USER_DATA = 'user_data'
+CHAT_DATA = 'chat_data'
+BOT_DATA = 'bot_data'
+CALLBACK_DATA = 'callback_data'
+CONVERSATION = 'conversation:{}'
+
+
+def _dump(value) -> bytes:
+    return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+class SqlitePersistence(BasePersistence):
+    """
+    Хранение состояния python-telegram-bot в той же базе, что и игры
+    (таблица bot_state): диалоги ConversationHandler, user_data, chat_data,
+    bot_data.
+
+    Application раз в update_interval секунд передаёт только изменившиеся
+    записи. Они копятся в буфере и записываются одной транзакцией за цикл,
+    а не отдельным файлом на каждое обновление. При остановке бота буфер
+    записывается целиком, поэтому перезапуск не выбрасывает пользователей
+    посреди редактирования вишлиста.
+    """
+
+    def __init__(self, db, store_data: PersistenceInput = None, update_interval: float = 60):
+        # В личных чатах chat_id совпадает с user_id, поэтому chat_data по умолчанию не храним
+        super().__init__(
+            store_data=store_data or PersistenceInput(chat_data=False),
+            update_interval=update_interval,
+        )
+        self.db = db
+        # (вид, ключ) -> сериализованное значение или None (удалить)
+        self._pending: Dict[Tuple[str, str], Optional[bytes]] = {}
+        self._write_task: Optional[asyncio.Task] = None
+
+    async def _load(self, kind: str) -> Dict[str, object]:
+        rows = await self.db.get_bot_state(kind)
+        return {key: pickle.loads(value) for key, value in rows}
+
+    async def _store(self, kind: str, key: str, value: Optional[bytes]):
+        """Положить запись в буфер и дождаться записи буфера в базу"""
+        self._pending[(kind, key)] = value
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.ensure_future(self._write())
+        await asyncio.shield(self._write_task)
+
+    async def _write(self):
+        # Application вызывает update_* одного цикла одновременно (asyncio.gather):
+        # уступаем цикл событий, чтобы они успели попасть в этот же буфер
+        await asyncio.sleep(0)
+        while self._pending:
+            pending, self._pending = self._pending, {}
+            try:
+                await self.db.save_bot_state(
+                    (kind, key, value) for (kind, key), value in pending.items()
+                )
+            except Exception:
+                # Не теряем несохранённое: запишем вместе со следующим циклом
+                for item, value in pending.items():
+                    self._pending.setdefault(item, value)
+                raise
+            logger.debug(f"Состояние бота сохранено: {len(pending)} записей")
+
+    async def get_user_data(self) -> Dict[int, dict]:
+        return {int(key): value for key, value in (await self._load(USER_DATA)).items()}
+
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return {int(key): value for key, value in (await self._load(CHAT_DATA)).items()}
+
+    async def get_bot_data(self) -> dict:
+        return (await self._load(BOT_DATA)).get('', {})
+
+    async def get_callback_data(self):
+        return (await self._load(CALLBACK_DATA)).get('')
+
+    async def get_conversations(self, name: str) -> Dict[Tuple, object]:
+        states = await self._load(CONVERSATION.format(name))
+        return {tuple(json.loads(key)): state for key, state in states.items()}
+
+    async def update_user_data(self, user_id: int, data: dict):
+        # Пустые словари не храним: у большинства участников user_data не используется
+        await self._store(USER_DATA, str(user_id), _dump(data) if data else None)
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        await self._store(CHAT_DATA, str(chat_id), _dump(data) if data else None)
+
+    async def update_bot_data(self, data: dict):
+        await self._store(BOT_DATA, '', _dump(data))
+
+    async def update_callback_data(self, data):
+        await self._store(CALLBACK_DATA, '', _dump(data))
+
+    async def update_conversation(self, name: str, key: Tuple, new_state: Optional[object]):
+        # Завершённый диалог (None) удаляем
+        value = _dump(new_state) if new_state is not None else None
+        await self._store(CONVERSATION.format(name), json.dumps(list(key)), value)
+
+    async def drop_user_data(self, user_id: int):
+        await self._store(USER_DATA, str(user_id), None)
+
+    async def drop_chat_data(self, chat_id: int):
+        await self._store(CHAT_DATA, str(chat_id), None)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        """Данные меняет только этот процесс — перечитывать нечего"""
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        """Данные меняет только этот процесс — перечитывать нечего"""
+
+    async def refresh_bot_data(self, bot_data: dict):
+        """Данные меняет только этот процесс — перечитывать нечего"""
+
+    async def flush(self):
+        """Записать всё, что осталось в буфере (вызывается при остановке бота)"""
+        if self._pending or (self._write_task is not None and not self._write_task.done()):
+            if self._write_task is None or self._write_task.done():
+                self._write_task = asyncio.ensure_future(self._write())
+            await self._write_task
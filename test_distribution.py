@@ -0,0 +1,200 @@
+"""
+Тесты распределения ролей: сверяем решатель с полным перебором на маленьких играх.
+
+Запуск:
+    python -m pytest test_distribution.py
+"""
+import random
+from itertools import permutations
+from typing import Dict, List, Optional, Set, Tuple
+
+import pytest
+
+from distribution import (
+    build_forbidden, check_feasibility, find_assignment, find_chain,
+    find_cycles, find_hall_violation, max_matching, merge_cycles, splice_out,
+)
+
+
+# Сколько случайных игр проверяем на каждый размер
+INSTANCES = 150
+
+# Размеры игр, для которых перебор всех перестановок еще быстрый
+SIZES = range(2, 8)
+
+
+def random_game(n: int, rng: random.Random) -> Tuple[List[int], Dict[int, Set[int]]]:
+    """Участники и двусторонний индекс исключений случайной плотности"""
+    user_ids = rng.sample(range(100, 1000), n)
+    density = rng.random()
+    index: Dict[int, Set[int]] = {}
+    for i, a in enumerate(user_ids):
+        for b in user_ids[i + 1:]:
+            if rng.random() < density:
+                index.setdefault(a, set()).add(b)
+                index.setdefault(b, set()).add(a)
+    return user_ids, index
+
+
+def games():
+    """Все случайные игры теста: (n, участники, исключения)"""
+    rng = random.Random(2024)
+    for n in SIZES:
+        for _ in range(INSTANCES):
+            yield (n, *random_game(n, rng))
+
+
+def brute_force(user_ids: List[int], forbidden: Dict[int, Set[int]]) -> Optional[Dict[int, int]]:
+    """Первое допустимое распределение полным перебором"""
+    for receivers in permutations(user_ids):
+        if all(r not in forbidden[g] for g, r in zip(user_ids, receivers)):
+            return dict(zip(user_ids, receivers))
+    return None
+
+
+def has_chain(user_ids: List[int], forbidden: Dict[int, Set[int]]) -> bool:
+    """Есть ли распределение одной цепочкой (перебор циклов из первого участника)"""
+    first, rest = user_ids[0], user_ids[1:]
+    for order in permutations(rest):
+        cycle = (first, *order)
+        if all(cycle[(i + 1) % len(cycle)] not in forbidden[g] for i, g in enumerate(cycle)):
+            return True
+    return False
+
+
+def assert_valid(assignment: Dict[int, int], user_ids: List[int], forbidden: Dict[int, Set[int]]):
+    """Каждый дарит ровно одному, каждый получает ровно один подарок, запретов нет"""
+    assert sorted(assignment) == sorted(user_ids)
+    assert sorted(assignment.values()) == sorted(user_ids)
+    for giver_id, receiver_id in assignment.items():
+        assert receiver_id not in forbidden[giver_id]
+
+
+def test_build_forbidden_includes_self():
+    forbidden = build_forbidden([1, 2, 3], {1: {2}, 2: {1}})
+    assert forbidden == {1: {1, 2}, 2: {1, 2}, 3: {3}}
+
+
+def test_find_assignment_needs_two_participants():
+    assert find_assignment([1], build_forbidden([1], {})) is None
+    assert find_assignment([], {}) is None
+
+
+@pytest.mark.parametrize('n, user_ids, index', list(games()))
+def test_find_assignment_matches_brute_force(n, user_ids, index):
+    forbidden = build_forbidden(user_ids, index)
+    assignment = find_assignment(user_ids, forbidden, random.Random(n))
+    if brute_force(user_ids, forbidden) is None:
+        assert assignment is None
+    else:
+        assert assignment is not None
+        assert_valid(assignment, user_ids, forbidden)
+
+
+@pytest.mark.parametrize('n, user_ids, index', list(games()))
+def test_feasibility_verdict_and_hall_witness(n, user_ids, index):
+    forbidden = build_forbidden(user_ids, index)
+    matching, violation = check_feasibility(user_ids, forbidden)
+    exists = brute_force(user_ids, forbidden) is not None
+    assert (violation is None) == exists
+
+    # Паросочетание допустимо: разные получатели, без запретов
+    assert len(set(matching.values())) == len(matching)
+    assert all(r not in forbidden[g] for g, r in matching.items())
+    if exists:
+        assert len(matching) == n
+        return
+
+    # Свидетель Холла: дарители могут дарить только этим получателям, и их меньше
+    givers, receivers = violation
+    assert len(receivers) < len(givers)
+    reachable = {r for g in givers for r in user_ids if r not in forbidden[g]}
+    assert reachable <= set(receivers)
+
+
+def test_max_matching_repairs_stale_hint():
+    user_ids = [1, 2, 3, 4]
+    forbidden = build_forbidden(user_ids, {1: {2}, 2: {1}})
+    # Подсказка из прошлого паросочетания: пара 1 -> 2 теперь запрещена
+    matching = max_matching(user_ids, forbidden, hint={1: 2, 2: 3, 3: 4, 4: 1})
+    assert_valid(matching, user_ids, forbidden)
+
+
+def test_hall_violation_none_for_perfect_matching():
+    user_ids = [1, 2, 3]
+    forbidden = build_forbidden(user_ids, {})
+    assert find_hall_violation(user_ids, forbidden, {1: 2, 2: 3, 3: 1}) is None
+
+
+def test_hall_violation_nobody_to_give():
+    user_ids = [1, 2, 3]
+    forbidden = build_forbidden(user_ids, {1: {2, 3}, 2: {1}, 3: {1}})
+    _, violation = check_feasibility(user_ids, forbidden)
+    assert violation == ([1], [])
+
+
+@pytest.mark.parametrize('n, user_ids, index', list(games()))
+def test_find_chain(n, user_ids, index):
+    forbidden = build_forbidden(user_ids, index)
+    chain = find_chain(user_ids, forbidden, random.Random(n))
+    if brute_force(user_ids, forbidden) is None:
+        assert chain is None
+        return
+    assert_valid(chain, user_ids, forbidden)
+    if has_chain(user_ids, forbidden):
+        assert len(find_cycles(chain)) == 1
+
+
+def test_merge_cycles_keeps_assignment_valid():
+    user_ids = list(range(1, 9))
+    forbidden = build_forbidden(user_ids, {})
+    # Четыре пары «дарим друг другу»
+    assignment = {1: 2, 2: 1, 3: 4, 4: 3, 5: 6, 6: 5, 7: 8, 8: 7}
+    assert merge_cycles(assignment, forbidden, random.Random(0)) == 1
+    assert_valid(assignment, user_ids, forbidden)
+    assert len(find_cycles(assignment)) == 1
+
+
+def test_find_cycles():
+    assert sorted(map(sorted, find_cycles({1: 2, 2: 1, 3: 4, 4: 5, 5: 3}))) == [[1, 2], [3, 4, 5]]
+
+
+def test_splice_out_closes_chain():
+    # 1 -> 2 -> 3 -> 1, уходит 2: 1 дарит тому, кому дарил 2
+    assert splice_out(1, 3, {}, {3: 1}) == {1: 3}
+
+
+def test_splice_out_swaps_with_another_pair():
+    # 1 -> 5 -> 2, но между 1 и 2 исключение: 1 меняется получателем с другой парой
+    index = {1: {2}, 2: {1}}
+    rest = {2: 3, 3: 4, 4: 1}
+    changes = splice_out(1, 2, index, rest, random.Random(0))
+    result = {**rest, **changes}
+    assert_valid(result, [1, 2, 3, 4], build_forbidden([1, 2, 3, 4], index))
+    assert len(changes) == 2
+
+
+@pytest.mark.parametrize('n, user_ids, index', [game for game in games() if game[0] >= 3])
+def test_splice_out_matches_brute_force(n, user_ids, index):
+    forbidden = build_forbidden(user_ids, index)
+    assignment = find_assignment(user_ids, forbidden, random.Random(n))
+    if assignment is None:
+        return
+
+    # Уходит случайный участник: его даритель остается без получателя
+    rng = random.Random(n * 31 + user_ids[0])
+    leaving = rng.choice(user_ids)
+    giver_id = next(g for g, r in assignment.items() if r == leaving)
+    receiver_id = assignment[leaving]
+    rest = {g: r for g, r in assignment.items() if g not in (leaving, giver_id)}
+    remaining = [u for u in user_ids if u != leaving]
+    remaining_forbidden = build_forbidden(remaining, index)
+
+    changes = splice_out(giver_id, receiver_id, index, rest, rng)
+    if brute_force(remaining, remaining_forbidden) is None:
+        assert changes is None
+        return
+    assert changes is not None
+    assert giver_id in changes
+    result = {**rest, **changes}
+    assert_valid(result, remaining, remaining_forbidden)
@@ -0,0 +1,309 @@
+"""
+Импорт и выгрузка участников, исключений и распределений в CSV и JSONL.
+
+Запуск:
+    python transfer.py export users users.csv --game 1
+    python transfer.py export exclusions - --format jsonl > exclusions.jsonl
+    python transfer.py import users.csv --game 1
+    python transfer.py import exclusions.jsonl
+
+Что именно лежит в файле, определяется по колонкам:
+    users:       user_id, username, first_name, last_name, wishlist
+    exclusions:  user1_id, user2_id
+    assignments: giver_id, receiver_id
+
+Участники читаются потоково и загружаются пачками по CHUNK_SIZE, каждая
+пачка — одна транзакция, поэтому память не растет с размером файла.
+Исключения и распределения сначала проверяются целиком (все ID — участники
+игры, распределение остается возможным, получатели не повторяются) и
+загружаются одной транзакцией.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Set, TextIO, Tuple
+
+from database import Database, DEFAULT_GAME_ID, WISHLIST_MAX_LENGTH
+from distribution import build_forbidden, can_give, check_feasibility
+
+
+# Сколько строк загружаем одной транзакцией
+CHUNK_SIZE = 1000
+
+# Колонки каждого вида данных
+KINDS = {
+    'users': ('user_id', 'username', 'first_name', 'last_name', 'wishlist'),
+    'exclusions': ('user1_id', 'user2_id'),
+    'assignments': ('giver_id', 'receiver_id'),
+}
+
+FORMATS = ('csv', 'jsonl')
+
+# Сколько ID показываем в сообщении о невозможном распределении
+ERROR_IDS_LIMIT = 10
+
+
+def detect_format(filename: str) -> str:
+    """Формат по расширению файла (по умолчанию CSV)"""
+    extension = os.path.splitext(filename or '')[1].lower()
+    return 'jsonl' if extension in ('.jsonl', '.ndjson', '.json') else 'csv'
+
+
+def detect_kind(columns: Iterable[str]) -> str:
+    """Вид данных по набору колонок"""
+    columns = set(columns)
+    for kind in ('assignments', 'exclusions', 'users'):
+        if KINDS[kind][0] in columns:
+            return kind
+    raise ValueError("Не удалось понять, что в файле: нет колонки user_id, user1_id или giver_id")
+
+
+def read_records(stream: TextIO, fmt: str) -> Iterator[Dict]:
+    """Потоково читать записи-словари из CSV или JSONL"""
+    if fmt == 'csv':
+        number = 1
+        try:
+            for record in csv.DictReader(stream):
+                yield record
+                number += 1
+        except csv.Error as e:
+            raise ValueError(f"Запись {number}: некорректный CSV ({e})")
+        return
+    for line_number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            raise ValueError(f"Строка {line_number}: некорректный JSON ({e})")
+        if not isinstance(record, dict):
+            raise ValueError(f"Строка {line_number}: ожидался JSON-объект")
+        yield record
+
+
+def _user_id(record: Dict, column: str, number: int) -> int:
+    try:
+        return int(record[column])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError(f"Запись {number}: в колонке {column} должен быть числовой ID")
+
+
+def _text(record: Dict, column: str) -> str:
+    """Пустые значения загружаем как NULL"""
+    value = record.get(column)
+    return str(value) if value not in (None, '') else None
+
+
+def parse_row(kind: str, record: Dict, number: int) -> Tuple:
+    """Запись файла -> кортеж для Database"""
+    if kind == 'users':
+        first_name = _text(record, 'first_name')
+        if first_name is None:
+            raise ValueError(f"Запись {number}: не указано имя (first_name)")
+        wishlist = _text(record, 'wishlist')
+        if wishlist and len(wishlist) > WISHLIST_MAX_LENGTH:
+            raise ValueError(f"Запись {number}: вишлист длиннее {WISHLIST_MAX_LENGTH} символов")
+        return (
+            _user_id(record, 'user_id', number),
+            _text(record, 'username') or '',
+            first_name,
+            _text(record, 'last_name'),
+            wishlist,
+        )
+    first, second = KINDS[kind]
+    a, b = _user_id(record, first, number), _user_id(record, second, number)
+    if a == b:
+        raise ValueError(f"Запись {number}: {first} и {second} совпадают")
+    return a, b
+
+
+def chunked(iterable: Iterable, size: int = CHUNK_SIZE) -> Iterator[List]:
+    """Разбить поток на списки не длиннее size"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _id_list(user_ids: List[int]) -> str:
+    shown = ", ".join(map(str, user_ids[:ERROR_IDS_LIMIT]))
+    if len(user_ids) > ERROR_IDS_LIMIT:
+        shown += f" и еще {len(user_ids) - ERROR_IDS_LIMIT}"
+    return shown
+
+
+def check_members(kind: str, rows: List[Tuple[int, int]], members: Set[int]):
+    """Все ID в парах должны быть участниками игры"""
+    for number, pair in enumerate(rows, start=1):
+        for column, user_id in zip(KINDS[kind], pair):
+            if user_id not in members:
+                raise ValueError(f"Запись {number}: участника {user_id} ({column}) нет в игре")
+
+
+def check_exclusions(db: Database, game_id: int, pairs: List[Tuple[int, int]], members: Set[int]):
+    """С новыми исключениями распределение должно оставаться возможным"""
+    index = {user_id: set(others) for user_id, others in db.get_exclusion_index(game_id).items()}
+    for a, b in pairs:
+        index.setdefault(a, set()).add(b)
+        index.setdefault(b, set()).add(a)
+    user_ids = sorted(members)
+    _, violation = check_feasibility(user_ids, build_forbidden(user_ids, index))
+    if violation:
+        givers, receivers = violation
+        if not receivers:
+            reason = f"участникам {_id_list(givers)} некому дарить"
+        else:
+            reason = f"участники {_id_list(givers)} могут дарить только {_id_list(receivers)}"
+        raise ValueError(f"с этими исключениями распределить роли невозможно: {reason}")
+
+
+def check_assignments(db: Database, game_id: int, pairs: List[Tuple[int, int]]):
+    """
+    Распределения из файла заменяют пары своих дарителей. После загрузки
+    у каждого дарителя и получателя одна пара и нет запрещенных пар.
+    """
+    index = db.get_exclusion_index(game_id)
+    result = {giver_id: receiver_id for _, giver_id, receiver_id, _ in db.get_all_assignments(game_id)}
+    givers = set()
+    for number, (giver_id, receiver_id) in enumerate(pairs, start=1):
+        if giver_id in givers:
+            raise ValueError(f"Запись {number}: у дарителя {giver_id} уже есть получатель в файле")
+        if giver_id == receiver_id:
+            raise ValueError(f"Запись {number}: участник {giver_id} не может дарить себе")
+        if not can_give(index, giver_id, receiver_id):
+            raise ValueError(f"Запись {number}: между {giver_id} и {receiver_id} есть исключение")
+        givers.add(giver_id)
+        result[giver_id] = receiver_id
+
+    givers_by_receiver: Dict[int, List[int]] = {}
+    for giver_id, receiver_id in result.items():
+        givers_by_receiver.setdefault(receiver_id, []).append(giver_id)
+    for receiver_id, receiver_givers in givers_by_receiver.items():
+        if len(receiver_givers) > 1:
+            raise ValueError(
+                f"получателю {receiver_id} дарили бы несколько участников: {_id_list(sorted(receiver_givers))}"
+            )
+
+
+def import_stream(db: Database, game_id: int, stream: TextIO, fmt: str) -> Tuple[str, int]:
+    """
+    Загрузить файл в игру. Возвращает (вид данных, число строк).
+    При ошибке в строке файла с участниками уже загруженные пачки остаются
+    в базе; исключения и распределения загружаются целиком или не загружаются.
+    """
+    records = read_records(stream, fmt)
+    first = next(records, None)
+    if first is None:
+        raise ValueError("Файл пустой")
+    kind = detect_kind(first)
+
+    def rows():
+        yield parse_row(kind, first, 1)
+        for number, record in enumerate(records, start=2):
+            yield parse_row(kind, record, number)
+
+    if kind == 'users':
+        total = 0
+        for chunk in chunked(rows()):
+            db.add_users(game_id, chunk)
+            total += len(chunk)
+        return kind, total
+
+    # Пар не больше, чем пар участников игры, поэтому проверяем файл целиком.
+    # Проверка и загрузка в одной транзакции: игру не изменят между ними
+    with db.transaction():
+        pairs = list(rows())
+        members = {user_id for user_id, _, _ in db.get_user_names(game_id)}
+        check_members(kind, pairs, members)
+        if kind == 'exclusions':
+            check_exclusions(db, game_id, pairs, members)
+            db.add_exclusions(game_id, pairs)
+        else:
+            check_assignments(db, game_id, pairs)
+            db.update_assignments(game_id, pairs)
+    return kind, len(pairs)
+
+
+def export_stream(db: Database, game_id: int, kind: str, stream: TextIO, fmt: str) -> int:
+    """Выгрузить данные игры в поток. Возвращает число строк."""
+    columns = KINDS[kind]
+    rows = {
+        'users': db.iter_users,
+        'exclusions': db.iter_exclusions,
+        'assignments': db.iter_assignments,
+    }[kind](game_id)
+
+    total = 0
+    if fmt == 'csv':
+        writer = csv.writer(stream)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(['' if value is None else value for value in row])
+            total += 1
+    else:
+        for row in rows:
+            stream.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n')
+            total += 1
+    return total
+
+
+def export_bytes(db: Database, game_id: int, kind: str, fmt: str) -> io.BytesIO:
+    """Выгрузка в память (для отправки файлом в Telegram)"""
+    buffer = io.BytesIO()
+    text = io.TextIOWrapper(buffer, encoding='utf-8', newline='')
+    export_stream(db, game_id, kind, text, fmt)
+    text.flush()
+    text.detach()
+    buffer.seek(0)
+    return buffer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Импорт и выгрузка данных Тайного Санты")
+    parser.add_argument('--db', default='santa.db', help="файл базы данных")
+    parser.add_argument('--game', type=int, default=DEFAULT_GAME_ID, help="номер игры")
+    parser.add_argument('--format', choices=FORMATS, help="формат файла (по умолчанию по расширению)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = commands.add_parser('export', help="выгрузить данные игры")
+    export_parser.add_argument('kind', choices=KINDS)
+    export_parser.add_argument('path', help="файл или - для stdout")
+
+    import_parser = commands.add_parser('import', help="загрузить файл в игру")
+    import_parser.add_argument('path', help="файл или - для stdin")
+
+    args = parser.parse_args()
+    fmt = args.format or detect_format(args.path)
+    db = Database(args.db)
+    try:
+        if db.get_game(args.game) is None:
+            raise ValueError(f"игры {args.game} нет в базе")
+        if args.command == 'export':
+            if args.path == '-':
+                total = export_stream(db, args.game, args.kind, sys.stdout, fmt)
+            else:
+                with open(args.path, 'w', encoding='utf-8', newline='') as f:
+                    total = export_stream(db, args.game, args.kind, f, fmt)
+            print(f"Выгружено строк: {total}", file=sys.stderr)
+        else:
+            if args.path == '-':
+                kind, total = import_stream(db, args.game, sys.stdin, fmt)
+            else:
+                with open(args.path, encoding='utf-8-sig', newline='') as f:
+                    kind, total = import_stream(db, args.game, f, fmt)
+            print(f"Загружено ({kind}): {total}", file=sys.stderr)
+    except ValueError as e:
+        sys.exit(f"Ошибка: {e}")
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()